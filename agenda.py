@@ -0,0 +1,200 @@
+"""
+Agenda en memoria de las próximas verificaciones
+
+El verificador por cron descubre el trabajo escaneando
+`proxima_verificacion <= ahora` en cada disparo, así que la precisión
+depende de la frecuencia del cron. La agenda mantiene en un heap las mismas
+fechas que la base de datos: se carga al iniciar, se actualiza después de
+cada commit que reprograma una guía (suscribir, verificar, webhook,
+cancelar) y un worker del proceso despierta justo en la fecha más próxima
+para verificar solo esas guías.
+
+La base de datos sigue siendo la fuente de verdad: el worker relee cada
+guía antes de verificarla y la agenda se recarga completa cada
+AGENDA_RESINCRONIZAR_MINUTOS para recoger escrituras de otras instancias.
+"""
+
+import asyncio
+import heapq
+import logging
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from reloj import a_colombia, ahora
+
+logger = logging.getLogger(__name__)
+
+
+class AgendaVerificaciones:
+    """
+    Heap de (fecha, guia_id) con borrado perezoso
+    
+    `_fechas` guarda la fecha vigente de cada guía; las entradas del heap que
+    no coinciden con ella son reprogramaciones viejas y se descartan al salir.
+    Mientras el worker no está corriendo la agenda ignora las escrituras.
+    """
+    
+    def __init__(self, espera_maxima_segundos: float = 60):
+        self.espera_maxima_segundos = espera_maxima_segundos
+        self._heap: List[Tuple[datetime, int]] = []
+        self._fechas: Dict[int, datetime] = {}
+        self._despertar = asyncio.Event()
+        self._tarea: Optional[asyncio.Task] = None
+        self.ultima_carga: Optional[datetime] = None
+        self.disparos = 0
+        self.guias_disparadas = 0
+        self.errores = 0
+    
+    def __len__(self) -> int:
+        return len(self._fechas)
+    
+    @property
+    def activa(self) -> bool:
+        return self._tarea is not None
+    
+    def programar(self, guia_id: int, fecha: Optional[datetime]):
+        """Agenda (o reprograma) una guía; fecha None la saca de la agenda"""
+        if not self.activa:
+            return
+        if fecha is None:
+            self._fechas.pop(guia_id, None)
+            return
+        if self._fechas.get(guia_id) == fecha:
+            return
+        
+        siguiente = self.proxima()
+        self._fechas[guia_id] = fecha
+        heapq.heappush(self._heap, (fecha, guia_id))
+        if siguiente is None or fecha < siguiente:
+            self._despertar.set()
+        
+        # Muchas reprogramaciones dejan entradas obsoletas: se reconstruye el heap
+        if len(self._heap) > 2 * len(self._fechas) + 1000:
+            self._reconstruir()
+    
+    def cancelar(self, guia_id: int):
+        self._fechas.pop(guia_id, None)
+    
+    def cargar(self, pares: Iterable[Tuple[int, datetime]]):
+        """Reemplaza la agenda completa con pares (guia_id, proxima_verificacion)"""
+        self._fechas = {guia_id: fecha for guia_id, fecha in pares}
+        self._reconstruir()
+        self.ultima_carga = ahora()
+        self._despertar.set()
+    
+    def proxima(self) -> Optional[datetime]:
+        """Fecha de la próxima verificación agendada"""
+        self._descartar_obsoletas()
+        return self._heap[0][0] if self._heap else None
+    
+    def vencidas(self, momento: datetime, limite: int) -> List[int]:
+        """
+        Saca de la agenda hasta `limite` guías con fecha <= momento
+        
+        Quien las procesa debe volver a programarlas con su nueva fecha.
+        """
+        guia_ids = []
+        while len(guia_ids) < limite:
+            self._descartar_obsoletas()
+            if not self._heap or self._heap[0][0] > momento:
+                break
+            _, guia_id = heapq.heappop(self._heap)
+            del self._fechas[guia_id]
+            guia_ids.append(guia_id)
+        return guia_ids
+    
+    def _descartar_obsoletas(self):
+        while self._heap and self._fechas.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+    
+    def _reconstruir(self):
+        self._heap = [(fecha, guia_id) for guia_id, fecha in self._fechas.items()]
+        heapq.heapify(self._heap)
+    
+    # ===== WORKER =====
+    
+    def iniciar(
+        self,
+        procesar: Callable[[List[int]], Awaitable[None]],
+        recargar: Callable[[], Awaitable[None]],
+        tamano_lote: int,
+        intervalo_recarga: timedelta
+    ):
+        """
+        Arranca el worker en el event loop actual
+        
+        Args:
+            procesar: Verifica un lote de guia_ids vencidos y los reprograma
+            recargar: Lee las fechas desde la base de datos y llama a cargar()
+            tamano_lote: Máximo de guías por llamada a procesar
+            intervalo_recarga: Cada cuánto se recarga la agenda completa
+        """
+        if self.activa:
+            return
+        self._despertar = asyncio.Event()
+        self.ultima_carga = None
+        self._tarea = asyncio.create_task(
+            self._ejecutar(procesar, recargar, tamano_lote, intervalo_recarga)
+        )
+    
+    async def detener(self):
+        if not self._tarea:
+            return
+        self._tarea.cancel()
+        try:
+            await self._tarea
+        except asyncio.CancelledError:
+            pass
+        self._tarea = None
+        self._fechas.clear()
+        self._heap.clear()
+    
+    async def _ejecutar(self, procesar, recargar, tamano_lote: int, intervalo_recarga: timedelta):
+        while True:
+            try:
+                if self.ultima_carga is None or ahora() - self.ultima_carga >= intervalo_recarga:
+                    await recargar()
+                
+                momento = ahora()
+                guia_ids = self.vencidas(momento, tamano_lote)
+                if guia_ids:
+                    self.disparos += 1
+                    self.guias_disparadas += len(guia_ids)
+                    await procesar(guia_ids)
+                    continue
+                
+                siguiente = self.proxima()
+                espera = self.espera_maxima_segundos
+                if siguiente is not None:
+                    espera = min(max((siguiente - momento).total_seconds(), 0), espera)
+                
+                # Se despierta antes si alguien agenda una guía más próxima
+                self._despertar.clear()
+                try:
+                    await asyncio.wait_for(self._despertar.wait(), timeout=espera)
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Las guías del lote fallido vuelven con la recarga completa
+                self.errores += 1
+                self.ultima_carga = None
+                logger.error("❌ Error en el worker de la agenda: %s", e)
+                await asyncio.sleep(self.espera_maxima_segundos)
+    
+    def estadisticas(self) -> dict:
+        siguiente = self.proxima()
+        return {
+            "activa": self.activa,
+            "guias": len(self),
+            "entradas_heap": len(self._heap),
+            "proxima": a_colombia(siguiente).isoformat() if siguiente else None,
+            "ultima_carga": a_colombia(self.ultima_carga).isoformat() if self.ultima_carga else None,
+            "disparos": self.disparos,
+            "guias_disparadas": self.guias_disparadas,
+            "errores": self.errores,
+        }
+
+
+agenda_verificaciones = AgendaVerificaciones()
@@ -0,0 +1,285 @@
+"""
+Benchmark offline de /api/verificar
+
+Levanta los stubs locales de rastreo, OneSignal y FCM, siembra N suscripciones
+vencidas en SQLite (o en DATABASE_URL si se pasa --database-url) y ejecuta
+/api/verificar en proceso midiendo:
+
+- throughput (guías verificadas por segundo)
+- latencia p50/p99 de cada ejecución completa
+- sentencias SQL emitidas por ejecución
+- memoria (pico de tracemalloc y RSS máximo del proceso)
+- push: entregados al proveedor y tiempo extra hasta vaciar la cola de envíos
+  elegido con --proveedor-push (onesignal y fcm contra sus stubs; memoria y
+  archivo sin red)
+
+El resultado se imprime y se puede guardar en JSON con --salida para
+comparar entre cambios.
+
+Uso:
+    python -m benchmarks.benchmark_verificador --guias 2000 --repeticiones 5 --salida bench.json
+    python -m benchmarks.benchmark_verificador --proveedor-push memoria --push-tasa 5000
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.stubs import PROGRESION_ESTADOS, ServidorStub, crear_app_rastreo, crear_app_onesignal, crear_app_fcm
+
+
+def percentil(valores: list, p: float) -> float:
+    """Percentil por interpolación lineal (valores ya medidos, p en 0-100)"""
+    ordenados = sorted(valores)
+    if not ordenados:
+        return 0.0
+    k = (len(ordenados) - 1) * p / 100
+    inferior = int(k)
+    superior = min(inferior + 1, len(ordenados) - 1)
+    return ordenados[inferior] + (ordenados[superior] - ordenados[inferior]) * (k - inferior)
+
+
+def _commit_actual() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except Exception:
+        return ""
+
+
+def configurar_entorno(args, url_rastreo: str, url_onesignal: str, url_fcm: str) -> str:
+    """
+    Apunta la app a los stubs y a la base de datos del benchmark
+    Debe ejecutarse ANTES de importar main/config/database
+    """
+    directorio = tempfile.mkdtemp(prefix='bench_')
+    database_url = args.database_url
+    if not database_url:
+        database_url = f"sqlite:///{os.path.join(directorio, 'bench.db')}"
+    
+    os.environ["DATABASE_URL"] = database_url
+    os.environ["RASTREO_API_URL"] = f"{url_rastreo}/api/rastreo"
+    os.environ["ONESIGNAL_API_URL"] = f"{url_onesignal}/api/v1"
+    os.environ.setdefault("ONESIGNAL_API_KEY", "bench")
+    os.environ.setdefault("ONESIGNAL_APP_ID", "bench")
+    os.environ["FCM_API_URL"] = f"{url_fcm}/v1"
+    os.environ.setdefault("FCM_PROYECTO", "bench")
+    os.environ.setdefault("FCM_TOKEN_ACCESO", "bench")
+    os.environ["PUSH_PROVEEDOR"] = args.proveedor_push
+    os.environ["PUSH_ARCHIVO"] = os.path.join(directorio, "push.jsonl")
+    os.environ["PUSH_TASA_POR_SEGUNDO"] = str(args.push_tasa)
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    return database_url
+
+
+async def sembrar(n: int, estado: str = "ADMITIDA"):
+    """Reinicia las tablas con N guías vencidas, cada una con una suscripción activa"""
+    from sqlalchemy import delete, insert
+    from database import AsyncSessionLocal, Guia, Suscripcion, HistorialVerificacion, recalcular_contadores
+    
+    from reloj import ahora, a_colombia
+    
+    vencida = ahora() - timedelta(minutes=5)
+    guias = [
+        {
+            "numero_guia": f"B{i:09d}",
+            "origen": "MEDELLIN (ANTIOQUIA)",
+            "destino": "BARRANQUILLA (ATLANTICO)",
+            "estado_actual": estado,
+            "fecha_admision": a_colombia(vencida).strftime("%Y/%m/%d %H:%M"),
+            "fecha_creacion": vencida,
+            "proxima_verificacion": vencida,
+            "verificaciones_realizadas": 0,
+        }
+        for i in range(n)
+    ]
+    
+    async with AsyncSessionLocal() as db:
+        await db.execute(delete(HistorialVerificacion))
+        await db.execute(delete(Suscripcion))
+        await db.execute(delete(Guia))
+        for inicio in range(0, n, 1000):
+            ids = await db.scalars(
+                insert(Guia).returning(Guia.id, sort_by_parameter_order=True),
+                guias[inicio:inicio + 1000]
+            )
+            await db.execute(insert(Suscripcion), [
+                {
+                    "numero_guia": guia["numero_guia"],
+                    "guia_id": guia_id,
+                    "onesignal_user_id": f"00000000-0000-4000-8000-{(inicio + i) % 500:012d}",
+                    "token_fcm": f"fcm-bench-{inicio + i}",
+                    "fecha_creacion": vencida,
+                    "activo": True,
+                }
+                for i, (guia, guia_id) in enumerate(zip(guias[inicio:inicio + 1000], ids.all()))
+            ])
+        await db.commit()
+        await recalcular_contadores(db)
+
+
+async def ejecutar(args) -> dict:
+    import httpx
+    from sqlalchemy import event
+    from cache import cache_lectura
+    from database import init_db, async_engine
+    from envios import controlador_envios
+    import main
+    
+    init_db()
+    
+    sentencias = {"total": 0}
+    
+    @event.listens_for(async_engine.sync_engine, "before_cursor_execute")
+    def _contar_sentencia(*_):
+        sentencias["total"] += 1
+    
+    transporte = httpx.ASGITransport(app=main.app)
+    ejecuciones = []
+    
+    async with httpx.AsyncClient(transport=transporte, base_url="http://bench", timeout=None) as cliente:
+        for repeticion in range(args.calentamiento + args.repeticiones):
+            await sembrar(args.guias, PROGRESION_ESTADOS[args.posicion_inicial])
+            cache_lectura.limpiar()
+            args.estado_rastreo.posiciones.clear()
+            args.estado_rastreo.posiciones.update(
+                {f"B{i:09d}": args.posicion_inicial for i in range(args.guias)}
+            )
+            
+            sentencias["total"] = 0
+            enviados, fallidos = controlador_envios.enviados, controlador_envios.fallidos
+            tracemalloc.start()
+            inicio = time.perf_counter()
+            respuesta = await cliente.post("/api/verificar")
+            duracion = time.perf_counter() - inicio
+            _, pico_memoria = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            
+            if respuesta.status_code != 200:
+                raise RuntimeError(f"/api/verificar respondió {respuesta.status_code}: {respuesta.text[:300]}")
+            
+            # Los workers empiezan a enviar desde el primer lote: se mide lo que falta al responder
+            inicio_push = time.perf_counter()
+            if not await controlador_envios.vaciar(espera_maxima=args.espera_push):
+                raise RuntimeError(f"La cola de push no se vació en {args.espera_push}s")
+            duracion_push = time.perf_counter() - inicio_push
+            
+            if repeticion < args.calentamiento:
+                continue
+            
+            cuerpo = respuesta.json()
+            ejecuciones.append({
+                "duracion_s": round(duracion, 4),
+                "guias_verificadas": cuerpo["guias_verificadas"],
+                "errores_timeout": cuerpo["errores_timeout"],
+                "notificaciones_enviadas": cuerpo["notificaciones_enviadas"],
+                "lotes": cuerpo["lotes"],
+                "sentencias_sql": sentencias["total"],
+                "memoria_pico_mb": round(pico_memoria / 1024 / 1024, 2),
+                "vaciado_push_s": round(duracion_push, 4),
+                "push_entregados": controlador_envios.enviados - enviados,
+                "push_fallidos": controlador_envios.fallidos - fallidos,
+                "tiempos": cuerpo.get("tiempos", {}),
+            })
+    
+    await controlador_envios.detener()
+    await async_engine.dispose()
+    
+    duraciones = [e["duracion_s"] for e in ejecuciones]
+    verificadas = sum(e["guias_verificadas"] for e in ejecuciones)
+    entregados = sum(e["push_entregados"] for e in ejecuciones)
+    duracion_total = sum(duraciones) + sum(e["vaciado_push_s"] for e in ejecuciones)
+    
+    return {
+        "benchmark": "verificador",
+        "fecha": datetime.now().isoformat(),
+        "commit": _commit_actual(),
+        "python": platform.python_version(),
+        "base_datos": args.database_url.split("://")[0] if args.database_url else "sqlite",
+        "parametros": {
+            "guias": args.guias,
+            "repeticiones": args.repeticiones,
+            "calentamiento": args.calentamiento,
+            "latencia_rastreo_ms": args.latencia_ms,
+            "tasa_error_rastreo": args.tasa_error,
+            "prob_avance": args.prob_avance,
+            "posicion_inicial": args.posicion_inicial,
+            "proveedor_push": args.proveedor_push,
+            "push_tasa_por_segundo": args.push_tasa,
+        },
+        "resultados": {
+            "throughput_guias_s": round(verificadas / sum(duraciones), 1) if duraciones else 0,
+            "latencia_p50_s": round(percentil(duraciones, 50), 4),
+            "latencia_p99_s": round(percentil(duraciones, 99), 4),
+            "latencia_media_s": round(statistics.fmean(duraciones), 4) if duraciones else 0,
+            "sentencias_sql_por_ejecucion": max((e["sentencias_sql"] for e in ejecuciones), default=0),
+            "memoria_pico_mb": max((e["memoria_pico_mb"] for e in ejecuciones), default=0),
+            "rss_maximo_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            "consultas_stub": args.estado_rastreo.consultas,
+            "errores_stub": args.estado_rastreo.errores,
+            "push_entregados": entregados,
+            "push_fallidos": sum(e["push_fallidos"] for e in ejecuciones),
+            # Hasta el último push entregado (verificación + vaciado de la cola)
+            "push_por_segundo": round(entregados / duracion_total, 1) if duracion_total else 0,
+        },
+        "ejecuciones": ejecuciones,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark offline de /api/verificar")
+    parser.add_argument("--guias", type=int, default=1000, help="Suscripciones vencidas a sembrar")
+    parser.add_argument("--repeticiones", type=int, default=5)
+    parser.add_argument("--calentamiento", type=int, default=1, help="Ejecuciones descartadas")
+    parser.add_argument("--latencia-ms", type=float, default=50, help="Latencia media del stub de rastreo")
+    parser.add_argument("--jitter-ms", type=float, default=20)
+    parser.add_argument("--tasa-error", type=float, default=0.02, help="Fracción de respuestas 503 del stub")
+    parser.add_argument("--prob-avance", type=float, default=0.3, help="Probabilidad de avanzar de estado por consulta")
+    parser.add_argument(
+        "--posicion-inicial", type=int, default=0, choices=range(len(PROGRESION_ESTADOS) - 1),
+        help="Estado de partida de cada guía (2 = EN TRANSITO: cada avance es una llegada con push)"
+    )
+    parser.add_argument("--database-url", default="", help="Por defecto SQLite temporal")
+    parser.add_argument("--puerto-rastreo", type=int, default=9101)
+    parser.add_argument("--puerto-onesignal", type=int, default=9102)
+    parser.add_argument("--puerto-fcm", type=int, default=9103)
+    parser.add_argument(
+        "--proveedor-push", choices=["onesignal", "fcm", "memoria", "archivo"], default="onesignal",
+        help="onesignal y fcm van a sus stubs locales; memoria y archivo no usan red"
+    )
+    parser.add_argument("--push-tasa", type=float, default=1000, help="PUSH_TASA_POR_SEGUNDO del controlador")
+    parser.add_argument("--espera-push", type=float, default=300, help="Segundos máximos para vaciar la cola de push")
+    parser.add_argument("--salida", default="", help="Archivo JSON donde guardar el resultado")
+    args = parser.parse_args()
+    
+    app_rastreo = crear_app_rastreo(args.latencia_ms, args.jitter_ms, args.tasa_error, args.prob_avance)
+    args.estado_rastreo = app_rastreo.state.rastreo
+    
+    with ServidorStub(app_rastreo, args.puerto_rastreo) as rastreo, \
+         ServidorStub(crear_app_onesignal(), args.puerto_onesignal) as onesignal, \
+         ServidorStub(crear_app_fcm(), args.puerto_fcm) as fcm:
+        configurar_entorno(args, rastreo.url, onesignal.url, fcm.url)
+        resultado = asyncio.run(ejecutar(args))
+    
+    texto = json.dumps(resultado, indent=2, ensure_ascii=False)
+    print(texto)
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as archivo:
+            archivo.write(texto + "\n")
+
+
+if __name__ == "__main__":
+    main()
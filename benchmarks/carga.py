@@ -0,0 +1,298 @@
+"""
+Pruebas de carga de los endpoints de suscripción y lectura
+
+Generador asíncrono de lazo abierto: las peticiones se lanzan según la tasa
+objetivo (RPS) de cada fase sin esperar a que terminen las anteriores, y la
+latencia se mide desde el instante programado (no desde el envío), así un
+servidor saturado no "frena" al generador y las colas se ven en los percentiles.
+
+Modos:
+- En proceso (por defecto): la app corre dentro de este proceso vía
+  httpx.ASGITransport, con stubs locales de rastreo y OneSignal y SQLite temporal
+- Por localhost (--url): contra un servidor ya levantado y apuntado a los stubs:
+      python -m benchmarks.stubs
+      RASTREO_API_URL=http://127.0.0.1:9001/api/rastreo \\
+      ONESIGNAL_API_URL=http://127.0.0.1:9002/api/v1 python main.py
+
+Uso:
+    python -m benchmarks.carga --escenario pico_manana --salida carga.json
+    python -m benchmarks.carga --escenario lectura --url http://127.0.0.1:8000
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.stubs import ServidorStub, crear_app_rastreo, crear_app_onesignal, crear_app_fcm
+from benchmarks.benchmark_verificador import configurar_entorno, percentil, _commit_actual
+
+# ===== ESCENARIOS PREDEFINIDOS =====
+# fases: [(duración en segundos, RPS objetivo)]
+# mezcla: peso relativo de cada endpoint
+
+ESCENARIOS = {
+    # Pico de la mañana: los clientes registran sus guías al despachar y
+    # enseguida consultan el estado varias veces desde la app
+    "pico_manana": {
+        "fases": [(20, 10), (20, 25), (60, 50), (20, 25)],
+        "mezcla": {"suscribir": 45, "consultar_guia": 40, "consultar_usuario": 15},
+    },
+    # Solo lecturas (cache y base de datos) sobre guías ya suscritas
+    "lectura": {
+        "fases": [(10, 50), (40, 150)],
+        "mezcla": {"consultar_guia": 70, "consultar_usuario": 30},
+        "precarga": 500,
+    },
+    # Corto, para validar el entorno
+    "humo": {
+        "fases": [(5, 10)],
+        "mezcla": {"suscribir": 50, "consultar_guia": 30, "consultar_usuario": 20},
+    },
+}
+
+
+class Registro:
+    """Latencias y resultados por endpoint"""
+    
+    def __init__(self):
+        self.latencias: Dict[str, List[float]] = defaultdict(list)
+        self.codigos: Dict[str, Counter] = defaultdict(Counter)
+        self.excepciones: Dict[str, Counter] = defaultdict(Counter)
+        self.descartadas = 0
+        self.en_vuelo = 0
+        self.max_en_vuelo = 0
+    
+    def resumen(self, duracion: float) -> dict:
+        endpoints = {}
+        for nombre in sorted(set(self.codigos) | set(self.excepciones)):
+            latencias_ms = [l * 1000 for l in self.latencias[nombre]]
+            codigos = self.codigos[nombre]
+            enviadas = sum(codigos.values()) + sum(self.excepciones[nombre].values())
+            exitos = sum(n for codigo, n in codigos.items() if codigo < 400)
+            endpoints[nombre] = {
+                "enviadas": enviadas,
+                "exitos": exitos,
+                "errores": enviadas - exitos,
+                "rps_logrado": round(enviadas / duracion, 1) if duracion else 0,
+                "codigos": {str(c): n for c, n in sorted(codigos.items())},
+                "excepciones": dict(self.excepciones[nombre]),
+                "latencia_ms": {
+                    "p50": round(percentil(latencias_ms, 50), 1),
+                    "p90": round(percentil(latencias_ms, 90), 1),
+                    "p99": round(percentil(latencias_ms, 99), 1),
+                    "max": round(max(latencias_ms, default=0), 1),
+                },
+            }
+        return {
+            "duracion_s": round(duracion, 2),
+            "descartadas": self.descartadas,
+            "max_en_vuelo": self.max_en_vuelo,
+            "endpoints": endpoints,
+        }
+
+
+class Generador:
+    """Construye y ejecuta cada petición del escenario"""
+    
+    def __init__(self, cliente, registro: Registro, semilla: int, usuarios: int, suscribir_asincrono: bool = False):
+        self.cliente = cliente
+        self.ruta_suscribir = "/api/suscribir?asincrono=true" if suscribir_asincrono else "/api/suscribir"
+        self.registro = registro
+        self.aleatorio = random.Random(semilla)
+        self.usuarios = [f"carga-{i:05d}" for i in range(usuarios)]
+        self.suscritas: List[Tuple[str, str]] = []
+        self._secuencia = 0
+    
+    def _nueva_guia(self) -> str:
+        self._secuencia += 1
+        return f"C{os.getpid() % 1000:03d}{self._secuencia:07d}"
+    
+    def _conocida(self) -> Tuple[str, str]:
+        if self.suscritas:
+            return self.aleatorio.choice(self.suscritas)
+        return self._nueva_guia(), self.aleatorio.choice(self.usuarios)
+    
+    def preparar(self, endpoint: str) -> Tuple[str, str, dict]:
+        """Devuelve (método, ruta, kwargs) de la próxima petición"""
+        if endpoint == "suscribir":
+            guia, usuario = self._nueva_guia(), self.aleatorio.choice(self.usuarios)
+            return "POST", self.ruta_suscribir, {"json": {"numero_guia": guia, "onesignal_user_id": usuario}}
+        if endpoint == "consultar_guia":
+            guia, _ = self._conocida()
+            return "GET", f"/api/suscripcion/{guia}", {}
+        if endpoint == "consultar_usuario":
+            _, usuario = self._conocida()
+            return "GET", f"/api/suscripciones/user/{usuario}", {}
+        raise ValueError(f"Endpoint desconocido: {endpoint}")
+    
+    async def enviar(self, endpoint: str, programada: float):
+        metodo, ruta, kwargs = self.preparar(endpoint)
+        registro = self.registro
+        registro.en_vuelo += 1
+        registro.max_en_vuelo = max(registro.max_en_vuelo, registro.en_vuelo)
+        try:
+            respuesta = await self.cliente.request(metodo, ruta, **kwargs)
+            registro.latencias[endpoint].append(time.perf_counter() - programada)
+            registro.codigos[endpoint][respuesta.status_code] += 1
+            if endpoint == "suscribir" and respuesta.status_code < 400:
+                self.suscritas.append((kwargs["json"]["numero_guia"], kwargs["json"]["onesignal_user_id"]))
+        except Exception as e:
+            registro.excepciones[endpoint][type(e).__name__] += 1
+        finally:
+            registro.en_vuelo -= 1
+
+
+async def precargar(generador: Generador, cantidad: int, concurrencia: int = 20):
+    """Suscribe guías antes de medir (para escenarios de solo lectura)"""
+    semaforo = asyncio.Semaphore(concurrencia)
+    
+    async def una():
+        async with semaforo:
+            metodo, ruta, kwargs = generador.preparar("suscribir")
+            respuesta = await generador.cliente.request(metodo, ruta, **kwargs)
+            if respuesta.status_code < 400:
+                generador.suscritas.append((kwargs["json"]["numero_guia"], kwargs["json"]["onesignal_user_id"]))
+    
+    await asyncio.gather(*(una() for _ in range(cantidad)))
+
+
+async def ejecutar_escenario(generador: Generador, escenario: dict, max_en_vuelo: int) -> float:
+    """
+    Lanza las peticiones de todas las fases a la tasa objetivo (lazo abierto)
+    
+    Returns:
+        Duración total en segundos
+    """
+    endpoints = list(escenario["mezcla"])
+    pesos = list(escenario["mezcla"].values())
+    tareas = set()
+    inicio = time.perf_counter()
+    programada = inicio
+    
+    for duracion, rps in escenario["fases"]:
+        fin_fase = programada + duracion
+        intervalo = 1 / rps
+        while programada < fin_fase:
+            espera = programada - time.perf_counter()
+            if espera > 0:
+                await asyncio.sleep(espera)
+            
+            if generador.registro.en_vuelo >= max_en_vuelo:
+                generador.registro.descartadas += 1
+            else:
+                endpoint = generador.aleatorio.choices(endpoints, pesos)[0]
+                tarea = asyncio.create_task(generador.enviar(endpoint, programada))
+                tareas.add(tarea)
+                tarea.add_done_callback(tareas.discard)
+            programada += intervalo
+    
+    if tareas:
+        await asyncio.gather(*tareas)
+    return time.perf_counter() - inicio
+
+
+async def ejecutar(args) -> dict:
+    import httpx
+    
+    escenario = ESCENARIOS[args.escenario]
+    if args.escala != 1:
+        escenario = dict(escenario, fases=[(d, r * args.escala) for d, r in escenario["fases"]])
+    if args.duracion_fase:
+        escenario = dict(escenario, fases=[(args.duracion_fase, r) for _, r in escenario["fases"]])
+    
+    limites = httpx.Limits(max_connections=args.max_en_vuelo, max_keepalive_connections=args.max_en_vuelo)
+    if args.url:
+        cliente = httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limites)
+    else:
+        from database import init_db
+        import main
+        init_db()
+        cliente = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=main.app), base_url="http://carga", timeout=args.timeout
+        )
+    
+    registro = Registro()
+    async with cliente:
+        generador = Generador(cliente, registro, args.semilla, args.usuarios, args.suscribir_asincrono)
+        if escenario.get("precarga"):
+            await precargar(generador, escenario["precarga"])
+        duracion = await ejecutar_escenario(generador, escenario, args.max_en_vuelo)
+    
+    if not args.url:
+        from database import async_engine
+        await async_engine.dispose()
+    
+    return {
+        "benchmark": "carga",
+        "escenario": args.escenario,
+        "fecha": datetime.now().isoformat(),
+        "commit": _commit_actual(),
+        "modo": "localhost" if args.url else "en_proceso",
+        "parametros": {
+            "fases": escenario["fases"],
+            "mezcla": escenario["mezcla"],
+            "max_en_vuelo": args.max_en_vuelo,
+            "usuarios": args.usuarios,
+            "suscribir_asincrono": args.suscribir_asincrono,
+            "latencia_rastreo_ms": args.latencia_ms,
+            "tasa_error_rastreo": args.tasa_error,
+        },
+        "resultados": registro.resumen(duracion),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pruebas de carga de suscripción y lectura")
+    parser.add_argument("--escenario", choices=sorted(ESCENARIOS), default="pico_manana")
+    parser.add_argument("--escala", type=float, default=1, help="Multiplica el RPS de todas las fases")
+    parser.add_argument("--duracion-fase", type=float, default=0, help="Sobrescribe la duración de cada fase (s)")
+    parser.add_argument("--url", default="", help="Servidor ya levantado (si no, en proceso)")
+    parser.add_argument("--max-en-vuelo", type=int, default=500, help="Peticiones concurrentes antes de descartar")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--usuarios", type=int, default=2000, help="Usuarios OneSignal distintos")
+    parser.add_argument("--semilla", type=int, default=1)
+    parser.add_argument("--suscribir-asincrono", action="store_true",
+                        help="Usa la suscripción rápida (202); medir por --url, en proceso se esperan las tareas de fondo")
+    parser.add_argument("--latencia-ms", type=float, default=80, help="Latencia del stub de rastreo (en proceso)")
+    parser.add_argument("--tasa-error", type=float, default=0.01)
+    parser.add_argument("--database-url", default="", help="Por defecto SQLite temporal (en proceso)")
+    parser.add_argument("--puerto-rastreo", type=int, default=9111)
+    parser.add_argument("--puerto-onesignal", type=int, default=9112)
+    parser.add_argument("--puerto-fcm", type=int, default=9113)
+    parser.add_argument(
+        "--proveedor-push", choices=["onesignal", "fcm", "memoria", "archivo"], default="onesignal",
+        help="Proveedor de push en proceso (onesignal y fcm van a sus stubs)"
+    )
+    parser.add_argument("--push-tasa", type=float, default=1000, help="PUSH_TASA_POR_SEGUNDO del controlador")
+    parser.add_argument("--salida", default="", help="Archivo JSON donde guardar el resultado")
+    args = parser.parse_args()
+    
+    if args.url:
+        resultado = asyncio.run(ejecutar(args))
+    else:
+        # prob_avance=0: las guías nuevas no llegan a destino entre suscribir y consultar
+        app_rastreo = crear_app_rastreo(args.latencia_ms, tasa_error=args.tasa_error, prob_avance=0)
+        with ServidorStub(app_rastreo, args.puerto_rastreo) as rastreo, \
+             ServidorStub(crear_app_onesignal(), args.puerto_onesignal) as onesignal, \
+             ServidorStub(crear_app_fcm(), args.puerto_fcm) as fcm:
+            configurar_entorno(args, rastreo.url, onesignal.url, fcm.url)
+            resultado = asyncio.run(ejecutar(args))
+    
+    texto = json.dumps(resultado, indent=2, ensure_ascii=False)
+    print(texto)
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as archivo:
+            archivo.write(texto + "\n")
+
+
+if __name__ == "__main__":
+    main()
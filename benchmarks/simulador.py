@@ -0,0 +1,274 @@
+"""
+Simulador del planificador de verificaciones
+
+Reproduce ciclos de vida sintéticos de guías (admisión -> despacho ->
+llegada a oficina) durante varios días simulados y aplica una política de
+verificación con el reloj simulado (`reloj.RelojSimulado`), sin base de datos
+ni red. Por cada política reporta:
+
+- llamadas a la API de rastreo por guía notificada
+- retraso de la notificación (llegada real -> verificación que la detecta)
+
+La política "actual" es `calcular_proxima_verificacion`; las demás son
+referencias de intervalo fijo para comparar costo vs. latencia.
+
+Uso:
+    python -m benchmarks.simulador --dias 7 --guias-por-dia 400 --salida sim.json
+    python -m benchmarks.simulador --politicas actual,fijo_1h --intervalo-verificador 30
+"""
+
+import argparse
+import heapq
+import json
+import math
+import os
+import random
+import sys
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+from config import TIEMPOS_VIAJE
+from reloj import reloj_simulado, a_colombia, ZONA_COLOMBIA
+from utils import calcular_proxima_verificacion
+from benchmarks.benchmark_verificador import percentil, _commit_actual
+
+ESTADO_ADMITIDA = "ADMITIDA"
+ESTADO_DESPACHADA = "DESPACHO NACIONAL BUSES"
+
+
+class GuiaSimulada:
+    """Ciclo de vida real de una guía (lo que la API de rastreo iría mostrando)"""
+    
+    __slots__ = ("numero", "origen", "destino", "suscripcion", "admision", "despacho", "llegada",
+                 "llamadas", "verificaciones", "notificada")
+    
+    def __init__(self, numero: str, origen: str, destino: str,
+                 suscripcion: datetime, admision: datetime, despacho: datetime, llegada: datetime):
+        self.numero = numero
+        self.origen = origen
+        self.destino = destino
+        self.suscripcion = suscripcion
+        self.admision = admision
+        self.despacho = despacho
+        self.llegada = llegada
+        self.llamadas = 0
+        self.verificaciones = 0
+        self.notificada: Optional[datetime] = None
+    
+    def estado(self, momento: datetime) -> str:
+        if momento >= self.llegada:
+            return f"RECLAME EN OFICINA {self.destino}"
+        if momento >= self.despacho:
+            return ESTADO_DESPACHADA
+        return ESTADO_ADMITIDA
+    
+    def trazabilidad(self, momento: datetime) -> List[Dict]:
+        eventos = [{"detalle": ESTADO_ADMITIDA, "fecha": _fecha_rastreo(self.admision)}]
+        if momento >= self.despacho:
+            eventos.append({"detalle": ESTADO_DESPACHADA, "fecha": _fecha_rastreo(self.despacho)})
+        return eventos
+
+
+def _fecha_rastreo(momento: datetime) -> str:
+    """Fecha tal como la publica la API de rastreo (hora Colombia sin zona)"""
+    return a_colombia(momento).strftime("%Y/%m/%d %H:%M")
+
+
+# ===== POLÍTICAS =====
+
+Politica = Callable[[GuiaSimulada, datetime], Optional[datetime]]
+
+
+def politica_actual(guia: GuiaSimulada, momento: datetime) -> Optional[datetime]:
+    return calcular_proxima_verificacion(
+        estado_actual=guia.estado(momento),
+        origen=guia.origen,
+        destino=guia.destino,
+        fecha_admision=_fecha_rastreo(guia.admision),
+        verificaciones_realizadas=guia.verificaciones,
+        trazabilidad=guia.trazabilidad(momento)
+    )
+
+
+def politica_fija(intervalo: timedelta) -> Politica:
+    def politica(guia: GuiaSimulada, momento: datetime) -> Optional[datetime]:
+        return momento + intervalo
+    return politica
+
+
+POLITICAS: Dict[str, Politica] = {
+    "actual": politica_actual,
+    "fijo_30m": politica_fija(timedelta(minutes=30)),
+    "fijo_1h": politica_fija(timedelta(hours=1)),
+    "fijo_2h": politica_fija(timedelta(hours=2)),
+}
+
+
+# ===== GENERACIÓN DE GUÍAS =====
+
+def generar_guias(dias: int, guias_por_dia: int, inicio: datetime, semilla: int,
+                  dispersion_viaje: float) -> List[GuiaSimulada]:
+    """
+    Guías con suscripción concentrada en el pico de la mañana (6-10h Colombia),
+    despacho entre 2 y 12 horas después de la admisión y duración real del
+    viaje = tiempo tabulado * lognormal(0, dispersion_viaje)
+    """
+    aleatorio = random.Random(semilla)
+    rutas = list(TIEMPOS_VIAJE.items())
+    guias = []
+    
+    # Medianoche en Colombia del primer día
+    medianoche = a_colombia(inicio).replace(hour=0, minute=0, second=0, microsecond=0)
+    
+    for dia in range(dias):
+        base = medianoche + timedelta(days=dia)
+        for i in range(guias_por_dia):
+            # 70% en el pico de la mañana, el resto repartido en el día (hora Colombia 6-20h)
+            hora_colombia = aleatorio.uniform(6, 10) if aleatorio.random() < 0.7 else aleatorio.uniform(6, 20)
+            suscripcion = (base + timedelta(hours=hora_colombia)).astimezone(timezone.utc)
+            admision = suscripcion - timedelta(minutes=aleatorio.uniform(0, 60))
+            despacho = admision + timedelta(hours=aleatorio.uniform(2, 12))
+            (origen, destino), horas = aleatorio.choice(rutas)
+            viaje = horas * math.exp(aleatorio.gauss(0, dispersion_viaje))
+            llegada = despacho + timedelta(hours=viaje)
+            guias.append(GuiaSimulada(
+                f"S{dia:02d}{i:06d}", origen, destino,
+                suscripcion.replace(second=0, microsecond=0),
+                admision.replace(second=0, microsecond=0),
+                despacho.replace(second=0, microsecond=0),
+                llegada.replace(second=0, microsecond=0)
+            ))
+    return guias
+
+
+# ===== SIMULACIÓN =====
+
+def _siguiente_ejecucion(momento: datetime, inicio: datetime, intervalo: timedelta) -> datetime:
+    """Primera ejecución del verificador (cron cada `intervalo`) en o después de `momento`"""
+    if not intervalo:
+        return momento
+    pasos = math.ceil((momento - inicio) / intervalo)
+    return inicio + pasos * intervalo
+
+
+def simular(guias: List[GuiaSimulada], politica: Politica, inicio: datetime, fin: datetime,
+            intervalo_verificador: timedelta, tasa_error: float, semilla: int) -> dict:
+    """
+    Ejecuta la política sobre las guías con un reloj simulado
+    
+    Los eventos (suscripciones y verificaciones) se procesan en orden de tiempo
+    con un heap; cada verificación sigue la misma lógica que el verificador:
+    llegada -> notificar y terminar, error -> reintentar en 1 hora, si no
+    reprogramar con la política.
+    """
+    aleatorio = random.Random(semilla)
+    for guia in guias:
+        guia.llamadas = guia.verificaciones = 0
+        guia.notificada = None
+    
+    eventos = [(guia.suscripcion, i, True) for i, guia in enumerate(guias)]
+    heapq.heapify(eventos)
+    rechazadas = 0
+    
+    with reloj_simulado(inicio) as reloj:
+        while eventos:
+            momento, indice, es_suscripcion = heapq.heappop(eventos)
+            if momento > fin:
+                break
+            reloj.fijar(momento)
+            guia = guias[indice]
+            guia.llamadas += 1
+            
+            if es_suscripcion:
+                # La suscripción consulta la guía una vez y rechaza las que ya llegaron
+                if momento >= guia.llegada:
+                    rechazadas += 1
+                    continue
+            else:
+                if aleatorio.random() < tasa_error:
+                    heapq.heappush(eventos, (_siguiente_ejecucion(momento + timedelta(hours=1), inicio, intervalo_verificador), indice, False))
+                    continue
+                if momento >= guia.llegada:
+                    guia.notificada = momento
+                    continue
+            
+            proxima = politica(guia, momento)
+            if not es_suscripcion:
+                guia.verificaciones += 1
+            if proxima is None:
+                continue
+            proxima = max(proxima, momento + timedelta(minutes=1))
+            heapq.heappush(eventos, (_siguiente_ejecucion(proxima, inicio, intervalo_verificador), indice, False))
+    
+    notificadas = [g for g in guias if g.notificada]
+    retrasos_min = [(g.notificada - g.llegada).total_seconds() / 60 for g in notificadas]
+    llamadas = [g.llamadas for g in notificadas]
+    
+    return {
+        "guias": len(guias),
+        "rechazadas_al_suscribir": rechazadas,
+        "notificadas": len(notificadas),
+        "pendientes_al_final": len(guias) - len(notificadas) - rechazadas,
+        "llamadas_totales": sum(g.llamadas for g in guias),
+        "llamadas_por_guia_notificada": {
+            "media": round(sum(llamadas) / len(llamadas), 2) if llamadas else 0,
+            "p50": round(percentil(llamadas, 50), 1),
+            "p95": round(percentil(llamadas, 95), 1),
+            "max": max(llamadas, default=0),
+        },
+        "retraso_notificacion_min": {
+            "p50": round(percentil(retrasos_min, 50), 1),
+            "p90": round(percentil(retrasos_min, 90), 1),
+            "p99": round(percentil(retrasos_min, 99), 1),
+            "max": round(max(retrasos_min, default=0), 1),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulador de políticas de verificación")
+    parser.add_argument("--dias", type=int, default=7, help="Días con nuevas suscripciones")
+    parser.add_argument("--dias-extra", type=int, default=3, help="Días adicionales para que lleguen las últimas guías")
+    parser.add_argument("--guias-por-dia", type=int, default=400)
+    parser.add_argument("--politicas", default=",".join(POLITICAS), help="Separadas por coma")
+    parser.add_argument("--intervalo-verificador", type=float, default=15,
+                        help="Minutos entre ejecuciones de /api/verificar (0 = exacto)")
+    parser.add_argument("--tasa-error", type=float, default=0.01, help="Fracción de consultas fallidas")
+    parser.add_argument("--dispersion-viaje", type=float, default=0.15, help="Sigma lognormal del tiempo real de viaje")
+    parser.add_argument("--inicio", default="2025-10-06T00:00:00", help="Inicio de la simulación (hora Colombia)")
+    parser.add_argument("--semilla", type=int, default=1)
+    parser.add_argument("--salida", default="", help="Archivo JSON donde guardar el resultado")
+    args = parser.parse_args()
+    
+    inicio = datetime.fromisoformat(args.inicio)
+    if inicio.tzinfo is None:
+        inicio = inicio.replace(tzinfo=ZONA_COLOMBIA)
+    fin = inicio + timedelta(days=args.dias + args.dias_extra)
+    intervalo = timedelta(minutes=args.intervalo_verificador)
+    guias = generar_guias(args.dias, args.guias_por_dia, inicio, args.semilla, args.dispersion_viaje)
+    
+    resultados = {}
+    for nombre in args.politicas.split(","):
+        resultados[nombre] = simular(guias, POLITICAS[nombre], inicio, fin, intervalo, args.tasa_error, args.semilla)
+    
+    resultado = {
+        "benchmark": "simulador",
+        "fecha": datetime.now().isoformat(),
+        "commit": _commit_actual(),
+        "parametros": {k: v for k, v in vars(args).items() if k != "salida"},
+        "politicas": resultados,
+    }
+    
+    texto = json.dumps(resultado, indent=2, ensure_ascii=False)
+    print(texto)
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as archivo:
+            archivo.write(texto + "\n")
+
+
+if __name__ == "__main__":
+    main()
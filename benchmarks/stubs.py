@@ -0,0 +1,240 @@
+"""
+Servidores stub locales para benchmarks y pruebas de carga
+
+- API de rastreo (RASTREO_API_URL): latencia y tasa de error configurables,
+  y progresión de estados por guía (cada consulta puede avanzar un estado)
+- OneSignal (ONESIGNAL_API_URL): /notifications y /players
+- FCM HTTP v1 (FCM_API_URL): /projects/{proyecto}/messages:send
+
+Uso independiente (por ejemplo, para apuntar un servidor real a los stubs):
+    python -m benchmarks.stubs --puerto-rastreo 9001 --puerto-onesignal 9002 --puerto-fcm 9003
+"""
+
+import argparse
+import asyncio
+import random
+import threading
+import time
+import uuid
+import zlib
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+import uvicorn
+from fastapi import FastAPI, HTTPException, Request
+
+from reloj import ZONA_COLOMBIA
+
+# Ciclo de vida típico de una guía en la API de rastreo
+PROGRESION_ESTADOS = [
+    "ADMITIDA",
+    "DESPACHO NACIONAL BUSES",
+    "EN TRANSITO",
+    "RECLAME EN OFICINA BARRANQUILLA",
+    "ENTREGADA",
+]
+
+RUTAS = [
+    ("MEDELLIN (ANTIOQUIA)", "BARRANQUILLA (ATLANTICO)"),
+    ("BOGOTA (CUNDINAMARCA)", "CALI (VALLE)"),
+    ("MEDELLIN (ANTIOQUIA)", "BOGOTA (CUNDINAMARCA)"),
+    ("BARRANQUILLA (ATLANTICO)", "SINCELEJO (SUCRE)"),
+]
+
+
+class EstadoRastreo:
+    """Estado compartido del stub de rastreo (posición de cada guía y contadores)"""
+    
+    def __init__(self, latencia_ms: float, jitter_ms: float, tasa_error: float,
+                 prob_avance: float, semilla: int):
+        self.latencia_ms = latencia_ms
+        self.jitter_ms = jitter_ms
+        self.tasa_error = tasa_error
+        self.prob_avance = prob_avance
+        self.aleatorio = random.Random(semilla)
+        self.posiciones: Dict[str, int] = {}
+        self.consultas = 0
+        self.errores = 0
+    
+    def _trazabilidad(self, posicion: int) -> List[dict]:
+        # Como la API real: hora local de Colombia sin zona
+        base = datetime.now(ZONA_COLOMBIA) - timedelta(hours=6)
+        return [
+            {"detalle": estado, "fecha": (base + timedelta(hours=i)).strftime("%Y/%m/%d %H:%M")}
+            for i, estado in enumerate(PROGRESION_ESTADOS[:posicion + 1])
+        ]
+    
+    def consultar(self, numero_guia: str) -> dict:
+        posicion = self.posiciones.get(numero_guia, 0)
+        if posicion < len(PROGRESION_ESTADOS) - 1 and self.aleatorio.random() < self.prob_avance:
+            posicion += 1
+        self.posiciones[numero_guia] = posicion
+        
+        origen, destino = RUTAS[zlib.crc32(numero_guia.encode()) % len(RUTAS)]
+        return {
+            "numero_guia": numero_guia,
+            "estado_actual": PROGRESION_ESTADOS[posicion],
+            "origen": origen,
+            "destino": destino,
+            "fecha_admision": self._trazabilidad(0)[0]["fecha"],
+            "remitente_nombre": "REMITENTE PRUEBA",
+            "destinatario_nombre": "DESTINATARIO PRUEBA",
+            "trazabilidad": self._trazabilidad(posicion),
+        }
+
+
+def crear_app_rastreo(
+    latencia_ms: float = 50,
+    jitter_ms: float = 20,
+    tasa_error: float = 0.0,
+    prob_avance: float = 0.3,
+    semilla: int = 42,
+    posiciones_iniciales: Optional[Dict[str, int]] = None
+) -> FastAPI:
+    """App que emula GET {RASTREO_API_URL}/{numero_guia}"""
+    app = FastAPI()
+    estado = EstadoRastreo(latencia_ms, jitter_ms, tasa_error, prob_avance, semilla)
+    estado.posiciones.update(posiciones_iniciales or {})
+    app.state.rastreo = estado
+    
+    @app.get("/api/rastreo/{numero_guia}")
+    async def rastreo(numero_guia: str):
+        estado.consultas += 1
+        espera = max(0.0, estado.latencia_ms + estado.aleatorio.uniform(-estado.jitter_ms, estado.jitter_ms))
+        await asyncio.sleep(espera / 1000)
+        
+        if estado.aleatorio.random() < estado.tasa_error:
+            estado.errores += 1
+            raise HTTPException(status_code=503, detail="Error simulado")
+        
+        return estado.consultar(numero_guia)
+    
+    @app.get("/stub/estadisticas")
+    async def estadisticas():
+        return {"consultas": estado.consultas, "errores": estado.errores, "guias": len(estado.posiciones)}
+    
+    return app
+
+
+def crear_app_onesignal(latencia_ms: float = 30, tasa_429: float = 0.0, semilla: int = 7) -> FastAPI:
+    """App que emula {ONESIGNAL_API_URL}/notifications y /players"""
+    app = FastAPI()
+    aleatorio = random.Random(semilla)
+    contadores = {"notificaciones": 0, "destinatarios": 0, "players": 0, "rechazos_429": 0}
+    app.state.contadores = contadores
+    
+    @app.post("/api/v1/notifications")
+    async def notificaciones(request: Request):
+        payload = await request.json()
+        await asyncio.sleep(latencia_ms / 1000)
+        
+        if aleatorio.random() < tasa_429:
+            contadores["rechazos_429"] += 1
+            raise HTTPException(status_code=429, detail="Rate limited", headers={"Retry-After": "1"})
+        
+        destinatarios = len(payload.get("include_player_ids", []))
+        contadores["notificaciones"] += 1
+        contadores["destinatarios"] += destinatarios
+        return {"id": str(uuid.uuid4()), "recipients": destinatarios}
+    
+    @app.post("/api/v1/players")
+    async def players(request: Request):
+        await request.json()
+        await asyncio.sleep(latencia_ms / 1000)
+        contadores["players"] += 1
+        return {"success": True, "id": str(uuid.uuid4())}
+    
+    @app.get("/stub/estadisticas")
+    async def estadisticas():
+        return contadores
+    
+    return app
+
+
+def crear_app_fcm(latencia_ms: float = 30, tasa_429: float = 0.0, semilla: int = 11) -> FastAPI:
+    """App que emula {FCM_API_URL}/projects/{proyecto}/messages:send (acepta cualquier token Bearer)"""
+    app = FastAPI()
+    aleatorio = random.Random(semilla)
+    contadores = {"mensajes": 0, "rechazos_429": 0}
+    app.state.contadores = contadores
+    
+    @app.post("/v1/projects/{proyecto}/messages:send")
+    async def enviar(proyecto: str, request: Request):
+        payload = await request.json()
+        await asyncio.sleep(latencia_ms / 1000)
+        
+        if not request.headers.get("Authorization", "").startswith("Bearer "):
+            raise HTTPException(status_code=401, detail="Falta el token OAuth")
+        if aleatorio.random() < tasa_429:
+            contadores["rechazos_429"] += 1
+            raise HTTPException(status_code=429, detail="QUOTA_EXCEEDED", headers={"Retry-After": "1"})
+        if not payload.get("message", {}).get("token"):
+            raise HTTPException(status_code=400, detail="INVALID_ARGUMENT")
+        
+        contadores["mensajes"] += 1
+        return {"name": f"projects/{proyecto}/messages/{uuid.uuid4()}"}
+    
+    @app.get("/stub/estadisticas")
+    async def estadisticas():
+        return contadores
+    
+    return app
+
+
+class ServidorStub:
+    """
+    Ejecuta una app ASGI con uvicorn en un hilo aparte
+    
+    Example:
+        with ServidorStub(crear_app_rastreo(), puerto=9001) as servidor:
+            print(servidor.url)
+    """
+    
+    def __init__(self, app: FastAPI, puerto: int, host: str = "127.0.0.1"):
+        self.app = app
+        self.url = f"http://{host}:{puerto}"
+        self._servidor = uvicorn.Server(
+            uvicorn.Config(app, host=host, port=puerto, log_level="warning", access_log=False)
+        )
+        self._hilo = threading.Thread(target=self._servidor.run, daemon=True)
+    
+    def __enter__(self) -> "ServidorStub":
+        self._hilo.start()
+        while not self._servidor.started:
+            time.sleep(0.01)
+        return self
+    
+    def __exit__(self, *exc):
+        self._servidor.should_exit = True
+        self._hilo.join(timeout=5)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stubs locales de rastreo, OneSignal y FCM")
+    parser.add_argument("--puerto-rastreo", type=int, default=9001)
+    parser.add_argument("--puerto-onesignal", type=int, default=9002)
+    parser.add_argument("--puerto-fcm", type=int, default=9003)
+    parser.add_argument("--latencia-ms", type=float, default=50)
+    parser.add_argument("--tasa-error", type=float, default=0.0)
+    parser.add_argument("--prob-avance", type=float, default=0.3)
+    parser.add_argument("--tasa-429", type=float, default=0.0)
+    args = parser.parse_args()
+    
+    rastreo = crear_app_rastreo(args.latencia_ms, tasa_error=args.tasa_error, prob_avance=args.prob_avance)
+    onesignal = crear_app_onesignal(tasa_429=args.tasa_429)
+    fcm = crear_app_fcm(tasa_429=args.tasa_429)
+    
+    with ServidorStub(rastreo, args.puerto_rastreo) as s1, ServidorStub(onesignal, args.puerto_onesignal) as s2, \
+            ServidorStub(fcm, args.puerto_fcm) as s3:
+        print(f"RASTREO_API_URL={s1.url}/api/rastreo")
+        print(f"ONESIGNAL_API_URL={s2.url}/api/v1")
+        print(f"FCM_API_URL={s3.url}/v1")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""
+Caché de lectura en memoria para las consultas de la app móvil
+
+La app consulta muy seguido el estado de sus guías, pero los datos solo
+cambian al suscribir, cancelar o verificar. Cada escritura invalida las
+claves exactas que afecta (por guía y por usuario) y las respuestas llevan
+ETag para que la app pueda recibir 304 sin cuerpo.
+"""
+
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+from fastapi import Response
+from fastapi.encoders import jsonable_encoder
+
+from config import CACHE_TTL_SEGUNDOS, CACHE_MAX_ENTRADAS
+
+
+class EntradaCache:
+    """Respuesta ya serializada junto con su ETag y vencimiento"""
+    
+    __slots__ = ("cuerpo", "etag", "expira")
+    
+    def __init__(self, cuerpo: bytes, etag: str, expira: float):
+        self.cuerpo = cuerpo
+        self.etag = etag
+        self.expira = expira
+
+
+class CacheLectura:
+    """
+    Caché LRU con TTL
+    
+    Guarda el JSON final (bytes) para no volver a serializar en cada lectura.
+    
+    Cada invalidación avanza una versión global y anota en qué versión se
+    invalidó la clave. Quien lee de la base de datos toma version() antes
+    de la consulta y la pasa a guardar(): si la clave se invalidó mientras
+    tanto, el valor (posiblemente viejo) se responde pero no se guarda.
+    """
+    
+    def __init__(self, ttl_segundos: int, max_entradas: int):
+        self.ttl_segundos = ttl_segundos
+        self.max_entradas = max_entradas
+        self._entradas: "OrderedDict[str, EntradaCache]" = OrderedDict()
+        self._version = 0
+        self._invalidada_en: "OrderedDict[str, int]" = OrderedDict()
+        # Versión más alta olvidada de _invalidada_en: lecturas anteriores no se guardan
+        self._version_olvidada = 0
+        self.aciertos = 0
+        self.fallos = 0
+        self.invalidaciones = 0
+        self.descartadas = 0
+    
+    def obtener(self, clave: str) -> Optional[EntradaCache]:
+        entrada = self._entradas.get(clave)
+        
+        if entrada is None or entrada.expira < time.monotonic():
+            if entrada is not None:
+                del self._entradas[clave]
+            self.fallos += 1
+            return None
+        
+        self._entradas.move_to_end(clave)
+        self.aciertos += 1
+        return entrada
+    
+    def version(self) -> int:
+        """Versión a tomar antes de leer de la base de datos (ver guardar)"""
+        return self._version
+    
+    def _vigente(self, clave: str, version: int) -> bool:
+        return version >= self._version_olvidada and self._invalidada_en.get(clave, 0) <= version
+    
+    def guardar(self, clave: str, valor: Any, version: Optional[int] = None) -> EntradaCache:
+        """
+        Serializa el valor y lo guarda
+        
+        Args:
+            version: version() tomada antes de leer el valor; si la clave se
+                invalidó después, la entrada se devuelve sin guardarla
+        """
+        cuerpo = json.dumps(jsonable_encoder(valor), ensure_ascii=False).encode("utf-8")
+        etag = '"' + hashlib.sha1(cuerpo).hexdigest()[:20] + '"'
+        entrada = EntradaCache(cuerpo, etag, time.monotonic() + self.ttl_segundos)
+        
+        if version is not None and not self._vigente(clave, version):
+            self.descartadas += 1
+            return entrada
+        
+        self._entradas[clave] = entrada
+        self._entradas.move_to_end(clave)
+        while len(self._entradas) > self.max_entradas:
+            self._entradas.popitem(last=False)
+        
+        return entrada
+    
+    def invalidar(self, *claves: str):
+        for clave in claves:
+            self._version += 1
+            self._invalidada_en[clave] = self._version
+            self._invalidada_en.move_to_end(clave)
+            if self._entradas.pop(clave, None) is not None:
+                self.invalidaciones += 1
+        
+        # Olvidar una invalidación vieja solo vuelve más conservador a guardar()
+        while len(self._invalidada_en) > self.max_entradas:
+            _, version = self._invalidada_en.popitem(last=False)
+            self._version_olvidada = max(self._version_olvidada, version)
+    
+    def limpiar(self):
+        self.invalidaciones += len(self._entradas)
+        self._entradas.clear()
+        self._version += 1
+        self._version_olvidada = self._version
+        self._invalidada_en.clear()
+    
+    def estadisticas(self) -> dict:
+        return {
+            "entradas": len(self._entradas),
+            "aciertos": self.aciertos,
+            "fallos": self.fallos,
+            "invalidaciones": self.invalidaciones,
+            "descartadas_por_invalidacion": self.descartadas,
+        }
+
+
+cache_lectura = CacheLectura(CACHE_TTL_SEGUNDOS, CACHE_MAX_ENTRADAS)
+
+
+def clave_guia(numero_guia: str) -> str:
+    return f"guia:{numero_guia}"
+
+
+def clave_usuario(onesignal_user_id: str) -> str:
+    return f"usuario:{onesignal_user_id}"
+
+
+def invalidar_suscripcion(numero_guia: str, onesignal_user_id: Optional[str]):
+    """Invalida las lecturas afectadas por escribir una fila de suscripción"""
+    cache_lectura.invalidar(clave_guia(numero_guia))
+    if onesignal_user_id:
+        cache_lectura.invalidar(clave_usuario(onesignal_user_id))
+
+
+def etag_coincide(if_none_match: Optional[str], etag: str) -> bool:
+    """Evalúa el header If-None-Match (acepta lista de ETags, débiles y '*')"""
+    if not if_none_match:
+        return False
+    
+    candidatos = [valor.strip() for valor in if_none_match.split(",")]
+    return "*" in candidatos or any(
+        candidato.removeprefix("W/") == etag for candidato in candidatos
+    )
+
+
+def respuesta_cacheada(entrada: EntradaCache, if_none_match: Optional[str]) -> Response:
+    """Construye la respuesta HTTP (200 con cuerpo o 304 sin cuerpo)"""
+    headers = {"ETag": entrada.etag, "Cache-Control": "no-cache"}
+    
+    if etag_coincide(if_none_match, entrada.etag):
+        return Response(status_code=304, headers=headers)
+    
+    return Response(content=entrada.cuerpo, media_type="application/json", headers=headers)
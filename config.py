@@ -11,6 +11,9 @@ from typing import Tuple
 ONESIGNAL_API_KEY = os.environ.get("ONESIGNAL_API_KEY", "")
 ONESIGNAL_APP_ID = os.environ.get("ONESIGNAL_APP_ID", "")
 
+# URL base de la API de OneSignal (configurable para stubs locales y benchmarks)
+ONESIGNAL_API_URL = os.environ.get("ONESIGNAL_API_URL", "https://onesignal.com/api/v1")
+
 # Validar que las variables estén configuradas
 if not ONESIGNAL_API_KEY or not ONESIGNAL_APP_ID:
     logging.warning("⚠️ OneSignal no configurado - Variables de entorno faltantes")
@@ -21,6 +24,92 @@ RASTREO_API_URL = os.environ.get(
     "https://api-buses-fkpk.onrender.com/api/rastreo"
 )
 
+# ===== CONCURRENCIA =====
+# Máximo de consultas simultáneas a la API de rastreo durante una verificación
+VERIFICACION_CONCURRENCIA = int(os.environ.get("VERIFICACION_CONCURRENCIA", "10"))
+# Guías procesadas por lote (cada lote hace su propio commit)
+VERIFICACION_TAMANO_LOTE = int(os.environ.get("VERIFICACION_TAMANO_LOTE", "200"))
+# Conexiones HTTP salientes reutilizadas (rastreo + proveedor de push)
+HTTP_MAX_CONEXIONES = int(os.environ.get("HTTP_MAX_CONEXIONES", "50"))
+
+# ===== ENVÍO DE PUSH (proveedor y cuota) =====
+# onesignal | fcm | memoria | archivo (los dos últimos no salen a la red: pruebas y benchmarks)
+PUSH_PROVEEDOR = os.environ.get("PUSH_PROVEEDOR", "onesignal").lower()
+# Destino del proveedor "archivo" (una línea JSON por push)
+PUSH_ARCHIVO = os.environ.get("PUSH_ARCHIVO", "push.jsonl")
+# Push que un worker junta por envío (el proveedor puede imponer un máximo menor)
+PUSH_TAMANO_LOTE = int(os.environ.get("PUSH_TAMANO_LOTE", "100"))
+# Peticiones por segundo al proveedor por instancia y workers simultáneos
+PUSH_TASA_POR_SEGUNDO = float(os.environ.get("PUSH_TASA_POR_SEGUNDO", "20"))
+PUSH_CONCURRENCIA = int(os.environ.get("PUSH_CONCURRENCIA", "5"))
+# Con la cola llena se descartan los push informativos (las llegadas siempre entran)
+PUSH_COLA_MAX = int(os.environ.get("PUSH_COLA_MAX", "10000"))
+# Reintentos de un push ante 429 y pausa si OneSignal no manda Retry-After
+PUSH_MAX_REINTENTOS = int(os.environ.get("PUSH_MAX_REINTENTOS", "5"))
+PUSH_ESPERA_429_SEGUNDOS = float(os.environ.get("PUSH_ESPERA_429_SEGUNDOS", "1"))
+
+# ===== FIREBASE CLOUD MESSAGING (PUSH_PROVEEDOR=fcm) =====
+FCM_PROYECTO = os.environ.get("FCM_PROYECTO", "")
+# JSON de la cuenta de servicio (requiere `pip install google-auth`)
+FCM_CREDENCIALES = os.environ.get("FCM_CREDENCIALES", "")
+# Token OAuth fijo en lugar de la cuenta de servicio (stubs locales o token gestionado afuera)
+FCM_TOKEN_ACCESO = os.environ.get("FCM_TOKEN_ACCESO", "")
+FCM_API_URL = os.environ.get("FCM_API_URL", "https://fcm.googleapis.com/v1")
+
+# ===== AGENDA EN MEMORIA (verificación a la hora exacta) =====
+# true: un worker del proceso verifica cada guía justo en su proxima_verificacion;
+# /api/verificar (cron) queda como respaldo y para la limpieza. Activar en una sola instancia
+AGENDA_ACTIVA = os.environ.get("AGENDA_ACTIVA", "false").lower() == "true"
+# Recarga completa desde la base de datos (recoge escrituras de otras instancias)
+AGENDA_RESINCRONIZAR_MINUTOS = int(os.environ.get("AGENDA_RESINCRONIZAR_MINUTOS", "30"))
+
+# ===== WEBHOOK DE RASTREO (eventos empujados por el backend de rastreo) =====
+# Secreto compartido para la firma HMAC-SHA256; vacío = webhook deshabilitado
+WEBHOOK_RASTREO_SECRETO = os.environ.get("WEBHOOK_RASTREO_SECRETO", "")
+# Antigüedad máxima aceptada del timestamp firmado (protege contra reenvíos)
+WEBHOOK_TOLERANCIA_SEGUNDOS = int(os.environ.get("WEBHOOK_TOLERANCIA_SEGUNDOS", "300"))
+# Tras un evento, el polling queda como respaldo: no antes de estas horas
+WEBHOOK_HORAS_RESPALDO = float(os.environ.get("WEBHOOK_HORAS_RESPALDO", "6"))
+WEBHOOK_MAX_EVENTOS = int(os.environ.get("WEBHOOK_MAX_EVENTOS", "500"))
+
+# ===== HITOS INTERMEDIOS (notificaciones antes de la llegada) =====
+# (texto en el detalle del evento, tipo, título, mensaje); {guia} y {destino} se reemplazan
+HITOS_INTERMEDIOS = [
+    ("DESPACHO NACIONAL BUSES", "despacho", "Tu encomienda va en camino 🚌",
+     "La guía {guia} fue despachada hacia {destino}"),
+    ("EN TRANSITO", "transito", "Tu encomienda sigue en ruta 🛣️",
+     "La guía {guia} pasó por un punto de tránsito hacia {destino}"),
+]
+NOTIFICAR_HITOS = os.environ.get("NOTIFICAR_HITOS", "true").lower() == "true"
+
+# ===== SUSCRIPCIÓN RÁPIDA =====
+# true: /api/suscribir responde 202 de inmediato y valida la guía en segundo plano
+# (se puede elegir por request con ?asincrono=true|false)
+SUSCRIPCION_ASINCRONA = os.environ.get("SUSCRIPCION_ASINCRONA", "false").lower() == "true"
+# Si la validación en segundo plano no termina (reinicio), el verificador la retoma tras estos minutos
+SUSCRIPCION_MINUTOS_RESPALDO = int(os.environ.get("SUSCRIPCION_MINUTOS_RESPALDO", "10"))
+# Consultas recientes a la API de rastreo reutilizadas al suscribir (0 = sin caché)
+RASTREO_CACHE_SEGUNDOS = int(os.environ.get("RASTREO_CACHE_SEGUNDOS", "60"))
+RASTREO_CACHE_MAX_ENTRADAS = int(os.environ.get("RASTREO_CACHE_MAX_ENTRADAS", "5000"))
+# Horas que se guarda la respuesta de un header Idempotency-Key (reintentos de la app)
+IDEMPOTENCIA_HORAS = float(os.environ.get("IDEMPOTENCIA_HORAS", "24"))
+# Suscripción en lote (clientes corporativos): máximo de items y consultas simultáneas a rastreo
+SUSCRIPCION_LOTE_MAX = int(os.environ.get("SUSCRIPCION_LOTE_MAX", "500"))
+SUSCRIPCION_LOTE_CONCURRENCIA = int(os.environ.get("SUSCRIPCION_LOTE_CONCURRENCIA", "10"))
+
+# ===== REGISTRO DE DISPOSITIVOS (players de OneSignal) =====
+# Un token FCM registrado hace menos de estas horas responde el player ID guardado
+DISPOSITIVO_REGISTRO_HORAS = float(os.environ.get("DISPOSITIVO_REGISTRO_HORAS", "168"))
+# Registro en lote (backfill): máximo de tokens y llamadas simultáneas a OneSignal
+DISPOSITIVOS_LOTE_MAX = int(os.environ.get("DISPOSITIVOS_LOTE_MAX", "500"))
+DISPOSITIVOS_LOTE_CONCURRENCIA = int(os.environ.get("DISPOSITIVOS_LOTE_CONCURRENCIA", "10"))
+
+# ===== CACHÉ DE LECTURA (consultas de la app) =====
+# Red de seguridad: las entradas se invalidan al escribir, el TTL solo cubre
+# escrituras hechas por otra instancia
+CACHE_TTL_SEGUNDOS = int(os.environ.get("CACHE_TTL_SEGUNDOS", "300"))
+CACHE_MAX_ENTRADAS = int(os.environ.get("CACHE_MAX_ENTRADAS", "10000"))
+
 # ===== CONFIGURACIÓN DE TIEMPOS =====
 HORAS_ANTES_LLEGADA = 4
 HORAS_ENTRE_VERIFICACIONES = 2
@@ -343,8 +432,8 @@ def obtener_tiempo_viaje(origen: str, destino: str) -> int:
         return TIEMPOS_VIAJE[ruta]
     
     # Si no existe, usar tiempo por defecto (12 horas)
-    logging.warning(
-        f"⚠️ Ruta {origen_limpio} -> {destino_limpio} no encontrada, "
-        f"usando tiempo por defecto de 12 horas"
+    logging.getLogger(__name__).warning(
+        "⚠️ Ruta %s -> %s no encontrada, usando tiempo por defecto de 12 horas",
+        origen_limpio, destino_limpio
     )
     return 12
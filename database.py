@@ -2,11 +2,24 @@
 Modelos de Base de Datos PostgreSQL
 """
 
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean, ForeignKey, Text, text
+from sqlalchemy import (
+    create_engine, event, inspect, select, insert, update, delete, func,
+    Column, Integer, BigInteger, String, DateTime, Boolean, ForeignKey, Index, MetaData, Table, Text, text
+)
+from sqlalchemy.dialects.postgresql import insert as insert_postgres
+from sqlalchemy.dialects.sqlite import insert as insert_sqlite
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.orm import sessionmaker, relationship
-from datetime import datetime
+from sqlalchemy.types import TypeDecorator
+from typing import AsyncIterator, Dict, Iterable, Optional
+from datetime import datetime, timezone
 import os
+import time
+
+from reloj import ahora
 
 # URL de conexión a PostgreSQL
 # En Render, la variable DATABASE_URL se configura automáticamente
@@ -19,29 +32,256 @@ DATABASE_URL = os.environ.get(
 if DATABASE_URL.startswith("postgres://"):
     DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
 
+# ===== POOL DE CONEXIONES (configurable por entorno) =====
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "10"))      # segundos esperando conexión libre
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", "300"))       # segundos antes de reciclar una conexión
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", "0"))  # 0 = sin límite
+# pre_ping hace un SELECT 1 en cada checkout; por defecto se reemplaza por
+# reciclado + LIFO + invalidación automática al detectar desconexiones
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "false").lower() == "true"
+
+# Zona en la que se escribieron las fechas sin zona antes de migrar a TIMESTAMPTZ
+# (el servidor de Render corre en UTC)
+DB_ZONA_FECHAS_LEGADO = os.environ.get("DB_ZONA_FECHAS_LEGADO", "UTC")
+
+
+def _url_asincrona(url: str) -> str:
+    """
+    Convierte la URL síncrona al driver asíncrono equivalente
+    postgresql:// -> postgresql+asyncpg://  |  sqlite:// -> sqlite+aiosqlite://
+    """
+    if url.startswith("postgresql://"):
+        url = url.replace("postgresql://", "postgresql+asyncpg://", 1)
+        # asyncpg no entiende "sslmode", usa "ssl"
+        return url.replace("sslmode=", "ssl=")
+    if url.startswith("sqlite://"):
+        return url.replace("sqlite://", "sqlite+aiosqlite://", 1)
+    return url
+
+
+def _opciones_pool_asincrono(url: str) -> dict:
+    """
+    Opciones del pool para el motor asíncrono según el driver
+    SQLite (pruebas locales) usa NullPool/StaticPool y no acepta tamaños de pool
+    """
+    if url.startswith("sqlite"):
+        return {}
+    
+    opciones = {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+        # LIFO: las conexiones sobrantes quedan ociosas y se reciclan,
+        # en vez de rotar todas y encontrarlas cerradas por el servidor
+        "pool_use_lifo": True,
+    }
+    
+    if url.startswith("postgresql+asyncpg") and DB_STATEMENT_TIMEOUT_MS > 0:
+        opciones["connect_args"] = {
+            "server_settings": {"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)}
+        }
+    
+    return opciones
+
+
+ASYNC_DATABASE_URL = os.environ.get("ASYNC_DATABASE_URL", _url_asincrona(DATABASE_URL))
+
+# Motor síncrono: solo para inicialización y migraciones al arrancar
 engine = create_engine(DATABASE_URL, pool_pre_ping=True, pool_recycle=300)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# Motor asíncrono: usado por todos los endpoints (no bloquea el event loop)
+async_engine = create_async_engine(ASYNC_DATABASE_URL, **_opciones_pool_asincrono(ASYNC_DATABASE_URL))
+AsyncSessionLocal = async_sessionmaker(
+    bind=async_engine,
+    class_=AsyncSession,
+    autoflush=False,
+    expire_on_commit=False
+)
+
 Base = declarative_base()
 
-# ============ MODELOS ============
+# ============ MÉTRICAS DEL POOL ============
 
-class Suscripcion(Base):
+_metricas_pool = {
+    "conexiones_creadas": 0,
+    "conexiones_invalidadas": 0,
+    "checkouts": 0,
+    "esperas": 0,
+    "segundos_espera": 0.0,
+    "timeouts": 0,
+}
+
+
+@event.listens_for(async_engine.sync_engine, "connect")
+def _al_conectar(dbapi_connection, connection_record):
+    _metricas_pool["conexiones_creadas"] += 1
+
+
+@event.listens_for(async_engine.sync_engine, "checkout")
+def _al_checkout(dbapi_connection, connection_record, connection_proxy):
+    _metricas_pool["checkouts"] += 1
+
+
+@event.listens_for(async_engine.sync_engine, "invalidate")
+def _al_invalidar(dbapi_connection, connection_record, exception):
+    _metricas_pool["conexiones_invalidadas"] += 1
+
+
+def _pool_agotado() -> bool:
+    """True si el próximo checkout tendrá que esperar una conexión libre"""
+    pool = async_engine.pool
+    if not isinstance(pool, QueuePool):
+        return False
+    # overflow() cuenta las conexiones creadas por encima de pool_size (parte de -pool_size)
+    return pool.checkedin() == 0 and 0 <= DB_MAX_OVERFLOW <= pool.overflow()
+
+
+def obtener_metricas_pool() -> dict:
     """
-    Tabla principal de suscripciones a notificaciones
+    Estado actual del pool asíncrono (para monitoreo)
+    
+    Returns:
+        Diccionario con tamaño, conexiones en uso, overflow y contadores acumulados
     """
-    __tablename__ = "suscripciones"
+    pool = async_engine.pool
+    estado = {"tipo": type(pool).__name__, **_metricas_pool}
+    estado["segundos_espera"] = round(estado["segundos_espera"], 4)
     
-    # Identificación
-    id = Column(Integer, primary_key=True, index=True)
-    numero_guia = Column(String(50), nullable=False, index=True)
+    if isinstance(pool, QueuePool):
+        estado.update({
+            "tamano": pool.size(),
+            "max_overflow": DB_MAX_OVERFLOW,
+            "en_uso": pool.checkedout(),
+            "disponibles": pool.checkedin(),
+            "overflow": max(0, pool.overflow()),
+        })
     
-    # ✅ ACTUALIZADO: OneSignal Subscription ID (UUID)
-    onesignal_user_id = Column(String(255), nullable=True, index=True)
+    return estado
+
+
+class BaseDatosSaturada(Exception):
+    """El pool no entregó una conexión a tiempo; la API lo responde como 503"""
+
+
+async def _tomar_conexion(session: AsyncSession):
+    """
+    Toma la conexión del pool midiendo la espera
     
-    # Token FCM (opcional, para retrocompatibilidad)
-    token_fcm = Column(String(255), nullable=True)
+    Raises:
+        BaseDatosSaturada: si el pool está saturado
+    """
+    espera = _pool_agotado()
+    inicio = time.perf_counter()
+    try:
+        await session.connection()
+    except PoolTimeoutError:
+        _metricas_pool["timeouts"] += 1
+        raise BaseDatosSaturada("Base de datos saturada, intente nuevamente en unos segundos")
+    finally:
+        if espera:
+            _metricas_pool["esperas"] += 1
+            _metricas_pool["segundos_espera"] += time.perf_counter() - inicio
+
+
+async def get_db() -> AsyncIterator[AsyncSession]:
+    """
+    Dependencia de FastAPI: entrega una sesión asíncrona por request
+    y la cierra al terminar (aunque haya excepciones)
     
-    telefono = Column(String(20), nullable=True)
+    La conexión se toma del pool al inicio para medir esperas y responder
+    503 si el pool está saturado, en vez de fallar a mitad del endpoint
+    """
+    async with AsyncSessionLocal() as session:
+        await _tomar_conexion(session)
+        yield session
+
+
+class SesionPerezosa:
+    """
+    Sesión que se abre (y toma conexión del pool) solo al pedirla
+    
+    Para lecturas con caché: un acierto responde sin ocupar el pool.
+    
+    Example:
+        db = await sesion()
+    """
+    
+    def __init__(self):
+        self._sesion: Optional[AsyncSession] = None
+    
+    async def __call__(self) -> AsyncSession:
+        if self._sesion is None:
+            sesion = AsyncSessionLocal()
+            try:
+                await _tomar_conexion(sesion)
+            except BaseException:
+                await sesion.close()
+                raise
+            self._sesion = sesion
+        return self._sesion
+    
+    async def cerrar(self):
+        if self._sesion is not None:
+            await self._sesion.close()
+            self._sesion = None
+
+
+async def get_db_perezoso() -> AsyncIterator[SesionPerezosa]:
+    """Dependencia de FastAPI: como get_db, pero la conexión se toma solo si el endpoint la usa"""
+    perezosa = SesionPerezosa()
+    try:
+        yield perezosa
+    finally:
+        await perezosa.cerrar()
+
+# ============ TIPOS ============
+
+class FechaUTC(TypeDecorator):
+    """
+    DateTime con zona, siempre normalizado a UTC
+    
+    PostgreSQL lo guarda como TIMESTAMPTZ. SQLite no tiene zonas: se guarda
+    la hora UTC sin zona y se le vuelve a poner UTC al leer, así el resto
+    del código siempre recibe fechas comparables con `reloj.ahora()`.
+    Las fechas sin zona que lleguen se interpretan como UTC.
+    """
+    impl = DateTime(timezone=True)
+    cache_ok = True
+    
+    def process_bind_param(self, valor, dialect):
+        if valor is None:
+            return None
+        valor = valor.replace(tzinfo=timezone.utc) if valor.tzinfo is None else valor.astimezone(timezone.utc)
+        if dialect.name == "sqlite":
+            return valor.replace(tzinfo=None)
+        return valor
+    
+    def process_result_value(self, valor, dialect):
+        if valor is None:
+            return None
+        if valor.tzinfo is None:
+            return valor.replace(tzinfo=timezone.utc)
+        return valor.astimezone(timezone.utc)
+
+
+# ============ MODELOS ============
+
+class Guia(Base):
+    """
+    Estado de rastreo de una guía, compartido por todos sus suscriptores
+    
+    La programación de verificaciones vive aquí: el verificador consulta
+    cada guía una vez aunque la sigan muchos dispositivos.
+    """
+    __tablename__ = "guias"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    numero_guia = Column(String(50), nullable=False, unique=True)
     
     # Información de la guía
     origen = Column(String(100), nullable=True)
@@ -53,41 +293,152 @@ class Suscripcion(Base):
     remitente = Column(String(200), nullable=True)
     destinatario = Column(String(200), nullable=True)
     
-    # Control de verificaciones
-    fecha_creacion = Column(DateTime, default=datetime.now, nullable=False)
-    ultima_verificacion = Column(DateTime, nullable=True)
-    proxima_verificacion = Column(DateTime, nullable=True, index=True)
+    # Control de verificaciones (None = no se verifica: sin validar, rechazada o cerrada)
+    fecha_creacion = Column(FechaUTC, default=ahora, nullable=False)
+    ultima_verificacion = Column(FechaUTC, nullable=True)
+    proxima_verificacion = Column(FechaUTC, nullable=True, index=True)
     verificaciones_realizadas = Column(Integer, default=0)
     
+    fecha_entrega = Column(FechaUTC, nullable=True)  # Cuando llega a RECLAME EN OFICINA
+    # Fecha de DESPACHO NACIONAL BUSES, extraída una sola vez de la trazabilidad
+    fecha_despacho = Column(FechaUTC, nullable=True)
+    
+    # Resumen de la última trazabilidad vista: cantidad de eventos y huella del
+    # último, para saber qué eventos son nuevos sin guardar la lista completa
+    trazabilidad_eventos = Column(Integer, default=0, nullable=False)
+    trazabilidad_huella = Column(String(16), nullable=True)
+    
+    # Relación con historial
+    historial = relationship("HistorialVerificacion", back_populates="guia", cascade="all, delete-orphan")
+    
+    def __repr__(self):
+        return f"<Guia {self.numero_guia} - {self.estado_actual}>"
+
+
+class Suscripcion(Base):
+    """
+    Tabla principal de suscripciones a notificaciones
+    Un dispositivo siguiendo una guía; el estado de rastreo está en Guia
+    """
+    __tablename__ = "suscripciones"
+    
+    # Identificación
+    id = Column(Integer, primary_key=True, index=True)
+    # Se conserva el número (además de guia_id) para el índice único y las búsquedas por guía
+    numero_guia = Column(String(50), nullable=False, index=True)
+    # Nullable solo porque se agregó con ALTER TABLE; toda fila migrada o nueva lo tiene
+    guia_id = Column(Integer, ForeignKey("guias.id"), nullable=True, index=True)
+    
+    # ✅ ACTUALIZADO: OneSignal Subscription ID (UUID)
+    onesignal_user_id = Column(String(255), nullable=True, index=True)
+    
+    # Token FCM (opcional, para retrocompatibilidad)
+    token_fcm = Column(String(255), nullable=True)
+    
+    telefono = Column(String(20), nullable=True)
+    
     # Estado de la suscripción
+    fecha_creacion = Column(FechaUTC, default=ahora, nullable=False)
     activo = Column(Boolean, default=True, index=True)
-    fecha_entrega = Column(DateTime, nullable=True)  # Cuando llega a RECLAME EN OFICINA
+    fecha_entrega = Column(FechaUTC, nullable=True)  # Cuando se le notificó la llegada
     
-    # Relación con historial
-    historial = relationship("HistorialVerificacion", back_populates="suscripcion", cascade="all, delete-orphan")
+    # Muchos a uno: se carga con JOIN en la misma consulta (AsyncSession no permite carga perezosa)
+    guia = relationship("Guia", lazy="joined")
     
     def __repr__(self):
-        return f"<Suscripcion {self.numero_guia} - {self.estado_actual}>"
+        return f"<Suscripcion {self.numero_guia} - {self.onesignal_user_id}>"
+
+
+# Una sola suscripción activa por (guía, usuario): los dobles toques de la app
+# chocan contra el índice en lugar de crear filas que se verifican dos veces.
+# Parcial: las inactivas (entregadas, canceladas) no cuentan.
+INDICE_SUSCRIPCIONES_ACTIVAS = Index(
+    "uq_suscripciones_activas_guia_usuario",
+    Suscripcion.numero_guia,
+    Suscripcion.onesignal_user_id,
+    unique=True,
+    postgresql_where=Suscripcion.activo == True,
+    sqlite_where=Suscripcion.activo == True,
+)
+
+
+def _insert_ignorando_conflictos(modelo, columnas: list, condicion=None):
+    """
+    INSERT ... ON CONFLICT DO NOTHING sobre un índice único (PostgreSQL y SQLite)
+    En otros motores es un INSERT normal.
+    """
+    dialecto = async_engine.dialect.name
+    if dialecto == "postgresql":
+        sentencia = insert_postgres(modelo)
+    elif dialecto == "sqlite":
+        sentencia = insert_sqlite(modelo)
+    else:
+        return insert(modelo)
+    return sentencia.on_conflict_do_nothing(index_elements=columnas, index_where=condicion)
+
+
+def insert_suscripcion_activa():
+    """
+    INSERT ... ON CONFLICT DO NOTHING contra el índice de suscripciones activas
+    
+    Si ya hay una suscripción activa para la misma guía y usuario no inserta
+    nada (RETURNING no devuelve fila).
+    """
+    return _insert_ignorando_conflictos(
+        Suscripcion,
+        [Suscripcion.numero_guia, Suscripcion.onesignal_user_id],
+        Suscripcion.activo == True
+    )
+
+
+async def obtener_o_crear_guias(db: AsyncSession, numeros: Iterable[str]) -> Dict[str, Guia]:
+    """
+    Guías por número, creando las que falten (sin commit)
+    
+    Un INSERT ... ON CONFLICT DO NOTHING para todas y un SELECT: seguro ante
+    suscripciones simultáneas a la misma guía.
+    
+    Example:
+        guia = (await obtener_o_crear_guias(db, ["E121101188"]))["E121101188"]
+    """
+    numeros = set(numeros)
+    if not numeros:
+        return {}
+    await db.execute(
+        _insert_ignorando_conflictos(Guia, [Guia.numero_guia]),
+        [{"numero_guia": numero} for numero in numeros]
+    )
+    resultado = await db.scalars(select(Guia).where(Guia.numero_guia.in_(numeros)))
+    return {guia.numero_guia: guia for guia in resultado}
+
+
+def con_suscriptores_activos():
+    """Condición EXISTS: la guía tiene al menos una suscripción activa"""
+    return (
+        select(Suscripcion.id)
+        .where(Suscripcion.guia_id == Guia.id, Suscripcion.activo == True)
+        .exists()
+    )
 
 
 class HistorialVerificacion(Base):
     """
-    Registro de cada verificación realizada
+    Registro de cada cambio de estado encontrado en una guía
     Útil para análisis y debugging
     """
-    __tablename__ = "historial_verificaciones"
+    __tablename__ = "historial_guias"
     
     id = Column(Integer, primary_key=True, index=True)
-    suscripcion_id = Column(Integer, ForeignKey("suscripciones.id"), nullable=False, index=True)
+    guia_id = Column(Integer, ForeignKey("guias.id"), nullable=False, index=True)
     
-    fecha_verificacion = Column(DateTime, default=datetime.now, nullable=False)
+    fecha_verificacion = Column(FechaUTC, default=ahora, nullable=False)
     estado_encontrado = Column(String(100), nullable=True)
     
     # Relación
-    suscripcion = relationship("Suscripcion", back_populates="historial")
+    guia = relationship("Guia", back_populates="historial")
     
     def __repr__(self):
-        return f"<Verificacion {self.suscripcion_id} - {self.estado_encontrado}>"
+        return f"<Verificacion {self.guia_id} - {self.estado_encontrado}>"
 
 
 class ConfiguracionCiudad(Base):
@@ -106,6 +457,146 @@ class ConfiguracionCiudad(Base):
         return f"<ConfigCiudad {self.origen} -> {self.destino}: {self.horas_viaje}h>"
 
 
+class ContadorEstadistica(Base):
+    """
+    Contadores materializados para /api/stats (lectura O(1))
+    Se actualizan en la misma transacción que cada escritura
+    """
+    __tablename__ = "contadores_estadisticas"
+    
+    nombre = Column(String(50), primary_key=True)
+    valor = Column(BigInteger, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f"<Contador {self.nombre}: {self.valor}>"
+
+
+class ClaveIdempotencia(Base):
+    """
+    Respuestas guardadas por header Idempotency-Key en POST /api/suscribir
+    Un reintento con la misma clave recibe la misma respuesta sin repetir el trabajo
+    """
+    __tablename__ = "claves_idempotencia"
+    
+    clave = Column(String(255), primary_key=True)
+    huella_peticion = Column(String(64), nullable=False)  # SHA-256 del cuerpo
+    status_code = Column(Integer, nullable=False)
+    respuesta = Column(Text, nullable=False)
+    fecha_creacion = Column(FechaUTC, default=ahora, nullable=False, index=True)
+    
+    def __repr__(self):
+        return f"<ClaveIdempotencia {self.clave} - {self.status_code}>"
+
+
+class Dispositivo(Base):
+    """
+    Registro local de dispositivos ya dados de alta en OneSignal
+    
+    La app llama a /api/registrar-dispositivo en cada arranque; si el mismo
+    token FCM se registró hace menos de DISPOSITIVO_REGISTRO_HORAS se responde
+    el player ID guardado sin llamar a OneSignal. El token se guarda como
+    huella SHA-256, no en claro.
+    """
+    __tablename__ = "dispositivos"
+    
+    huella_token = Column(String(64), primary_key=True)
+    onesignal_user_id = Column(String(255), nullable=False)
+    device_type = Column(Integer, nullable=False)
+    language = Column(String(10), nullable=False)
+    timezone = Column(Integer, nullable=False)
+    fecha_registro = Column(FechaUTC, default=ahora, nullable=False, index=True)
+    
+    def __repr__(self):
+        return f"<Dispositivo {self.huella_token[:12]} - {self.onesignal_user_id}>"
+
+
+def upsert_dispositivos():
+    """
+    INSERT ... ON CONFLICT (huella_token) DO UPDATE: crea o refresca registros
+    de dispositivos (PostgreSQL y SQLite). En otros motores es un INSERT normal.
+    
+    Example:
+        await db.execute(upsert_dispositivos(), [{"huella_token": ..., ...}])
+    """
+    dialecto = async_engine.dialect.name
+    if dialecto == "postgresql":
+        sentencia = insert_postgres(Dispositivo)
+    elif dialecto == "sqlite":
+        sentencia = insert_sqlite(Dispositivo)
+    else:
+        return insert(Dispositivo)
+    columnas = ("onesignal_user_id", "device_type", "language", "timezone", "fecha_registro")
+    return sentencia.on_conflict_do_update(
+        index_elements=[Dispositivo.huella_token],
+        set_={columna: sentencia.excluded[columna] for columna in columnas}
+    )
+
+
+# Contadores mantenidos incrementalmente (verificaciones_pendientes depende
+# de la hora actual y siempre se calcula con el índice de proxima_verificacion)
+CONTADORES = ("total_suscripciones", "activas", "completadas")
+
+
+# ============ ESTADÍSTICAS ============
+
+def consulta_guias_pendientes(ahora: datetime):
+    """
+    Guías vencidas con al menos una suscripción activa: cantidad y la
+    proxima_verificacion más antigua (backlog del verificador)
+    """
+    return select(func.count(), func.min(Guia.proxima_verificacion)).where(
+        Guia.proxima_verificacion <= ahora,
+        con_suscriptores_activos()
+    )
+
+
+def consulta_estadisticas(ahora: datetime):
+    """
+    Todas las estadísticas en una sola pasada: COUNT(*) FILTER (WHERE ...)
+    Las verificaciones pendientes se cuentan por guía (subconsulta escalar)
+    """
+    return select(
+        func.count().label("total_suscripciones"),
+        func.count().filter(Suscripcion.activo == True).label("activas"),
+        func.count().filter(Suscripcion.fecha_entrega != None).label("completadas"),
+        consulta_guias_pendientes(ahora).with_only_columns(func.count())
+        .scalar_subquery().label("verificaciones_pendientes"),
+    ).select_from(Suscripcion)
+
+
+async def ajustar_contadores(db: AsyncSession, **deltas: int):
+    """
+    Suma los deltas a los contadores materializados (sin hacer commit)
+    
+    Example:
+        await ajustar_contadores(db, total_suscripciones=1, activas=1)
+    """
+    for nombre, delta in deltas.items():
+        if delta:
+            await db.execute(
+                update(ContadorEstadistica)
+                .where(ContadorEstadistica.nombre == nombre)
+                .values(valor=ContadorEstadistica.valor + delta)
+            )
+
+
+async def leer_contadores(db: AsyncSession) -> dict:
+    """Lee los contadores materializados"""
+    resultado = await db.execute(select(ContadorEstadistica.nombre, ContadorEstadistica.valor))
+    return {fila.nombre: fila.valor for fila in resultado}
+
+
+async def recalcular_contadores(db: AsyncSession) -> dict:
+    """Recalcula los contadores desde la tabla de suscripciones (corrige desviaciones)"""
+    fila = (await db.execute(consulta_estadisticas(ahora()))).one()
+    valores = {nombre: getattr(fila, nombre) for nombre in CONTADORES}
+    
+    await db.execute(delete(ContadorEstadistica))
+    db.add_all([ContadorEstadistica(nombre=n, valor=v) for n, v in valores.items()])
+    await db.commit()
+    return valores
+
+
 # ============ FUNCIONES DE INICIALIZACIÓN ============
 
 def init_db():
@@ -124,9 +615,27 @@ def init_db():
         # ✅ MIGRACIÓN: Agregar columna onesignal_user_id si no existe
         _migrar_onesignal_user_id()
         
+        # ✅ MIGRACIÓN: Fechas sin zona -> TIMESTAMPTZ (UTC)
+        _migrar_fechas_utc()
+        
+        # ✅ MIGRACIÓN: Columnas nuevas de suscripciones
+        _migrar_columnas_suscripciones()
+        
+        # ✅ MIGRACIÓN: Estado de rastreo por suscripción -> tabla guias
+        _migrar_guias()
+        
+        # ✅ MIGRACIÓN: Índice único de suscripciones activas
+        _migrar_indice_suscripciones_activas()
+        
         # Opcional: Insertar datos iniciales de ciudades
         _insertar_datos_ciudades()
         
+        # Contadores materializados consistentes con la tabla al arrancar
+        _inicializar_contadores()
+        
+        # El motor síncrono solo se usa al arrancar: liberar sus conexiones
+        engine.dispose()
+        
     except Exception as e:
         logger.error(f"❌ Error creando tablas: {e}")
         raise
@@ -184,6 +693,266 @@ def _migrar_onesignal_user_id():
         # No lanzar excepción para no romper el inicio de la app
 
 
+# Columnas agregadas después de la creación original: (nombre, tipo PostgreSQL, tipo SQLite)
+COLUMNAS_NUEVAS_SUSCRIPCIONES = (
+    ("guia_id", "INTEGER REFERENCES guias(id)", "INTEGER REFERENCES guias(id)"),
+)
+
+
+def _migrar_columnas_suscripciones():
+    """
+    Migración: agrega a suscripciones las columnas nuevas que falten
+    Las filas existentes las completan en su próxima verificación
+    """
+    import logging
+    logger = logging.getLogger(__name__)
+    
+    try:
+        existentes = {c["name"] for c in inspect(engine).get_columns("suscripciones")}
+        es_postgres = engine.dialect.name == "postgresql"
+        
+        # Columnas en su propia transacción: un fallo al crear índices (DDL
+        # transaccional en PostgreSQL) no debe deshacer los ADD COLUMN
+        with engine.connect() as conn:
+            for nombre, tipo_postgres, tipo_sqlite in COLUMNAS_NUEVAS_SUSCRIPCIONES:
+                if nombre in existentes:
+                    continue
+                logger.info(f"📝 Agregando columna {nombre}...")
+                tipo = tipo_postgres if es_postgres else tipo_sqlite
+                conn.execute(text(f"ALTER TABLE suscripciones ADD COLUMN {nombre} {tipo}"))
+            conn.commit()
+        
+        # create_all no crea índices en tablas que ya existían. El único de
+        # activas lo crea _migrar_indice_suscripciones_activas, después de
+        # desactivar los duplicados
+        with engine.connect() as conn:
+            for indice in Suscripcion.__table__.indexes:
+                if indice is not INDICE_SUSCRIPCIONES_ACTIVAS:
+                    indice.create(conn, checkfirst=True)
+            conn.commit()
+    
+    except Exception as e:
+        logger.warning(f"⚠️ Error en migración de columnas de suscripciones: {e}")
+
+
+def _migrar_indice_suscripciones_activas():
+    """
+    Migración: crea el índice único parcial de suscripciones activas
+    
+    Antes deja activa solo la suscripción más antigua de cada (guía, usuario)
+    duplicada; las demás se desactivan. Las de usuario NULL (era FCM) no se
+    tocan: en el índice los NULL no chocan entre sí.
+    """
+    import logging
+    logger = logging.getLogger(__name__)
+    
+    try:
+        if INDICE_SUSCRIPCIONES_ACTIVAS.name in {i["name"] for i in inspect(engine).get_indexes("suscripciones")}:
+            return
+        
+        with engine.connect() as conn:
+            resultado = conn.execute(
+                update(Suscripcion)
+                .where(
+                    Suscripcion.activo == True,
+                    Suscripcion.onesignal_user_id != None,
+                    Suscripcion.id.not_in(
+                        select(func.min(Suscripcion.id))
+                        .where(Suscripcion.activo == True, Suscripcion.onesignal_user_id != None)
+                        .group_by(Suscripcion.numero_guia, Suscripcion.onesignal_user_id)
+                    )
+                )
+                .values(activo=False)
+            )
+            if resultado.rowcount:
+                logger.info(f"🧹 {resultado.rowcount} suscripciones activas duplicadas desactivadas")
+            
+            INDICE_SUSCRIPCIONES_ACTIVAS.create(conn)
+            conn.commit()
+            logger.info("✅ Índice único de suscripciones activas creado")
+    
+    except Exception as e:
+        logger.warning(f"⚠️ Error en migración del índice de suscripciones activas: {e}")
+
+
+# Columnas de rastreo que vivían en cada suscripción y pasaron a la tabla guias
+COLUMNAS_LEGADO_GUIA = (
+    "origen", "destino", "estado_actual", "fecha_admision", "remitente", "destinatario",
+    "ultima_verificacion", "proxima_verificacion", "verificaciones_realizadas",
+    "fecha_despacho", "trazabilidad_eventos", "trazabilidad_huella",
+)
+
+
+def _migrar_guias():
+    """
+    Migración: normaliza el estado de rastreo en la tabla guias
+    
+    1. Crea una guía por numero_guia con los datos de su suscripción más
+       reciente (las activas primero); proxima_verificacion es la más
+       temprana entre las activas.
+    2. Enlaza cada suscripción con su guía (guia_id).
+    3. Pasa historial_verificaciones (por suscripción) a historial_guias.
+    4. Elimina de suscripciones las columnas que ahora viven en guias.
+    
+    Idempotente: no hace nada si suscripciones ya no tiene estado_actual.
+    Todo en una transacción.
+    """
+    import logging
+    logger = logging.getLogger(__name__)
+    
+    try:
+        inspector = inspect(engine)
+        columnas = {c["name"] for c in inspector.get_columns("suscripciones")}
+        if "estado_actual" not in columnas:
+            return
+        
+        logger.info("🔄 Migrando estado de rastreo de suscripciones a guias...")
+        legado = Table("suscripciones", MetaData(), autoload_with=engine)
+        presentes = [c for c in COLUMNAS_LEGADO_GUIA if c in columnas]
+        
+        with engine.begin() as conn:
+            filas = conn.execute(select(legado).order_by(legado.c.id)).mappings().all()
+            por_guia = {}
+            for fila in filas:
+                por_guia.setdefault(fila["numero_guia"], []).append(fila)
+            
+            guias = {}
+            for numero, grupo in por_guia.items():
+                # Datos de la suscripción más reciente, prefiriendo las activas
+                representativa = max(grupo, key=lambda f: (bool(f["activo"]), f["id"]))
+                guia = {c: representativa[c] for c in presentes}
+                guia["numero_guia"] = numero
+                guia["fecha_creacion"] = min(f["fecha_creacion"] for f in grupo)
+                guia["proxima_verificacion"] = min(
+                    (f["proxima_verificacion"] for f in grupo if f["activo"] and f["proxima_verificacion"]),
+                    default=None
+                )
+                guia["fecha_entrega"] = representativa["fecha_entrega"]
+                guia["trazabilidad_eventos"] = guia.get("trazabilidad_eventos") or 0
+                guias[numero] = guia
+            
+            existentes = set(conn.scalars(select(Guia.numero_guia)).all())
+            nuevas = [g for numero, g in guias.items() if numero not in existentes]
+            for inicio in range(0, len(nuevas), 1000):
+                conn.execute(insert(Guia), nuevas[inicio:inicio + 1000])
+            
+            conn.execute(
+                update(legado).values(
+                    guia_id=select(Guia.id).where(Guia.numero_guia == legado.c.numero_guia).scalar_subquery()
+                )
+            )
+            
+            historial_movido = 0
+            if inspector.has_table("historial_verificaciones"):
+                historial_movido = conn.execute(text("""
+                    INSERT INTO historial_guias (guia_id, fecha_verificacion, estado_encontrado)
+                    SELECT s.guia_id, h.fecha_verificacion, h.estado_encontrado
+                    FROM historial_verificaciones h
+                    JOIN suscripciones s ON s.id = h.suscripcion_id
+                    ORDER BY h.id
+                """)).rowcount
+                conn.execute(text("DROP TABLE historial_verificaciones"))
+            
+            # SQLite no elimina columnas indexadas: primero sus índices
+            for indice in inspector.get_indexes("suscripciones"):
+                if set(indice["column_names"]) & set(presentes):
+                    conn.execute(text(f"DROP INDEX {indice['name']}"))
+            for columna in presentes:
+                conn.execute(text(f"ALTER TABLE suscripciones DROP COLUMN {columna}"))
+        
+        logger.info(
+            f"✅ Migración a guias completada: {len(nuevas)} guías para {len(filas)} suscripciones, "
+            f"{historial_movido} registros de historial"
+        )
+    
+    except Exception as e:
+        logger.error(f"❌ Error en migración a guias: {e}")
+        raise
+
+
+# Columnas de fecha que pasaron de TIMESTAMP a TIMESTAMPTZ
+COLUMNAS_FECHA = (
+    ("suscripciones", "fecha_creacion"),
+    ("suscripciones", "ultima_verificacion"),
+    ("suscripciones", "proxima_verificacion"),
+    ("suscripciones", "fecha_entrega"),
+    ("historial_verificaciones", "fecha_verificacion"),
+)
+
+
+def _migrar_fechas_utc():
+    """
+    Migración: convierte las columnas de fecha sin zona a TIMESTAMPTZ
+    
+    Los valores existentes se interpretan en DB_ZONA_FECHAS_LEGADO (UTC por
+    defecto). Idempotente: solo toca columnas que siguen sin zona.
+    Solo aplica en PostgreSQL (SQLite no tiene tipos con zona).
+    """
+    import logging
+    logger = logging.getLogger(__name__)
+    
+    if engine.dialect.name != "postgresql":
+        return
+    
+    try:
+        logger.info("🔄 Verificando migración de fechas a TIMESTAMPTZ...")
+        
+        with engine.connect() as conn:
+            migradas = 0
+            for tabla, columna in COLUMNAS_FECHA:
+                tipo = conn.execute(text("""
+                    SELECT data_type
+                    FROM information_schema.columns
+                    WHERE table_name = :tabla AND column_name = :columna
+                """), {"tabla": tabla, "columna": columna}).scalar()
+                
+                if tipo != "timestamp without time zone":
+                    continue
+                
+                logger.info(f"📝 {tabla}.{columna}: TIMESTAMP -> TIMESTAMPTZ ({DB_ZONA_FECHAS_LEGADO})")
+                conn.execute(
+                    text(f"""
+                        ALTER TABLE {tabla}
+                        ALTER COLUMN {columna} TYPE TIMESTAMPTZ
+                        USING {columna} AT TIME ZONE :zona
+                    """).bindparams(zona=DB_ZONA_FECHAS_LEGADO)
+                )
+                migradas += 1
+            
+            conn.commit()
+            if migradas:
+                logger.info(f"✅ Migración completada: {migradas} columnas de fecha con zona horaria")
+            else:
+                logger.info("✅ Columnas de fecha ya tienen zona horaria")
+        
+    except Exception as e:
+        logger.warning(f"⚠️ Error en migración de fechas: {e}")
+
+
+def _inicializar_contadores():
+    """
+    Recalcula los contadores de estadísticas al iniciar la aplicación
+    """
+    import logging
+    logger = logging.getLogger(__name__)
+    
+    db = SessionLocal()
+    
+    try:
+        fila = db.execute(consulta_estadisticas(ahora())).one()
+        db.query(ContadorEstadistica).delete()
+        for nombre in CONTADORES:
+            db.add(ContadorEstadistica(nombre=nombre, valor=getattr(fila, nombre)))
+        db.commit()
+        logger.info("✅ Contadores de estadísticas inicializados")
+        
+    except Exception as e:
+        logger.error(f"❌ Error inicializando contadores: {e}")
+        db.rollback()
+    finally:
+        db.close()
+
+
 def _insertar_datos_ciudades():
     """
     Inserta configuración inicial de tiempos entre ciudades
@@ -0,0 +1,74 @@
+"""
+Emisor de prueba para el webhook de rastreo (/api/webhooks/rastreo)
+Firma los eventos igual que el backend de rastreo
+
+Ejecutar:
+    WEBHOOK_RASTREO_SECRETO=secreto python enviar_webhook_prueba.py --guia E121101188 --estado "RECLAME EN OFICINA BARRANQUILLA"
+    WEBHOOK_RASTREO_SECRETO=secreto python enviar_webhook_prueba.py --guia E1 --guia E2 --estado "DESPACHO NACIONAL BUSES"
+    python enviar_webhook_prueba.py --guia E1 --firma-invalida
+"""
+
+import argparse
+import json
+import os
+import time
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import requests
+
+from utils import firmar_webhook
+
+API_URL = "http://localhost:8000"
+
+
+def construir_evento(numero_guia: str, estado: str) -> dict:
+    # La API de rastreo publica fechas en hora local de Colombia
+    fecha = datetime.now(ZoneInfo("America/Bogota")).strftime("%Y/%m/%d %H:%M")
+    return {
+        "numero_guia": numero_guia,
+        "estado_actual": estado,
+        "trazabilidad": [{"detalle": estado, "fecha": fecha}],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Envía eventos firmados al webhook de rastreo")
+    parser.add_argument("--url", default=API_URL)
+    parser.add_argument("--secreto", default=os.environ.get("WEBHOOK_RASTREO_SECRETO", ""))
+    parser.add_argument("--guia", action="append", required=True, help="Repetir para enviar un lote")
+    parser.add_argument("--estado", default="DESPACHO NACIONAL BUSES")
+    parser.add_argument("--firma-invalida", action="store_true", help="Envía una firma incorrecta (espera 401)")
+    args = parser.parse_args()
+    
+    eventos = [construir_evento(guia, args.estado) for guia in args.guia]
+    payload = eventos[0] if len(eventos) == 1 else {"eventos": eventos}
+    cuerpo = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    
+    timestamp = str(int(time.time()))
+    firma = firmar_webhook(args.secreto or "sin-secreto", timestamp, cuerpo)
+    if args.firma_invalida:
+        firma = "sha256=" + "0" * 64
+    
+    print(f"📨 Enviando {len(eventos)} evento(s) a {args.url}/api/webhooks/rastreo")
+    response = requests.post(
+        f"{args.url}/api/webhooks/rastreo",
+        data=cuerpo,
+        headers={
+            "Content-Type": "application/json",
+            "X-Rastreo-Timestamp": timestamp,
+            "X-Rastreo-Firma": firma,
+        },
+        timeout=15
+    )
+    
+    emoji = "✅" if response.status_code == 200 else "❌"
+    print(f"{emoji} Status {response.status_code}")
+    try:
+        print(json.dumps(response.json(), indent=2, ensure_ascii=False))
+    except ValueError:
+        print(response.text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+"""
+Controlador de envíos push
+
+Cuando muchas guías llegan en una misma verificación, disparar todos los
+push a la vez choca con la cuota del proveedor, y un 429 se perdía como
+cualquier otro fallo. Los push se encolan aquí (después del commit, desde
+BackgroundTasks) y unos pocos workers los envían en lotes al proveedor
+configurado (proveedores_push.py):
+
+- Cuota de PUSH_TASA_POR_SEGUNDO peticiones por segundo (cubeta de fichas) por instancia
+- Carriles de prioridad: las llegadas salen antes que los hitos informativos
+- Cada worker junta hasta PUSH_TAMANO_LOTE push ya encolados en un solo envío
+- Un 429 pausa todos los envíos lo que indique Retry-After y los push
+  limitados vuelven a la cola (hasta PUSH_MAX_REINTENTOS veces)
+- Con la cola llena se descartan los informativos; las llegadas siempre se aceptan
+"""
+
+import asyncio
+import itertools
+import logging
+import time
+from typing import List, Optional
+
+from config import (
+    PUSH_TASA_POR_SEGUNDO, PUSH_CONCURRENCIA, PUSH_COLA_MAX, PUSH_MAX_REINTENTOS, PUSH_ESPERA_429_SEGUNDOS,
+    PUSH_TAMANO_LOTE
+)
+from metricas import COLA_PUSH, PUSH_ENVIOS, PUSH_DESCARTADOS, PUSH_LIMITADOS
+from proveedores_push import CuotaProveedorExcedida, MensajePush, ProveedorPush, crear_proveedor
+
+logger = logging.getLogger(__name__)
+
+# Carril -> prioridad (menor sale primero)
+CARRILES = {"llegada": 0, "informativa": 1}
+
+
+class EnvioPush:
+    """Un push pendiente con sus reintentos"""
+    
+    __slots__ = ("carril", "mensaje", "intentos")
+    
+    def __init__(self, carril: str, mensaje: MensajePush):
+        self.carril = carril
+        self.mensaje = mensaje
+        self.intentos = 0
+
+
+class ControladorEnvios:
+    """
+    Cola con prioridad + cubeta de fichas + pausa global ante 429
+    
+    Los workers arrancan con el primer push encolado (dentro del event loop).
+    Cada lote consume tantas fichas como peticiones le cueste al proveedor.
+    """
+    
+    def __init__(
+        self,
+        proveedor: ProveedorPush,
+        tasa_por_segundo: float,
+        concurrencia: int,
+        max_cola: int,
+        max_reintentos: int,
+        tamano_lote: int = 1
+    ):
+        self.proveedor = proveedor
+        self.tasa_por_segundo = tasa_por_segundo
+        self.concurrencia = concurrencia
+        self.max_cola = max_cola
+        self.max_reintentos = max_reintentos
+        self.tamano_lote = max(tamano_lote, 1)
+        self._cola: Optional[asyncio.PriorityQueue] = None
+        self._workers: list = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._secuencia = itertools.count()
+        self._profundidad = {carril: 0 for carril in CARRILES}
+        self._fichas = float(max(tasa_por_segundo, 1))
+        self._ultima_recarga = time.monotonic()
+        self._pausa_hasta = 0.0
+        self.enviados = 0
+        self.fallidos = 0
+    
+    def _arrancar(self):
+        loop = asyncio.get_running_loop()
+        if self._workers and self._loop is loop:
+            return
+        self._loop = loop
+        self._cola = asyncio.PriorityQueue()
+        self._profundidad = {carril: 0 for carril in CARRILES}
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrencia)]
+    
+    async def encolar(self, carril: str, mensaje: MensajePush) -> bool:
+        """
+        Agrega un push a su carril (se usa como tarea de BackgroundTasks)
+        
+        Returns:
+            False si se descartó por cola llena
+        """
+        self._arrancar()
+        if carril != "llegada" and self._cola.qsize() >= self.max_cola:
+            PUSH_DESCARTADOS.labels(carril, "cola_llena").inc()
+            logger.warning("⚠️ Cola de push llena (%s), se descarta un push %s", self._cola.qsize(), carril)
+            return False
+        self._poner(EnvioPush(carril, mensaje))
+        return True
+    
+    def _poner(self, envio: EnvioPush):
+        self._cola.put_nowait((CARRILES[envio.carril], next(self._secuencia), envio))
+        self._profundidad[envio.carril] += 1
+        COLA_PUSH.labels(envio.carril).set(self._profundidad[envio.carril])
+    
+    @property
+    def _capacidad(self) -> float:
+        return max(self.tasa_por_segundo, 1)
+    
+    async def _esperar_turno(self, fichas: int = 1):
+        """
+        Espera la pausa por 429 (si hay) y las fichas de la cuota por segundo
+        
+        _tomar_lote nunca arma un lote que cueste más que la capacidad de la cubeta.
+        """
+        capacidad = self._capacidad
+        necesarias = min(fichas, capacidad)
+        while True:
+            ahora = time.monotonic()
+            if self._pausa_hasta > ahora:
+                await asyncio.sleep(self._pausa_hasta - ahora)
+                continue
+            
+            self._fichas = min(capacidad, self._fichas + (ahora - self._ultima_recarga) * self.tasa_por_segundo)
+            self._ultima_recarga = ahora
+            if self._fichas >= necesarias:
+                self._fichas -= fichas
+                return
+            await asyncio.sleep((necesarias - self._fichas) / self.tasa_por_segundo)
+    
+    def _tomar_lote(self, primero: EnvioPush) -> List[EnvioPush]:
+        """
+        Junta al primero los push que ya esperan en la cola, por orden de prioridad
+        
+        El lote se corta antes de necesitar más peticiones que fichas caben en
+        la cubeta: con FCM (una petición por push) un lote de 100 no sale de
+        golpe si la cuota es de 20 por segundo.
+        """
+        lote = [primero]
+        claves = {self.proveedor.clave_peticion(primero.mensaje)}
+        maximo = min(self.tamano_lote, self.proveedor.max_lote)
+        while len(lote) < maximo and not self._cola.empty():
+            entrada = self._cola.get_nowait()
+            clave = self.proveedor.clave_peticion(entrada[2].mensaje)
+            if clave not in claves and len(claves) >= self._capacidad:
+                # Vuelve con su misma prioridad y secuencia (sin contar como tarea nueva)
+                self._cola.put_nowait(entrada)
+                self._cola.task_done()
+                break
+            claves.add(clave)
+            lote.append(entrada[2])
+        return lote
+    
+    async def _worker(self):
+        while True:
+            _, _, envio = await self._cola.get()
+            lote = self._tomar_lote(envio)
+            try:
+                await self._esperar_turno(self.proveedor.solicitudes([e.mensaje for e in lote]))
+                for envio in lote:
+                    self._profundidad[envio.carril] -= 1
+                    COLA_PUSH.labels(envio.carril).set(self._profundidad[envio.carril])
+                await self._enviar(lote)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("❌ Error en el worker de push: %s", e)
+            finally:
+                for _ in lote:
+                    self._cola.task_done()
+    
+    async def _enviar(self, lote: List[EnvioPush]):
+        try:
+            resultados = await self.proveedor.enviar_lote([envio.mensaje for envio in lote])
+        except Exception as e:
+            logger.error("❌ Error del proveedor de push %s: %s", self.proveedor.nombre, e)
+            resultados = [False] * len(lote)
+        
+        limitados = []
+        espera = 0.0
+        for envio, resultado in zip(lote, resultados):
+            if isinstance(resultado, CuotaProveedorExcedida):
+                espera = max(espera, resultado.reintentar_en or PUSH_ESPERA_429_SEGUNDOS)
+                limitados.append(envio)
+            elif resultado is True:
+                self.enviados += 1
+                PUSH_ENVIOS.labels(envio.carril, "enviado").inc()
+            else:
+                self.fallidos += 1
+                PUSH_ENVIOS.labels(envio.carril, "fallido").inc()
+        
+        if not limitados:
+            return
+        self._pausa_hasta = max(self._pausa_hasta, time.monotonic() + espera)
+        PUSH_LIMITADOS.inc()
+        logger.warning(
+            "🚦 %s 429: envíos en pausa %.1fs (%s push de vuelta a la cola)",
+            self.proveedor.nombre, espera, len(limitados)
+        )
+        for envio in limitados:
+            envio.intentos += 1
+            if envio.intentos > self.max_reintentos:
+                PUSH_DESCARTADOS.labels(envio.carril, "reintentos_agotados").inc()
+                logger.error("❌ Push %s descartado tras %s respuestas 429", envio.carril, envio.intentos)
+                continue
+            self._poner(envio)
+    
+    async def vaciar(self, espera_maxima: float = 10) -> bool:
+        """
+        Espera a que la cola quede vacía sin detener los workers
+        
+        Returns:
+            False si se cumplió espera_maxima con push pendientes
+        """
+        if not self._workers:
+            return True
+        try:
+            await asyncio.wait_for(self._cola.join(), timeout=espera_maxima)
+            return True
+        except asyncio.TimeoutError:
+            return False
+    
+    async def detener(self, espera_maxima: float = 10):
+        """Intenta vaciar la cola (al apagar) y cancela los workers"""
+        if not self._workers:
+            return
+        if not await self.vaciar(espera_maxima):
+            logger.warning("⚠️ Se apagó con %s push sin enviar", self._cola.qsize())
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._cola = None
+        self._profundidad = {carril: 0 for carril in CARRILES}
+    
+    def estadisticas(self) -> dict:
+        pausa = self._pausa_hasta - time.monotonic()
+        return {
+            "activo": bool(self._workers),
+            "proveedor": self.proveedor.nombre,
+            "en_cola": dict(self._profundidad),
+            "pausa_429_segundos": round(pausa, 2) if pausa > 0 else 0,
+            "tasa_por_segundo": self.tasa_por_segundo,
+            "concurrencia": self.concurrencia,
+            "tamano_lote": min(self.tamano_lote, self.proveedor.max_lote),
+            "enviados": self.enviados,
+            "fallidos": self.fallidos,
+        }
+
+
+controlador_envios = ControladorEnvios(
+    crear_proveedor(),
+    tasa_por_segundo=PUSH_TASA_POR_SEGUNDO,
+    concurrencia=PUSH_CONCURRENCIA,
+    max_cola=PUSH_COLA_MAX,
+    max_reintentos=PUSH_MAX_REINTENTOS,
+    tamano_lote=PUSH_TAMANO_LOTE
+)
@@ -0,0 +1,145 @@
+"""
+Configuración de logging del servicio
+
+Variables de entorno:
+    LOG_LEVEL           Nivel global (por defecto INFO)
+    LOG_LEVELS          Niveles por módulo: "utils=WARNING,main=INFO,sqlalchemy.engine=WARNING"
+    LOG_FORMAT          "texto" (por defecto) o "json" (una línea JSON por evento)
+    LOG_MUESTREO_DEBUG  Fracción (0-1) de guías cuyas líneas DEBUG se emiten (por defecto 1)
+    LOG_ASINCRONO       "true" (por defecto): el I/O de logs ocurre en un hilo aparte
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import zlib
+from datetime import datetime, timezone
+from typing import Optional
+
+# Atributos estándar de LogRecord (todo lo demás viene de extra={...})
+_ATRIBUTOS_RECORD = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class FormateadorJSON(logging.Formatter):
+    """Una línea JSON por evento, incluyendo los campos pasados en extra"""
+    
+    def format(self, record: logging.LogRecord) -> str:
+        evento = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            "nivel": record.levelname,
+            "logger": record.name,
+            "mensaje": record.getMessage(),
+        }
+        
+        for clave, valor in record.__dict__.items():
+            if clave not in _ATRIBUTOS_RECORD and not clave.startswith("_"):
+                evento[clave] = valor
+        
+        if record.exc_info:
+            evento["excepcion"] = self.formatException(record.exc_info)
+        
+        return json.dumps(evento, ensure_ascii=False, default=str)
+
+
+class FiltroMuestreoDebug(logging.Filter):
+    """
+    Deja pasar solo una fracción de las líneas DEBUG
+    
+    Si el registro trae numero_guia (extra={"numero_guia": ...}) la decisión
+    es determinística por guía: una guía muestreada conserva todas sus líneas.
+    """
+    
+    def __init__(self, fraccion: float):
+        super().__init__()
+        self.umbral = int(max(0.0, min(1.0, fraccion)) * 10000)
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno != logging.DEBUG or self.umbral >= 10000:
+            return True
+        
+        numero_guia = getattr(record, "numero_guia", None)
+        if numero_guia:
+            return zlib.crc32(str(numero_guia).encode()) % 10000 < self.umbral
+        return random.randrange(10000) < self.umbral
+
+
+class ManejadorCola(logging.handlers.QueueHandler):
+    """
+    QueueHandler que encola el LogRecord sin formatear
+    
+    El prepare() estándar formatea el mensaje en el hilo que loguea (y borra
+    args y exc_info); aquí el record viaja intacto y FormateadorJSON recibe
+    exc_info en el hilo del QueueListener.
+    """
+    
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def _niveles_por_modulo(valor: str) -> dict:
+    niveles = {}
+    for par in valor.split(","):
+        if "=" in par:
+            modulo, nivel = par.split("=", 1)
+            niveles[modulo.strip()] = nivel.strip().upper()
+    return niveles
+
+
+def configurar_logging():
+    """
+    Configura el logger raíz según las variables de entorno
+    Reemplaza cualquier handler previo (p. ej. el creado por logging.warning al importar)
+    """
+    global _listener
+    
+    nivel = os.environ.get("LOG_LEVEL", "INFO").upper()
+    formato = os.environ.get("LOG_FORMAT", "texto").lower()
+    fraccion_debug = float(os.environ.get("LOG_MUESTREO_DEBUG", "1"))
+    asincrono = os.environ.get("LOG_ASINCRONO", "true").lower() == "true"
+    
+    salida = logging.StreamHandler()
+    if formato == "json":
+        salida.setFormatter(FormateadorJSON())
+    else:
+        salida.setFormatter(logging.Formatter("%(levelname)s:%(name)s:%(message)s"))
+    muestreo = FiltroMuestreoDebug(fraccion_debug)
+    
+    raiz = logging.getLogger()
+    for handler in list(raiz.handlers):
+        raiz.removeHandler(handler)
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+    
+    if asincrono:
+        # El hilo del request solo filtra y encola el LogRecord; el formateo
+        # y la escritura ocurren en el hilo del QueueListener. El muestreo va
+        # antes de la cola para que las líneas DEBUG descartadas no se encolen
+        cola = queue.SimpleQueue()
+        manejador = ManejadorCola(cola)
+        manejador.addFilter(muestreo)
+        raiz.addHandler(manejador)
+        _listener = logging.handlers.QueueListener(cola, salida, respect_handler_level=True)
+        _listener.start()
+        atexit.register(detener_logging)
+    else:
+        salida.addFilter(muestreo)
+        raiz.addHandler(salida)
+    
+    raiz.setLevel(nivel)
+    for modulo, nivel_modulo in _niveles_por_modulo(os.environ.get("LOG_LEVELS", "")).items():
+        logging.getLogger(modulo).setLevel(nivel_modulo)
+
+
+def detener_logging():
+    """Vacía la cola de logs pendientes (al apagar la aplicación)"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
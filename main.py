@@ -1,17 +1,55 @@
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Depends, Header, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import Response, StreamingResponse, FileResponse, JSONResponse
+from pydantic import BaseModel, Field, ValidationError, field_serializer
+from contextlib import contextmanager
 from typing import Optional, List
 from datetime import datetime, timedelta
+from sqlalchemy import select, update, delete, func
+from sqlalchemy.ext.asyncio import AsyncSession
+import asyncio
+import hashlib
+import json
 import logging
 import os
-import requests
+import time
+import httpx
 
-from database import SessionLocal, init_db, Suscripcion, HistorialVerificacion
-from config import TIEMPOS_VIAJE, CIUDADES_NORMALIZE, ONESIGNAL_API_KEY, ONESIGNAL_APP_ID
-from utils import consultar_guia_rastreo, enviar_push_notification, calcular_proxima_verificacion
+from logging_config import configurar_logging, detener_logging
 
-logging.basicConfig(level=logging.INFO)
+from database import (
+    get_db, get_db_perezoso, SesionPerezosa, BaseDatosSaturada, async_engine, AsyncSessionLocal, init_db, obtener_metricas_pool, Guia, Suscripcion, HistorialVerificacion,
+    ClaveIdempotencia, Dispositivo, insert_suscripcion_activa, upsert_dispositivos, obtener_o_crear_guias, con_suscriptores_activos,
+    consulta_estadisticas, consulta_guias_pendientes, ajustar_contadores, leer_contadores, recalcular_contadores
+)
+from config import (
+    TIEMPOS_VIAJE, CIUDADES_NORMALIZE, ONESIGNAL_API_KEY, ONESIGNAL_APP_ID, ONESIGNAL_API_URL,
+    VERIFICACION_CONCURRENCIA, VERIFICACION_TAMANO_LOTE, HITOS_INTERMEDIOS, NOTIFICAR_HITOS,
+    SUSCRIPCION_ASINCRONA, SUSCRIPCION_MINUTOS_RESPALDO, IDEMPOTENCIA_HORAS, SUSCRIPCION_LOTE_MAX, SUSCRIPCION_LOTE_CONCURRENCIA,
+    DISPOSITIVO_REGISTRO_HORAS, DISPOSITIVOS_LOTE_MAX, DISPOSITIVOS_LOTE_CONCURRENCIA,
+    AGENDA_ACTIVA, AGENDA_RESINCRONIZAR_MINUTOS, WEBHOOK_RASTREO_SECRETO,
+    WEBHOOK_TOLERANCIA_SEGUNDOS, WEBHOOK_HORAS_RESPALDO, WEBHOOK_MAX_EVENTOS
+)
+from metricas import (
+    RESULTADOS_VERIFICACION, EVENTOS_WEBHOOK, SUSCRIPCIONES_LOTE, REGISTROS_DISPOSITIVO, HITOS_NOTIFICADOS, EJECUCIONES_VERIFICACION, VERIFICACIONES_PENDIENTES,
+    ATRASO_MAXIMO, GUIAS_AGENDADAS, POOL_EN_USO, POOL_OVERFLOW, instrumentar_engine
+)
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from tracing import span, resumen_tiempos, detener_rastreo
+from reloj import ahora as ahora_reloj, a_colombia
+from perfilado import perfilar, listar_perfiles, ruta_perfil
+from cache import (
+    cache_lectura, clave_guia, clave_usuario, invalidar_suscripcion, respuesta_cacheada
+)
+from agenda import agenda_verificaciones
+from envios import controlador_envios
+from proveedores_push import MensajePush
+from utils import (
+    consultar_guia_rastreo, consultar_guia_rastreo_cacheada, calcular_proxima_verificacion,
+    extraer_fecha_despacho, diferencia_trazabilidad, firma_webhook_valida, obtener_cliente_http, cerrar_cliente_http
+)
+
+configurar_logging()
 logger = logging.getLogger(__name__)
 
 app = FastAPI(
@@ -20,6 +58,8 @@ app = FastAPI(
     version="1.0.0"
 )
 
+instrumentar_engine(async_engine.sync_engine)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -28,6 +68,11 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.exception_handler(BaseDatosSaturada)
+async def base_datos_saturada(request: Request, exc: BaseDatosSaturada):
+    """Pool agotado al tomar la conexión (get_db o SesionPerezosa): 503 para que el cliente reintente"""
+    return JSONResponse(status_code=503, content={"detail": str(exc)})
+
 # ===== MODELOS DE DATOS =====
 
 class SuscripcionCreate(BaseModel):
@@ -36,6 +81,10 @@ class SuscripcionCreate(BaseModel):
     token_fcm: Optional[str] = None
     telefono: Optional[str] = None
 
+class SuscripcionLoteRequest(BaseModel):
+    """Suscripción en lote: pares (numero_guia, onesignal_user_id) de un cliente corporativo"""
+    suscripciones: List[SuscripcionCreate]
+
 class SuscripcionResponse(BaseModel):
     id: int
     numero_guia: str
@@ -45,6 +94,30 @@ class SuscripcionResponse(BaseModel):
     fecha_creacion: datetime
     activo: bool
     proxima_verificacion: Optional[datetime]
+    
+    @field_serializer("fecha_creacion", "proxima_verificacion")
+    def _en_hora_colombia(self, valor: Optional[datetime]) -> Optional[str]:
+        # Se guardan en UTC; la app las muestra en hora de Colombia
+        return a_colombia(valor).isoformat() if valor else None
+
+class ResultadoSuscripcionLote(BaseModel):
+    """Resultado de un item del lote, en el mismo orden de la petición"""
+    indice: int
+    numero_guia: str
+    onesignal_user_id: str
+    resultado: str  # creada | existente | duplicada | rechazada | error
+    status_code: int
+    detalle: Optional[str] = None
+    suscripcion: Optional[SuscripcionResponse] = None
+
+class SuscripcionLoteResponse(BaseModel):
+    recibidas: int
+    creadas: int
+    existentes: int
+    duplicadas: int
+    rechazadas: int
+    errores: int
+    resultados: List[ResultadoSuscripcionLote]
 
 class EstadisticasResponse(BaseModel):
     total_suscripciones: int
@@ -52,6 +125,26 @@ class EstadisticasResponse(BaseModel):
     completadas: int
     verificaciones_pendientes: int
 
+class OperacionMasivaRequest(BaseModel):
+    """Filtros para operaciones administrativas en bloque (se combinan con AND)"""
+    creadas_hace_mas_de_horas: Optional[float] = None
+    onesignal_user_id: Optional[str] = None
+    excluir_onesignal_user_id: Optional[str] = None
+    estado: Optional[str] = None    # Coincidencia parcial, sin distinguir mayúsculas
+    origen: Optional[str] = None
+    destino: Optional[str] = None
+    dry_run: bool = False
+    tamano_lote: int = Field(1000, ge=1, le=10000)
+
+class EventoRastreo(BaseModel):
+    """Cambio de estado de una guía empujado por el backend de rastreo"""
+    numero_guia: str
+    estado_actual: str
+    trazabilidad: Optional[List[dict]] = None
+
+class LoteEventosRastreo(BaseModel):
+    eventos: List[EventoRastreo]
+
 class RegistroDispositivoRequest(BaseModel):
     """Request para registrar un dispositivo en OneSignal desde el backend"""
     device_type: int  # 0 = iOS, 1 = Android, 2 = Web
@@ -59,8 +152,31 @@ class RegistroDispositivoRequest(BaseModel):
     language: str = "es"
     timezone: int = -18000  # Colombia (UTC-5)
 
+class RegistroDispositivoLoteRequest(BaseModel):
+    """Registro en lote de tokens FCM (backfill)"""
+    dispositivos: List[RegistroDispositivoRequest]
+
+class ResultadoRegistroLote(BaseModel):
+    """Resultado de un token del lote, en el mismo orden de la petición"""
+    indice: int
+    resultado: str  # registrado | existente | duplicado | error
+    status_code: int
+    onesignal_user_id: Optional[str] = None
+    detalle: Optional[str] = None
+
+class RegistroDispositivoLoteResponse(BaseModel):
+    recibidos: int
+    registrados: int
+    existentes: int
+    duplicados: int
+    errores: int
+    resultados: List[ResultadoRegistroLote]
+
 # ===== FUNCIONES AUXILIARES =====
 
+# Estado de una guía aceptada con 202 que aún no se valida contra la API de rastreo
+ESTADO_PENDIENTE = "PENDIENTE DE VALIDACION"
+
 def guia_llego_a_destino(estado: str) -> bool:
     """Detecta si una guía llegó a su destino final."""
     if not estado:
@@ -150,6 +266,25 @@ async def startup_event():
         logger.info("✅ OneSignal configurado correctamente")
     else:
         logger.warning("⚠️ OneSignal NO configurado - Variables de entorno faltantes")
+    logger.info("📲 Proveedor de push: %s", controlador_envios.proveedor.nombre)
+    
+    if AGENDA_ACTIVA:
+        agenda_verificaciones.iniciar(
+            _verificar_agendadas, _cargar_agenda,
+            tamano_lote=VERIFICACION_TAMANO_LOTE,
+            intervalo_recarga=timedelta(minutes=AGENDA_RESINCRONIZAR_MINUTOS)
+        )
+        logger.info("🗓️ Agenda de verificaciones activa")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await agenda_verificaciones.detener()
+    await controlador_envios.detener()
+    await cerrar_cliente_http()
+    await async_engine.dispose()
+    await detener_rastreo()
+    logger.info("👋 Conexiones HTTP y pool de base de datos cerrados")
+    detener_logging()
 
 # ===== ENDPOINTS =====
 
@@ -177,50 +312,70 @@ def root():
         }
     }
 
-@app.post("/api/registrar-dispositivo")
-async def registrar_dispositivo(data: RegistroDispositivoRequest):
+def _validar_registro(data: RegistroDispositivoRequest):
+    """Validaciones del registro de un dispositivo (HTTPException 400 si no pasa)"""
+    # ✅ VALIDACIÓN 2: Verificar que el token no esté vacío
+    if not data.identifier or len(data.identifier.strip()) == 0:
+        logger.error("❌ Token FCM vacío o inválido")
+        raise HTTPException(
+            status_code=400,
+            detail="El token FCM es requerido y no puede estar vacío"
+        )
+    
+    # ✅ VALIDACIÓN 3: Verificar tipo de dispositivo válido
+    if data.device_type not in [0, 1, 2]:
+        logger.error(f"❌ Tipo de dispositivo inválido: {data.device_type}")
+        raise HTTPException(
+            status_code=400,
+            detail="device_type debe ser 0 (iOS), 1 (Android) o 2 (Web)"
+        )
+
+def _verificar_onesignal_configurado():
+    # ✅ VALIDACIÓN 1: Verificar que OneSignal esté configurado
+    if not ONESIGNAL_API_KEY or not ONESIGNAL_APP_ID:
+        logger.error("❌ CRÍTICO: OneSignal no configurado")
+        logger.error("   Variables de entorno faltantes:")
+        logger.error(f"   - ONESIGNAL_API_KEY: {'✅ OK' if ONESIGNAL_API_KEY else '❌ FALTA'}")
+        logger.error(f"   - ONESIGNAL_APP_ID: {'✅ OK' if ONESIGNAL_APP_ID else '❌ FALTA'}")
+        raise HTTPException(
+            status_code=500, 
+            detail="OneSignal no está configurado en el servidor. Contacte al administrador del sistema."
+        )
+
+def _huella_token(identifier: str) -> str:
+    """Clave del registro local: SHA-256 del token FCM (el token no se guarda en claro)"""
+    return hashlib.sha256(identifier.strip().encode("utf-8")).hexdigest()
+
+def _registro_vigente(dispositivo: Optional[Dispositivo], data: RegistroDispositivoRequest, ahora: datetime) -> bool:
+    """El token ya se registró hace menos de DISPOSITIVO_REGISTRO_HORAS y con los mismos datos"""
+    return (
+        dispositivo is not None
+        and dispositivo.fecha_registro >= ahora - timedelta(hours=DISPOSITIVO_REGISTRO_HORAS)
+        and (dispositivo.device_type, dispositivo.language, dispositivo.timezone)
+        == (data.device_type, data.language, data.timezone)
+    )
+
+def _fila_dispositivo(data: RegistroDispositivoRequest, onesignal_user_id: str, ahora: datetime) -> dict:
+    return {
+        "huella_token": _huella_token(data.identifier),
+        "onesignal_user_id": onesignal_user_id,
+        "device_type": data.device_type,
+        "language": data.language,
+        "timezone": data.timezone,
+        "fecha_registro": ahora,
+    }
+
+async def _registrar_en_onesignal(data: RegistroDispositivoRequest) -> str:
     """
-    🔒 ENDPOINT SEGURO: Registra un dispositivo en OneSignal desde el backend.
+    Da de alta el dispositivo en OneSignal (POST /players)
+    
+    Returns:
+        El OneSignal User ID (player ID)
+    
+    Raises:
+        HTTPException con el status equivalente al error de OneSignal
     """
     try:
-        logger.info("=" * 60)
-        logger.info("📱 NUEVA SOLICITUD DE REGISTRO DE DISPOSITIVO")
-        logger.info("=" * 60)
-        logger.info(f"   Device Type: {data.device_type} (0=iOS, 1=Android, 2=Web)")
-        logger.info(f"   Language: {data.language}")
-        logger.info(f"   Timezone: {data.timezone}")
-        logger.info(f"   FCM Token (primeros 30 chars): {data.identifier[:30]}...")
-        
-        # ✅ VALIDACIÓN 1: Verificar que OneSignal esté configurado
-        if not ONESIGNAL_API_KEY or not ONESIGNAL_APP_ID:
-            logger.error("❌ CRÍTICO: OneSignal no configurado")
-            logger.error("   Variables de entorno faltantes:")
-            logger.error(f"   - ONESIGNAL_API_KEY: {'✅ OK' if ONESIGNAL_API_KEY else '❌ FALTA'}")
-            logger.error(f"   - ONESIGNAL_APP_ID: {'✅ OK' if ONESIGNAL_APP_ID else '❌ FALTA'}")
-            raise HTTPException(
-                status_code=500, 
-                detail="OneSignal no está configurado en el servidor. Contacte al administrador del sistema."
-            )
-        
-        # ✅ VALIDACIÓN 2: Verificar que el token no esté vacío
-        if not data.identifier or len(data.identifier.strip()) == 0:
-            logger.error("❌ Token FCM vacío o inválido")
-            raise HTTPException(
-                status_code=400,
-                detail="El token FCM es requerido y no puede estar vacío"
-            )
-        
-        # ✅ VALIDACIÓN 3: Verificar tipo de dispositivo válido
-        if data.device_type not in [0, 1, 2]:
-            logger.error(f"❌ Tipo de dispositivo inválido: {data.device_type}")
-            raise HTTPException(
-                status_code=400,
-                detail="device_type debe ser 0 (iOS), 1 (Android) o 2 (Web)"
-            )
-        
-        logger.info("✅ Todas las validaciones pasadas")
-        logger.info("🔐 Preparando credenciales de OneSignal...")
-        
         # Preparar headers para OneSignal API
         headers = {
             "Authorization": f"Basic {ONESIGNAL_API_KEY}",
@@ -237,12 +392,12 @@ async def registrar_dispositivo(data: RegistroDispositivoRequest):
         }
         
         logger.info("📡 Enviando solicitud a OneSignal API...")
-        logger.info(f"   URL: https://onesignal.com/api/v1/players")
+        logger.info(f"   URL: {ONESIGNAL_API_URL}/players")
         logger.info(f"   App ID: {ONESIGNAL_APP_ID[:20]}...")
         
         # ✅ LLAMADA SEGURA A ONESIGNAL API
-        response = requests.post(
-            "https://onesignal.com/api/v1/players",
+        response = await obtener_cliente_http().post(
+            f"{ONESIGNAL_API_URL}/players",
             json=payload,
             headers=headers,
             timeout=15  # Timeout de 15 segundos
@@ -269,18 +424,7 @@ async def registrar_dispositivo(data: RegistroDispositivoRequest):
             if len(onesignal_user_id) < 30:
                 logger.warning(f"⚠️ User ID con formato sospechoso: {onesignal_user_id}")
             
-            logger.info("=" * 60)
-            logger.info("✅ REGISTRO EXITOSO")
-            logger.info("=" * 60)
-            logger.info(f"   OneSignal User ID: {onesignal_user_id}")
-            logger.info(f"   Success: {result.get('success', True)}")
-            logger.info("=" * 60)
-            
-            return {
-                "success": True,
-                "onesignal_user_id": onesignal_user_id,
-                "message": "Dispositivo registrado exitosamente en OneSignal"
-            }
+            return onesignal_user_id
         
         # ✅ MANEJO DE ERRORES 400 (Validación)
         elif response.status_code == 400:
@@ -314,7 +458,7 @@ async def registrar_dispositivo(data: RegistroDispositivoRequest):
             )
     
     # ✅ MANEJO DE TIMEOUT
-    except requests.exceptions.Timeout:
+    except httpx.TimeoutException:
         logger.error("⏰ TIMEOUT conectando con OneSignal")
         logger.error("   La solicitud tardó más de 15 segundos")
         raise HTTPException(
@@ -323,15 +467,75 @@ async def registrar_dispositivo(data: RegistroDispositivoRequest):
         )
     
     # ✅ MANEJO DE ERRORES DE CONEXIÓN
-    except requests.exceptions.ConnectionError as e:
+    except httpx.ConnectError as e:
         logger.error(f"🌐 Error de conexión con OneSignal: {e}")
         raise HTTPException(
             status_code=503,
             detail="No se pudo conectar con OneSignal. Verifique su conexión a internet."
         )
+
+async def _guardar_dispositivos(db: AsyncSession, filas: List[dict]):
+    """Guarda los registros nuevos; si falla solo se pierde el atajo, no el registro en OneSignal"""
+    try:
+        await db.execute(upsert_dispositivos(), filas)
+        await db.commit()
+    except Exception as e:
+        logger.warning("⚠️ No se pudo guardar el registro local de %s dispositivos: %s", len(filas), e)
+        await db.rollback()
+
+@app.post("/api/registrar-dispositivo")
+async def registrar_dispositivo(data: RegistroDispositivoRequest, db: AsyncSession = Depends(get_db)):
+    """
+    🔒 ENDPOINT SEGURO: Registra un dispositivo en OneSignal desde el backend.
+    
+    Si el mismo token FCM ya se registró (con los mismos datos) hace menos de
+    DISPOSITIVO_REGISTRO_HORAS, responde el User ID guardado sin llamar a OneSignal.
+    """
+    try:
+        logger.info("=" * 60)
+        logger.info("📱 NUEVA SOLICITUD DE REGISTRO DE DISPOSITIVO")
+        logger.info("=" * 60)
+        logger.info(f"   Device Type: {data.device_type} (0=iOS, 1=Android, 2=Web)")
+        logger.info(f"   Language: {data.language}")
+        logger.info(f"   Timezone: {data.timezone}")
+        logger.info(f"   FCM Token (primeros 30 chars): {data.identifier[:30]}...")
+        
+        _verificar_onesignal_configurado()
+        _validar_registro(data)
+        
+        logger.info("✅ Todas las validaciones pasadas")
+        
+        ahora = ahora_reloj()
+        dispositivo = await db.get(Dispositivo, _huella_token(data.identifier))
+        if _registro_vigente(dispositivo, data, ahora):
+            logger.info(f"♻️ Dispositivo ya registrado, OneSignal User ID: {dispositivo.onesignal_user_id}")
+            REGISTROS_DISPOSITIVO.labels("existente").inc()
+            return {
+                "success": True,
+                "onesignal_user_id": dispositivo.onesignal_user_id,
+                "message": "Dispositivo ya registrado en OneSignal"
+            }
+        
+        logger.info("🔐 Preparando credenciales de OneSignal...")
+        onesignal_user_id = await _registrar_en_onesignal(data)
+        await _guardar_dispositivos(db, [_fila_dispositivo(data, onesignal_user_id, ahora)])
+        REGISTROS_DISPOSITIVO.labels("registrado").inc()
+        
+        logger.info("=" * 60)
+        logger.info("✅ REGISTRO EXITOSO")
+        logger.info("=" * 60)
+        logger.info(f"   OneSignal User ID: {onesignal_user_id}")
+        logger.info("=" * 60)
+        
+        return {
+            "success": True,
+            "onesignal_user_id": onesignal_user_id,
+            "message": "Dispositivo registrado exitosamente en OneSignal"
+        }
     
     # Re-lanzar HTTPException para que FastAPI las maneje correctamente
     except HTTPException:
+        REGISTROS_DISPOSITIVO.labels("error").inc()
         raise
     
     # ✅ MANEJO DE ERRORES INESPERADOS
@@ -343,316 +547,1407 @@ async def registrar_dispositivo(data: RegistroDispositivoRequest):
         logger.error(f"   Mensaje: {str(e)}")
         logger.error("=" * 60)
         
+        REGISTROS_DISPOSITIVO.labels("error").inc()
         raise HTTPException(
             status_code=500, 
             detail=f"Error interno del servidor: {str(e)}"
         )
 
+@app.post("/api/registrar-dispositivo/lote", response_model=RegistroDispositivoLoteResponse)
+async def registrar_dispositivos_lote(data: RegistroDispositivoLoteRequest, db: AsyncSession = Depends(get_db)):
+    """
+    Registra muchos tokens FCM en una sola petición (backfill de dispositivos)
+    
+    - Una sola consulta al registro local: los tokens vigentes no llaman a OneSignal
+    - Los demás se registran en paralelo (DISPOSITIVOS_LOTE_CONCURRENCIA)
+    - Un único upsert y un solo commit para los registros nuevos
+    
+    El resultado viene por item (registrado, existente, duplicado o error) con
+    el status que habría devuelto /api/registrar-dispositivo.
+    """
+    items = data.dispositivos
+    if len(items) > DISPOSITIVOS_LOTE_MAX:
+        raise HTTPException(status_code=413, detail=f"Maximo {DISPOSITIVOS_LOTE_MAX} dispositivos por lote")
+    _verificar_onesignal_configurado()
+    
+    resultados: List[Optional[ResultadoRegistroLote]] = [None] * len(items)
+    
+    def _resultado(indice: int, resultado: str, status_code: int,
+                   onesignal_user_id: Optional[str] = None, detalle: Optional[str] = None):
+        resultados[indice] = ResultadoRegistroLote(
+            indice=indice,
+            resultado=resultado,
+            status_code=status_code,
+            onesignal_user_id=onesignal_user_id,
+            detalle=detalle
+        )
+        REGISTROS_DISPOSITIVO.labels(resultado).inc()
+    
+    # Tokens repetidos dentro del mismo lote: cuenta el primero
+    primer_indice = {}
+    duplicados = []
+    for indice, item in enumerate(items):
+        try:
+            _validar_registro(item)
+        except HTTPException as e:
+            _resultado(indice, "error", e.status_code, detalle=e.detail)
+            continue
+        huella = _huella_token(item.identifier)
+        if huella in primer_indice:
+            duplicados.append((indice, primer_indice[huella]))
+        else:
+            primer_indice[huella] = indice
+    
+    ahora = ahora_reloj()
+    registrados = {}
+    if primer_indice:
+        resultado = await db.scalars(
+            select(Dispositivo).where(Dispositivo.huella_token.in_(primer_indice))
+        )
+        registrados = {d.huella_token: d for d in resultado.all()}
+    
+    por_registrar = []
+    for huella, indice in primer_indice.items():
+        dispositivo = registrados.get(huella)
+        if _registro_vigente(dispositivo, items[indice], ahora):
+            _resultado(indice, "existente", 200, dispositivo.onesignal_user_id)
+        else:
+            por_registrar.append(indice)
+    
+    semaforo = asyncio.Semaphore(DISPOSITIVOS_LOTE_CONCURRENCIA)
+    
+    async def _registrar(item: RegistroDispositivoRequest):
+        async with semaforo:
+            return await _registrar_en_onesignal(item)
+    
+    with span("registrar_dispositivos_lote.onesignal", dispositivos=len(por_registrar)):
+        respuestas = await asyncio.gather(
+            *(_registrar(items[indice]) for indice in por_registrar), return_exceptions=True
+        )
+    
+    filas = []
+    for indice, respuesta in zip(por_registrar, respuestas):
+        if isinstance(respuesta, HTTPException):
+            _resultado(indice, "error", respuesta.status_code, detalle=respuesta.detail)
+        elif isinstance(respuesta, Exception):
+            logger.error("❌ Error registrando dispositivo %s del lote: %s", indice, respuesta)
+            _resultado(indice, "error", 500, detalle=str(respuesta))
+        else:
+            _resultado(indice, "registrado", 200, respuesta)
+            filas.append(_fila_dispositivo(items[indice], respuesta, ahora))
+    
+    if filas:
+        await _guardar_dispositivos(db, filas)
+    
+    for indice, original in duplicados:
+        anterior = resultados[original]
+        _resultado(
+            indice, "duplicado", anterior.status_code, anterior.onesignal_user_id,
+            detalle=f"Repite el item {original} del lote"
+        )
+    
+    conteo = {"registrado": 0, "existente": 0, "duplicado": 0, "error": 0}
+    for r in resultados:
+        conteo[r.resultado] += 1
+    
+    logger.info(
+        "📱 Registro de dispositivos en lote: recibidos=%s registrados=%s existentes=%s duplicados=%s errores=%s",
+        len(items), conteo["registrado"], conteo["existente"], conteo["duplicado"], conteo["error"]
+    )
+    
+    return RegistroDispositivoLoteResponse(
+        recibidos=len(items),
+        registrados=conteo["registrado"],
+        existentes=conteo["existente"],
+        duplicados=conteo["duplicado"],
+        errores=conteo["error"],
+        resultados=resultados
+    )
+
 @app.post("/api/suscribir", response_model=SuscripcionResponse)
-async def suscribir_guia(data: SuscripcionCreate, background_tasks: BackgroundTasks):
-    db = SessionLocal()
+async def suscribir_guia(
+    data: SuscripcionCreate,
+    background_tasks: BackgroundTasks,
+    response: Response,
+    asincrono: Optional[bool] = Query(None, description="Responder 202 y validar la guía en segundo plano"),
+    perfilar_request: bool = Query(False, alias="perfilar"),
+    idempotency_key: Optional[str] = Header(None, max_length=255),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Suscribe una guía a notificaciones
+    
+    - Síncrono (por defecto): consulta la API de rastreo, valida y responde 200
+    - asincrono=true (o SUSCRIPCION_ASINCRONA): guarda la suscripción como
+      pendiente y responde 202 de inmediato; la validación corre en segundo
+      plano y el resultado se consulta en GET /api/suscripciones/{id}
+    - Idempotency-Key (opcional): un reintento con la misma clave y el mismo
+      cuerpo recibe la respuesta original durante IDEMPOTENCIA_HORAS
+    """
+    if asincrono is None:
+        asincrono = SUSCRIPCION_ASINCRONA
+    
+    huella = None
+    if idempotency_key:
+        huella = hashlib.sha256(data.model_dump_json().encode()).hexdigest()
+        repetida = await _respuesta_idempotente(db, idempotency_key, huella)
+        if repetida:
+            return repetida
+    
+    async with perfilar("suscribir", perfilar_request) as perfil:
+        if perfil:
+            response.headers["X-Perfil"] = perfil
+        respuesta = await _suscribir_guia(data, db, background_tasks, response, asincrono)
+    
+    if idempotency_key:
+        await _guardar_idempotencia(db, idempotency_key, huella, response.status_code or 200, respuesta)
+    return respuesta
+
+async def _respuesta_idempotente(db: AsyncSession, clave: str, huella: str) -> Optional[Response]:
+    """
+    Respuesta guardada para un Idempotency-Key vigente, o None si no hay
+    
+    Raises:
+        HTTPException 422 si la clave ya se usó con otro cuerpo
+    """
+    guardada = await db.get(ClaveIdempotencia, clave)
+    if not guardada or guardada.fecha_creacion < ahora_reloj() - timedelta(hours=IDEMPOTENCIA_HORAS):
+        return None
+    if guardada.huella_peticion != huella:
+        raise HTTPException(status_code=422, detail="Idempotency-Key ya usada con otra peticion")
+    
+    logger.debug("Respuesta repetida por Idempotency-Key %s", clave)
+    headers = {"Idempotent-Replayed": "true"}
+    if guardada.status_code == 202:
+        headers["Location"] = f"/api/suscripciones/{json.loads(guardada.respuesta)['id']}"
+    return Response(
+        content=guardada.respuesta, status_code=guardada.status_code,
+        media_type="application/json", headers=headers
+    )
+
+async def _guardar_idempotencia(
+    db: AsyncSession, clave: str, huella: str, status_code: int, respuesta: SuscripcionResponse
+):
+    """
+    Guarda la respuesta exitosa de un Idempotency-Key (los errores no se guardan:
+    un reintento vuelve a validar la guía). Si falla, la suscripción ya quedó
+    creada y el índice único sigue evitando duplicados.
+    """
     try:
-        logger.info(f"Nueva suscripcion: {data.numero_guia}")
+        await db.merge(ClaveIdempotencia(
+            clave=clave,
+            huella_peticion=huella,
+            status_code=status_code,
+            respuesta=respuesta.model_dump_json(),
+            fecha_creacion=ahora_reloj()
+        ))
+        await db.commit()
+    except Exception as e:
+        logger.warning("⚠️ No se pudo guardar Idempotency-Key %s: %s", clave, e)
+        await db.rollback()
+
+def _respuesta_suscripcion(suscripcion: Suscripcion, guia: Optional[Guia] = None) -> SuscripcionResponse:
+    guia = guia or suscripcion.guia
+    return SuscripcionResponse(
+        id=suscripcion.id,
+        numero_guia=suscripcion.numero_guia,
+        estado_actual=guia.estado_actual,
+        origen=guia.origen,
+        destino=guia.destino,
+        fecha_creacion=suscripcion.fecha_creacion,
+        activo=suscripcion.activo,
+        # La guía puede seguir programada por otros suscriptores
+        proxima_verificacion=guia.proxima_verificacion if suscripcion.activo else None
+    )
+
+def _guia_vigente(guia: Guia) -> bool:
+    """
+    True si la guía ya está validada y programada: una suscripción nueva se
+    une sin consultar la API de rastreo (el verificador la mantiene al día)
+    """
+    return guia.proxima_verificacion is not None and guia.estado_actual != ESTADO_PENDIENTE
+
+def _completar_guia(guia: Guia, info_guia: Optional[dict]) -> Optional[HTTPException]:
+    """
+    Valida la guía y la completa con la información de la API de rastreo
+    
+    Compartida por la suscripción síncrona, la suscripción en lote, la
+    validación en segundo plano y el verificador (guías pendientes que
+    quedaron sin validar).
+    
+    Returns:
+        None si la guía es válida, o la HTTPException con el motivo del rechazo
+    """
+    if not info_guia:
+        return HTTPException(status_code=404, detail=f"No se encontro la guia {guia.numero_guia}")
+    
+    estado_actual = info_guia.get('estado_actual', '')
+    
+    if guia_llego_a_destino(estado_actual):
+        return HTTPException(
+            status_code=400,
+            detail=f"Guia ya esta en {estado_actual}, no se puede suscribir a notificaciones"
+        )
+    
+    if not debe_continuar_verificando(estado_actual):
+        return HTTPException(
+            status_code=400,
+            detail=f"Guia en estado final ({estado_actual}), no se puede suscribir"
+        )
+    
+    guia.origen = info_guia.get('origen')
+    guia.destino = info_guia.get('destino')
+    guia.estado_actual = estado_actual
+    guia.fecha_admision = info_guia.get('fecha_admision')
+    guia.remitente = info_guia.get('remitente_nombre')
+    guia.destinatario = info_guia.get('destinatario_nombre')
+    guia.fecha_despacho = extraer_fecha_despacho(info_guia.get('trazabilidad'))
+    guia.fecha_entrega = None
+    # Resumen inicial: solo los eventos posteriores a la validación se consideran nuevos
+    _, guia.trazabilidad_eventos, guia.trazabilidad_huella = diferencia_trazabilidad(
+        info_guia.get('trazabilidad') or [], 0, None
+    )
+    
+    guia.proxima_verificacion = calcular_proxima_verificacion(
+        estado_actual=guia.estado_actual,
+        origen=guia.origen,
+        destino=guia.destino,
+        fecha_admision=guia.fecha_admision,
+        fecha_despacho=guia.fecha_despacho
+    )
+    return None
+
+async def _rechazar_guia(db: AsyncSession, guia: Guia, rechazo: HTTPException) -> list:
+    """
+    Marca la guía como rechazada (el motivo queda en estado_actual) y
+    desactiva sus suscripciones activas (pendientes de validación)
+    
+    Ajusta el contador de activas; no hace commit.
+    
+    Returns:
+        Filas (numero_guia, onesignal_user_id) desactivadas, para invalidar la caché tras el commit
+    """
+    guia.estado_actual = f"RECHAZADA: {rechazo.detail}"[:100]
+    guia.proxima_verificacion = None
+    resultado = await db.execute(
+        update(Suscripcion)
+        .where(Suscripcion.guia_id == guia.id, Suscripcion.activo == True)
+        .values(activo=False)
+        .returning(Suscripcion.numero_guia, Suscripcion.onesignal_user_id)
+    )
+    desactivadas = resultado.all()
+    await ajustar_contadores(db, activas=-len(desactivadas))
+    return desactivadas
+
+def _marcar_guia_pendiente(guia: Guia, ahora: datetime):
+    """Guía por validar en segundo plano; si la validación se pierde, el verificador la retoma"""
+    guia.estado_actual = ESTADO_PENDIENTE
+    guia.proxima_verificacion = ahora + timedelta(minutes=SUSCRIPCION_MINUTOS_RESPALDO)
+
+# Columnas que se copian de una suscripción nueva (aún sin id) a su INSERT
+_COLUMNAS_INSERT = (
+    "numero_guia", "guia_id", "onesignal_user_id", "token_fcm", "telefono", "fecha_creacion", "activo",
+)
+
+def _agendar(*guias: Guia):
+    """Lleva a la agenda en memoria la proxima_verificacion ya confirmada (después del commit)"""
+    for guia in guias:
+        agenda_verificaciones.programar(guia.id, guia.proxima_verificacion)
+
+# Guías que el cron o el worker de la agenda están verificando en este proceso
+_guias_en_verificacion: set = set()
+
+@contextmanager
+def _reservar_guias(guia_ids: List[int]):
+    """
+    Reserva las guías que ningún otro camino está verificando y las libera al salir
+    
+    Entre el SELECT y el commit de un lote hay awaits (API de rastreo): sin
+    la reserva, /api/verificar y la agenda podrían procesar la misma guía
+    vencida a la vez (consulta y push duplicados). Entre instancias lo
+    evita el FOR UPDATE SKIP LOCKED de las consultas (PostgreSQL).
+    
+    Yields:
+        Conjunto de ids reservados por este llamador
+    """
+    libres = {guia_id for guia_id in guia_ids if guia_id not in _guias_en_verificacion}
+    _guias_en_verificacion.update(libres)
+    try:
+        yield libres
+    finally:
+        _guias_en_verificacion.difference_update(libres)
+
+def _valores_insert(suscripcion: Suscripcion) -> dict:
+    return {columna: getattr(suscripcion, columna) for columna in _COLUMNAS_INSERT}
+
+def _nueva_suscripcion(data: SuscripcionCreate, guia: Guia, ahora: datetime) -> Suscripcion:
+    """Suscripción transitoria (fuera de la sesión): solo se usa para armar el INSERT y la respuesta"""
+    return Suscripcion(
+        numero_guia=data.numero_guia,
+        guia_id=guia.id,
+        onesignal_user_id=data.onesignal_user_id,
+        token_fcm=data.token_fcm,
+        telefono=data.telefono,
+        fecha_creacion=ahora,
+        activo=True
+    )
+
+async def _suscribir_guia(
+    data: SuscripcionCreate,
+    db: AsyncSession,
+    background_tasks: BackgroundTasks,
+    response: Response,
+    asincrono: bool
+) -> SuscripcionResponse:
+    try:
+        logger.info("Nueva suscripcion: %s", data.numero_guia)
+        ahora = ahora_reloj()
         
-        suscripcion_existente = db.query(Suscripcion).filter(
-            Suscripcion.numero_guia == data.numero_guia,
-            Suscripcion.onesignal_user_id == data.onesignal_user_id,
-            Suscripcion.activo == True
-        ).first()
-        
-        if suscripcion_existente:
-            logger.info(f"Suscripcion ya existe para {data.numero_guia}")
-            return SuscripcionResponse(
-                id=suscripcion_existente.id,
-                numero_guia=suscripcion_existente.numero_guia,
-                estado_actual=suscripcion_existente.estado_actual,
-                origen=suscripcion_existente.origen,
-                destino=suscripcion_existente.destino,
-                fecha_creacion=suscripcion_existente.fecha_creacion,
-                activo=suscripcion_existente.activo,
-                proxima_verificacion=suscripcion_existente.proxima_verificacion
-            )
+        guia = (await obtener_o_crear_guias(db, [data.numero_guia]))[data.numero_guia]
         
-        logger.info(f"Consultando informacion inicial de {data.numero_guia}")
-        info_guia = consultar_guia_rastreo(data.numero_guia)
+        if _guia_vigente(guia):
+            logger.debug("Guia %s ya validada, sin consultar rastreo", data.numero_guia, extra={"numero_guia": data.numero_guia})
+        elif asincrono:
+            if guia.estado_actual != ESTADO_PENDIENTE:
+                _marcar_guia_pendiente(guia, ahora)
+        else:
+            logger.debug("Consultando informacion inicial de %s", data.numero_guia, extra={"numero_guia": data.numero_guia})
+            rechazo = _completar_guia(guia, await consultar_guia_rastreo_cacheada(data.numero_guia))
+            if rechazo:
+                await db.rollback()
+                raise rechazo
         
-        if not info_guia:
-            raise HTTPException(status_code=404, detail=f"No se encontro la guia {data.numero_guia}")
+        nueva_suscripcion = _nueva_suscripcion(data, guia, ahora)
         
-        estado_actual = info_guia.get('estado_actual', '')
+        # Sin SELECT previo: el índice único decide si ya existe una activa
+        nueva_suscripcion.id = await db.scalar(
+            insert_suscripcion_activa()
+            .values(_valores_insert(nueva_suscripcion))
+            .returning(Suscripcion.id)
+        )
         
-        if guia_llego_a_destino(estado_actual):
-            raise HTTPException(
-                status_code=400, 
-                detail=f"Guia ya esta en {estado_actual}, no se puede suscribir a notificaciones"
+        if nueva_suscripcion.id is None:
+            suscripcion_existente = await db.scalar(
+                select(Suscripcion).where(
+                    Suscripcion.numero_guia == data.numero_guia,
+                    Suscripcion.onesignal_user_id == data.onesignal_user_id,
+                    Suscripcion.activo == True
+                ).limit(1)
             )
+            if suscripcion_existente:
+                logger.debug("Suscripcion ya existe para %s", data.numero_guia, extra={"numero_guia": data.numero_guia})
+                await db.commit()
+                _agendar(guia)
+                return _respuesta_suscripcion(suscripcion_existente)
+            raise HTTPException(status_code=409, detail="Suscripcion modificada en paralelo, reintenta")
         
-        if not debe_continuar_verificando(estado_actual):
-            raise HTTPException(
-                status_code=400,
-                detail=f"Guia en estado final ({estado_actual}), no se puede suscribir"
+        await ajustar_contadores(db, total_suscripciones=1, activas=1)
+        await db.commit()
+        _agendar(guia)
+        invalidar_suscripcion(nueva_suscripcion.numero_guia, nueva_suscripcion.onesignal_user_id)
+        
+        if guia.estado_actual == ESTADO_PENDIENTE:
+            background_tasks.add_task(_validar_guia_pendiente, guia.id)
+            response.status_code = 202
+            response.headers["Location"] = f"/api/suscripciones/{nueva_suscripcion.id}"
+            logger.info("⏳ Suscripcion pendiente creada: ID %s", nueva_suscripcion.id)
+        else:
+            logger.info(
+                "✅ Suscripcion creada: ID %s, primera verificacion en %s",
+                nueva_suscripcion.id, guia.proxima_verificacion
             )
         
-        nueva_suscripcion = Suscripcion(
-            numero_guia=data.numero_guia,
-            onesignal_user_id=data.onesignal_user_id,
-            token_fcm=data.token_fcm,
-            telefono=data.telefono,
-            origen=info_guia.get('origen'),
-            destino=info_guia.get('destino'),
-            estado_actual=estado_actual,
-            fecha_admision=info_guia.get('fecha_admision'),
-            remitente=info_guia.get('remitente_nombre'),
-            destinatario=info_guia.get('destinatario_nombre')
-        )
-        
-        # ✅ CORRECCIÓN CRÍTICA: Pasar la trazabilidad
-        proxima = calcular_proxima_verificacion(
-            estado_actual=nueva_suscripcion.estado_actual,
-            origen=nueva_suscripcion.origen,
-            destino=nueva_suscripcion.destino,
-            fecha_admision=nueva_suscripcion.fecha_admision,
-            trazabilidad=info_guia.get('trazabilidad')  # ← NUEVO
-        )
-        nueva_suscripcion.proxima_verificacion = proxima
-        
-        db.add(nueva_suscripcion)
-        db.commit()
-        db.refresh(nueva_suscripcion)
-        
-        logger.info(f"✅ Suscripcion creada: ID {nueva_suscripcion.id}")
-        logger.info(f"📅 Primera verificacion en: {proxima}")
-        
-        return SuscripcionResponse(
-            id=nueva_suscripcion.id,
-            numero_guia=nueva_suscripcion.numero_guia,
-            estado_actual=nueva_suscripcion.estado_actual,
-            origen=nueva_suscripcion.origen,
-            destino=nueva_suscripcion.destino,
-            fecha_creacion=nueva_suscripcion.fecha_creacion,
-            activo=nueva_suscripcion.activo,
-            proxima_verificacion=nueva_suscripcion.proxima_verificacion
-        )
+        return _respuesta_suscripcion(nueva_suscripcion, guia)
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"❌ Error creando suscripcion: {e}")
-        db.rollback()
+        logger.error("❌ Error creando suscripcion: %s", e)
+        await db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        db.close()
 
-@app.get("/api/suscripcion/{numero_guia}", response_model=SuscripcionResponse)
-def obtener_estado_suscripcion(numero_guia: str):
-    db = SessionLocal()
+async def _validar_guia_pendiente(guia_id: int):
+    """
+    Tarea en segundo plano: consulta la guía (reutilizando consultas recientes),
+    la completa o la rechaza junto con sus suscripciones pendientes
+    
+    Si la API de rastreo no responde, la guía queda pendiente y el
+    verificador la retoma en SUSCRIPCION_MINUTOS_RESPALDO minutos.
+    """
+    try:
+        async with AsyncSessionLocal() as db:
+            guia = await db.get(Guia, guia_id)
+            if not guia or guia.estado_actual != ESTADO_PENDIENTE:
+                return
+            
+            info_guia = await consultar_guia_rastreo_cacheada(guia.numero_guia)
+            if info_guia is None:
+                logger.warning("⚠️ No se pudo validar la guia %s, la retomara el verificador", guia.numero_guia)
+                return
+            
+            # Usuarios cuyas lecturas cambian con el estado de la guía
+            usuarios = (await db.scalars(
+                select(Suscripcion.onesignal_user_id).where(
+                    Suscripcion.guia_id == guia.id, Suscripcion.activo == True
+                )
+            )).all()
+            
+            rechazo = _completar_guia(guia, info_guia)
+            if rechazo:
+                await _rechazar_guia(db, guia, rechazo)
+                logger.info("🚫 Guia %s rechazada: %s", guia.numero_guia, rechazo.detail)
+            else:
+                logger.info(
+                    "✅ Guia %s validada, primera verificacion en %s",
+                    guia.numero_guia, guia.proxima_verificacion
+                )
+            
+            await db.commit()
+            _agendar(guia)
+            invalidar_suscripcion(guia.numero_guia, None)
+            for usuario in usuarios:
+                invalidar_suscripcion(guia.numero_guia, usuario)
+    except Exception as e:
+        logger.error("❌ Error validando guia %s: %s", guia_id, e)
+
+@app.post("/api/suscribir/lote", response_model=SuscripcionLoteResponse)
+async def suscribir_guias_lote(data: SuscripcionLoteRequest, db: AsyncSession = Depends(get_db)):
+    """
+    Suscribe muchas guías en una sola petición (clientes corporativos)
+    
+    - Una sola consulta para detectar suscripciones activas ya existentes
+    - Consulta en paralelo (SUSCRIPCION_LOTE_CONCURRENCIA) solo las guías
+      que aún no están validadas, una vez por guía aunque la pidan varios usuarios
+    - Inserta todas las válidas con un único INSERT y un solo commit
+    
+    Cada item se valida igual que en /api/suscribir; el resultado viene por
+    item (creada, existente, duplicada, rechazada o error) con el status que
+    habría devuelto la suscripción individual.
+    """
+    items = data.suscripciones
+    if len(items) > SUSCRIPCION_LOTE_MAX:
+        raise HTTPException(status_code=413, detail=f"Maximo {SUSCRIPCION_LOTE_MAX} suscripciones por lote")
+    
+    resultados: List[Optional[ResultadoSuscripcionLote]] = [None] * len(items)
+    
+    def _resultado(indice: int, resultado: str, status_code: int, detalle: Optional[str] = None,
+                   suscripcion: Optional[SuscripcionResponse] = None):
+        item = items[indice]
+        resultados[indice] = ResultadoSuscripcionLote(
+            indice=indice,
+            numero_guia=item.numero_guia,
+            onesignal_user_id=item.onesignal_user_id,
+            resultado=resultado,
+            status_code=status_code,
+            detalle=detalle,
+            suscripcion=suscripcion
+        )
+        SUSCRIPCIONES_LOTE.labels(resultado).inc()
+    
+    # Pares repetidos dentro del mismo lote: cuenta el primero
+    primer_indice = {}
+    duplicados = []
+    for indice, item in enumerate(items):
+        par = (item.numero_guia, item.onesignal_user_id)
+        if par in primer_indice:
+            duplicados.append((indice, primer_indice[par]))
+        else:
+            primer_indice[par] = indice
+    
+    # Una sola consulta para las suscripciones activas ya existentes
+    existentes = {}
+    if primer_indice:
+        resultado = await db.scalars(
+            select(Suscripcion).where(
+                Suscripcion.numero_guia.in_({guia for guia, _ in primer_indice}),
+                Suscripcion.onesignal_user_id.in_({usuario for _, usuario in primer_indice}),
+                Suscripcion.activo == True
+            ).order_by(Suscripcion.id)
+        )
+        for suscripcion in resultado.all():
+            existentes.setdefault((suscripcion.numero_guia, suscripcion.onesignal_user_id), suscripcion)
+    
+    pendientes = []
+    for par, indice in primer_indice.items():
+        if par in existentes:
+            _resultado(indice, "existente", 200, suscripcion=_respuesta_suscripcion(existentes[par]))
+        else:
+            pendientes.append(indice)
+    
+    guias = await obtener_o_crear_guias(db, {items[indice].numero_guia for indice in pendientes})
+    
+    # Consultas a la API de rastreo en paralelo, solo para las guías sin validar
+    semaforo = asyncio.Semaphore(SUSCRIPCION_LOTE_CONCURRENCIA)
+    
+    async def _consultar(numero_guia: str):
+        async with semaforo:
+            return await consultar_guia_rastreo_cacheada(numero_guia)
+    
+    por_validar = [guia for guia in guias.values() if not _guia_vigente(guia)]
+    with span("suscribir_lote.consultas", guias=len(por_validar)):
+        respuestas = await asyncio.gather(
+            *(_consultar(guia.numero_guia) for guia in por_validar), return_exceptions=True
+        )
+    
+    # Motivo por el que no se puede suscribir a cada guía: (resultado, status, detalle)
+    fallidas = {}
+    desactivadas = []
+    for guia, info_guia in zip(por_validar, respuestas):
+        if isinstance(info_guia, Exception):
+            logger.error("❌ Error consultando guia %s en lote: %s", guia.numero_guia, info_guia)
+            fallidas[guia.numero_guia] = ("error", 502, str(info_guia))
+            continue
+        rechazo = _completar_guia(guia, info_guia)
+        if rechazo:
+            desactivadas += await _rechazar_guia(db, guia, rechazo)
+            fallidas[guia.numero_guia] = ("rechazada", rechazo.status_code, rechazo.detail)
+    
+    ahora = ahora_reloj()
+    nuevas = []
+    for indice in pendientes:
+        item = items[indice]
+        if item.numero_guia in fallidas:
+            _resultado(indice, *fallidas[item.numero_guia])
+        else:
+            nuevas.append((indice, _nueva_suscripcion(item, guias[item.numero_guia], ahora)))
+    
     try:
-        suscripcion = db.query(Suscripcion).filter(
+        concurrentes = []
+        if nuevas:
+            # Un único INSERT ... ON CONFLICT DO NOTHING RETURNING para todo el lote
+            insertadas = await db.execute(
+                insert_suscripcion_activa().returning(
+                    Suscripcion.id, Suscripcion.numero_guia, Suscripcion.onesignal_user_id
+                ),
+                [_valores_insert(s) for _, s in nuevas]
+            )
+            ids = {(fila.numero_guia, fila.onesignal_user_id): fila.id for fila in insertadas}
+            
+            # Las que chocaron las creó otra petición entre la consulta y el INSERT
+            for indice, suscripcion in nuevas:
+                suscripcion.id = ids.get((suscripcion.numero_guia, suscripcion.onesignal_user_id))
+            concurrentes = [(i, s) for i, s in nuevas if s.id is None]
+            nuevas = [(i, s) for i, s in nuevas if s.id is not None]
+            
+            await ajustar_contadores(db, total_suscripciones=len(nuevas), activas=len(nuevas))
+        await db.commit()
+        _agendar(*guias.values())
+    except Exception as e:
+        logger.error("❌ Error insertando lote de suscripciones: %s", e)
+        await db.rollback()
+        for indice, _ in nuevas:
+            _resultado(indice, "error", 500, detalle=str(e))
+        nuevas = []
+    
+    for fila in desactivadas:
+        invalidar_suscripcion(fila.numero_guia, fila.onesignal_user_id)
+    
+    for indice, suscripcion in nuevas:
+        _resultado(indice, "creada", 200, suscripcion=_respuesta_suscripcion(suscripcion, guias[suscripcion.numero_guia]))
+        invalidar_suscripcion(suscripcion.numero_guia, suscripcion.onesignal_user_id)
+    
+    if concurrentes:
+        resultado = await db.scalars(
+            select(Suscripcion).where(
+                Suscripcion.numero_guia.in_({s.numero_guia for _, s in concurrentes}),
+                Suscripcion.onesignal_user_id.in_({s.onesignal_user_id for _, s in concurrentes}),
+                Suscripcion.activo == True
+            )
+        )
+        activas = {(s.numero_guia, s.onesignal_user_id): s for s in resultado.all()}
+        for indice, suscripcion in concurrentes:
+            existente = activas.get((suscripcion.numero_guia, suscripcion.onesignal_user_id))
+            if existente:
+                _resultado(indice, "existente", 200, suscripcion=_respuesta_suscripcion(existente))
+            else:
+                _resultado(indice, "error", 409, detalle="Suscripcion modificada en paralelo, reintenta")
+    
+    for indice, original in duplicados:
+        anterior = resultados[original]
+        _resultado(
+            indice, "duplicada", anterior.status_code,
+            detalle=f"Repite el item {original} del lote",
+            suscripcion=anterior.suscripcion
+        )
+    
+    conteo = {"creada": 0, "existente": 0, "duplicada": 0, "rechazada": 0, "error": 0}
+    for r in resultados:
+        conteo[r.resultado] += 1
+    
+    logger.info(
+        "📦 Suscripcion en lote: recibidas=%s creadas=%s existentes=%s duplicadas=%s rechazadas=%s errores=%s",
+        len(items), conteo["creada"], conteo["existente"], conteo["duplicada"], conteo["rechazada"], conteo["error"]
+    )
+    
+    return SuscripcionLoteResponse(
+        recibidas=len(items),
+        creadas=conteo["creada"],
+        existentes=conteo["existente"],
+        duplicadas=conteo["duplicada"],
+        rechazadas=conteo["rechazada"],
+        errores=conteo["error"],
+        resultados=resultados
+    )
+
+@app.get("/api/suscripciones/{suscripcion_id}", response_model=SuscripcionResponse)
+async def obtener_suscripcion_por_id(suscripcion_id: int, db: AsyncSession = Depends(get_db)):
+    """
+    Estado de una suscripción por ID (activa o no); sirve para seguir una
+    suscripción aceptada con 202 hasta que se valide o se rechace
+    """
+    suscripcion = await db.get(Suscripcion, suscripcion_id)
+    if not suscripcion:
+        raise HTTPException(status_code=404, detail="Suscripcion no encontrada")
+    return _respuesta_suscripcion(suscripcion)
+
+@app.get("/api/suscripcion/{numero_guia}", response_model=SuscripcionResponse)
+async def obtener_estado_suscripcion(
+    numero_guia: str,
+    if_none_match: Optional[str] = Header(None),
+    sesion: SesionPerezosa = Depends(get_db_perezoso)
+):
+    entrada = cache_lectura.obtener(clave_guia(numero_guia))
+    if entrada:
+        return respuesta_cacheada(entrada, if_none_match)
+    
+    version = cache_lectura.version()
+    db = await sesion()
+    suscripcion = await db.scalar(
+        select(Suscripcion).where(
             Suscripcion.numero_guia == numero_guia,
             Suscripcion.activo == True
-        ).first()
-        
-        if not suscripcion:
-            raise HTTPException(status_code=404, detail="No se encontro suscripcion activa para esta guia")
-        
-        return SuscripcionResponse(
-            id=suscripcion.id,
-            numero_guia=suscripcion.numero_guia,
-            estado_actual=suscripcion.estado_actual,
-            origen=suscripcion.origen,
-            destino=suscripcion.destino,
-            fecha_creacion=suscripcion.fecha_creacion,
-            activo=suscripcion.activo,
-            proxima_verificacion=suscripcion.proxima_verificacion
-        )
-    finally:
-        db.close()
+        ).limit(1)
+    )
+    
+    if not suscripcion:
+        raise HTTPException(status_code=404, detail="No se encontro suscripcion activa para esta guia")
+    
+    respuesta = _respuesta_suscripcion(suscripcion)
+    entrada = cache_lectura.guardar(clave_guia(numero_guia), respuesta, version)
+    return respuesta_cacheada(entrada, if_none_match)
 
 @app.delete("/api/suscripcion/{numero_guia}")
-def cancelar_suscripcion(numero_guia: str):
-    db = SessionLocal()
-    try:
-        suscripcion = db.query(Suscripcion).filter(
+async def cancelar_suscripcion(numero_guia: str, db: AsyncSession = Depends(get_db)):
+    suscripcion = await db.scalar(
+        select(Suscripcion).where(
             Suscripcion.numero_guia == numero_guia,
             Suscripcion.activo == True
-        ).first()
+        ).limit(1)
+    )
+    
+    if not suscripcion:
+        raise HTTPException(status_code=404, detail="No se encontro suscripcion activa")
+    
+    suscripcion.activo = False
+    await ajustar_contadores(db, activas=-1)
+    await db.commit()
+    invalidar_suscripcion(suscripcion.numero_guia, suscripcion.onesignal_user_id)
+    
+    if agenda_verificaciones.activa:
+        # Sin más suscriptores activos la guía deja de verificarse
+        sigue_activa = await db.scalar(
+            select(Guia.id).where(Guia.id == suscripcion.guia_id, con_suscriptores_activos())
+        )
+        if not sigue_activa:
+            agenda_verificaciones.cancelar(suscripcion.guia_id)
+    
+    logger.info("Suscripcion cancelada: %s", numero_guia)
+    return {"mensaje": "Suscripcion cancelada exitosamente"}
+
+def _aplicar_estado_guia(
+    db: AsyncSession,
+    guia: Guia,
+    suscriptores: List[Suscripcion],
+    info_guia: dict,
+    ahora: datetime,
+    background_tasks: BackgroundTasks,
+    es_verificacion: bool = True
+) -> str:
+    """
+    Máquina de estados de una guía ante un estado nuevo
+    
+    Compartida por el verificador (polling) y el webhook de rastreo: registra
+    el historial, notifica la llegada y los hitos intermedios a cada
+    suscriptor activo, los desactiva en estados finales o reprograma la
+    próxima verificación. Si no llegó nada nuevo (mismo estado, sin eventos
+    nuevos en la trazabilidad) solo reprograma. No hace commit ni ajusta
+    contadores.
+    
+    Args:
+        db: Sesión donde se agrega el historial
+        guia: Guía a actualizar
+        suscriptores: Suscripciones activas de la guía
+        info_guia: Datos de la guía (estado_actual y, opcionalmente, trazabilidad)
+        ahora: Hora de referencia (UTC)
+        background_tasks: Pasa los push al controlador de envíos después del commit
+        es_verificacion: True si viene de una consulta a la API (cuenta como verificación)
+    
+    Returns:
+        "llegada" | "estado_final" | "reprogramada" | "sin_cambios"
+    """
+    estado_nuevo = info_guia.get('estado_actual', '')
+    estado_anterior = guia.estado_actual
+    trazabilidad = info_guia.get('trazabilidad')
+    
+    # Eventos nuevos desde la última consulta (None = resincronizada, sin eventos nuevos que notificar)
+    if trazabilidad is not None:
+        nuevos, guia.trazabilidad_eventos, guia.trazabilidad_huella = diferencia_trazabilidad(
+            trazabilidad, guia.trazabilidad_eventos or 0, guia.trazabilidad_huella
+        )
+    else:
+        nuevos = [{"detalle": estado_nuevo}] if estado_nuevo != estado_anterior else []
+    
+    guia.ultima_verificacion = ahora
+    if es_verificacion:
+        guia.verificaciones_realizadas = (guia.verificaciones_realizadas or 0) + 1
+    
+    sin_cambios = estado_nuevo == estado_anterior and not nuevos
+    
+    # Sin novedades no se escribe historial ni se evalúa llegada/hitos: solo se reprograma
+    if not sin_cambios:
+        db.add(HistorialVerificacion(
+            guia_id=guia.id,
+            estado_encontrado=estado_nuevo
+        ))
+        guia.estado_actual = estado_nuevo
+    
+    if not sin_cambios and guia_llego_a_destino(estado_nuevo):
+        logger.info("🎉 Guia %s llego a destino! Estado: %s", guia.numero_guia, estado_nuevo)
         
-        if not suscripcion:
-            raise HTTPException(status_code=404, detail="No se encontro suscripcion activa")
+        # ✅ AGREGAR DATOS DE OFICINA
+        nombre_oficina = extraer_nombre_oficina(estado_nuevo, guia.destino)
         
-        suscripcion.activo = False
-        db.commit()
+        for suscripcion in suscriptores:
+            background_tasks.add_task(
+                controlador_envios.encolar,
+                "llegada",
+                MensajePush(
+                    suscripcion.onesignal_user_id,
+                    "¡Tu encomienda llegó! 🎉",
+                    f"La guía {guia.numero_guia} ya está disponible para recoger en {nombre_oficina}",
+                    {
+                        "tipo": "llegada",
+                        "numero_guia": guia.numero_guia,
+                        "estado": estado_nuevo,
+                        "oficina_nombre": nombre_oficina,
+                        # La app Flutter completará coordenadas/dirección/horario con OficinasData
+                    },
+                    token_fcm=suscripcion.token_fcm
+                )
+            )
+            suscripcion.fecha_entrega = ahora
+            suscripcion.activo = False
         
-        logger.info(f"Suscripcion cancelada: {numero_guia}")
-        return {"mensaje": "Suscripcion cancelada exitosamente"}
-    finally:
-        db.close()
+        guia.fecha_entrega = ahora
+        guia.proxima_verificacion = None
+        
+        logger.debug(
+            "✅ %s notificaciones encoladas para %s (oficina %s)",
+            len(suscriptores), guia.numero_guia, nombre_oficina,
+            extra={"numero_guia": guia.numero_guia}
+        )
+        return "llegada"
+    
+    if not sin_cambios and not debe_continuar_verificando(estado_nuevo):
+        logger.info("⚠️ Guia %s en estado final: %s", guia.numero_guia, estado_nuevo)
+        for suscripcion in suscriptores:
+            suscripcion.activo = False
+        guia.proxima_verificacion = None
+        return "estado_final"
+    
+    if nuevos and NOTIFICAR_HITOS:
+        _notificar_hito(guia, suscriptores, nuevos, background_tasks)
+    
+    # La fecha de despacho se extrae de la trazabilidad una sola vez
+    if guia.fecha_despacho is None:
+        guia.fecha_despacho = extraer_fecha_despacho(info_guia.get('trazabilidad'))
+    proxima = calcular_proxima_verificacion(
+        estado_actual=estado_nuevo,
+        origen=guia.origen,
+        destino=guia.destino,
+        fecha_admision=guia.fecha_admision,
+        verificaciones_realizadas=guia.verificaciones_realizadas,
+        fecha_despacho=guia.fecha_despacho
+    )
+    guia.proxima_verificacion = proxima
+    logger.debug(
+        "📅 Guia %s: proxima verificacion en %s", guia.numero_guia, proxima,
+        extra={"numero_guia": guia.numero_guia}
+    )
+    return "sin_cambios" if sin_cambios else "reprogramada"
+
+def _notificar_hito(guia: Guia, suscriptores: List[Suscripcion], nuevos: List[dict], background_tasks: BackgroundTasks):
+    """
+    Encola a cada suscriptor una notificación por el hito intermedio más
+    reciente entre los eventos nuevos (solo uno por consulta, aunque se
+    hayan acumulado varios)
+    """
+    for evento in reversed(nuevos):
+        detalle = (evento.get('detalle') or '').upper()
+        for patron, tipo, titulo, mensaje in HITOS_INTERMEDIOS:
+            if patron in detalle:
+                texto = mensaje.format(guia=guia.numero_guia, destino=guia.destino or "su destino")
+                for suscripcion in suscriptores:
+                    background_tasks.add_task(
+                        controlador_envios.encolar,
+                        "informativa",
+                        MensajePush(
+                            suscripcion.onesignal_user_id,
+                            titulo,
+                            texto,
+                            {"tipo": tipo, "numero_guia": guia.numero_guia, "estado": evento.get('detalle')},
+                            token_fcm=suscripcion.token_fcm
+                        )
+                    )
+                HITOS_NOTIFICADOS.labels(tipo).inc(len(suscriptores))
+                logger.debug(
+                    "📍 Hito %s notificado para %s", tipo, guia.numero_guia,
+                    extra={"numero_guia": guia.numero_guia}
+                )
+                return
+
+async def _suscriptores_activos(db: AsyncSession, guia_ids: List[int]) -> dict:
+    """Suscripciones activas de varias guías en una sola consulta: {guia_id: [Suscripcion]}"""
+    por_guia = {}
+    if not guia_ids:
+        return por_guia
+    resultado = await db.scalars(
+        select(Suscripcion)
+        .where(Suscripcion.guia_id.in_(guia_ids), Suscripcion.activo == True)
+        .order_by(Suscripcion.id)
+    )
+    for suscripcion in resultado.all():
+        por_guia.setdefault(suscripcion.guia_id, []).append(suscripcion)
+    return por_guia
 
 @app.post("/api/verificar")
-async def verificar_guias(background_tasks: BackgroundTasks):
-    db = SessionLocal()
+async def verificar_guias(
+    background_tasks: BackgroundTasks,
+    perfilar_request: bool = Query(False, alias="perfilar"),
+    db: AsyncSession = Depends(get_db)
+):
     try:
-        ahora = datetime.now()
-        logger.info(f"🔍 Iniciando verificacion de guias: {ahora}")
-        
-        suscripciones = db.query(Suscripcion).filter(
-            Suscripcion.activo == True,
-            Suscripcion.proxima_verificacion <= ahora
-        ).all()
-        
-        logger.info(f"📦 Guias a verificar: {len(suscripciones)}")
-        
-        verificadas = 0
-        notificaciones_enviadas = 0
-        errores_timeout = 0
-        desactivadas_por_estado_final = 0
-        
-        for suscripcion in suscripciones:
+        async with perfilar("verificacion", perfilar_request) as perfil:
+            with span("verificacion") as traza:
+                respuesta = await _ejecutar_verificacion(background_tasks, db)
+        respuesta["tiempos"] = resumen_tiempos(traza)
+        if perfil:
+            respuesta["perfil"] = perfil
+        return respuesta
+    except Exception as e:
+        logger.error("❌ Error en verificacion: %s", e)
+        await db.rollback()
+        # Los lotes anteriores ya hicieron commit: sus push deben salir aunque falle este
+        return JSONResponse(status_code=500, content={"detail": str(e)}, background=background_tasks)
+
+async def _verificar_lote(
+    db: AsyncSession,
+    guias: List[Guia],
+    ahora: datetime,
+    background_tasks: BackgroundTasks
+) -> dict:
+    """
+    Verifica un lote de guías vencidas y hace commit
+    
+    Consultas en paralelo (acotadas), luego se aplican los resultados en
+    secuencia (AsyncSession no es concurrente). Lo usan el escaneo de
+    /api/verificar y el worker de la agenda.
+    
+    Returns:
+        Conteos del lote: verificadas, llegadas, finales, errores_timeout
+    """
+    semaforo = asyncio.Semaphore(VERIFICACION_CONCURRENCIA)
+    
+    async def consultar(numero_guia: str):
+        async with semaforo:
+            with span("rastreo.consultar_guia", numero_guia=numero_guia):
+                logger.debug("🔍 Consultando guia %s en API de rastreo...", numero_guia, extra={"numero_guia": numero_guia})
+                return await consultar_guia_rastreo(numero_guia)
+    
+    suscriptores = await _suscriptores_activos(db, [g.id for g in guias])
+    conteo = {"verificadas": 0, "llegadas": 0, "finales": 0, "errores_timeout": 0}
+    
+    with span("rastreo.consultas"):
+        respuestas = await asyncio.gather(
+            *(consultar(g.numero_guia) for g in guias),
+            return_exceptions=True
+        )
+    
+    with span("aplicar_resultados"):
+        for guia, info_guia in zip(guias, respuestas):
+            suscripciones = suscriptores.get(guia.id, [])
             try:
-                logger.info(f"🔍 Consultando guia {suscripcion.numero_guia} en API de rastreo...")
-                info_guia = consultar_guia_rastreo(suscripcion.numero_guia)
+                if isinstance(info_guia, Exception):
+                    raise info_guia
                 
                 if not info_guia:
-                    logger.warning(f"⚠️ No se pudo consultar guia {suscripcion.numero_guia}")
-                    suscripcion.proxima_verificacion = ahora + timedelta(hours=1)
-                    errores_timeout += 1
+                    logger.warning("⚠️ No se pudo consultar guia %s", guia.numero_guia)
+                    guia.proxima_verificacion = ahora + timedelta(hours=1)
+                    conteo["errores_timeout"] += 1
+                    RESULTADOS_VERIFICACION.labels("timeout").inc()
                     continue
                 
-                estado_anterior = suscripcion.estado_actual
-                estado_nuevo = info_guia.get('estado_actual', '')
+                if guia.estado_actual == ESTADO_PENDIENTE:
+                    # Suscripción rápida cuya validación en segundo plano no terminó
+                    rechazo = _completar_guia(guia, info_guia)
+                    if rechazo:
+                        await _rechazar_guia(db, guia, rechazo)
+                    RESULTADOS_VERIFICACION.labels("rechazada" if rechazo else "validada").inc()
+                    conteo["verificadas"] += 1
+                    continue
                 
-                historial = HistorialVerificacion(
-                    suscripcion_id=suscripcion.id,
-                    estado_encontrado=estado_nuevo
+                resultado_guia = _aplicar_estado_guia(
+                    db, guia, suscripciones, info_guia, ahora, background_tasks
                 )
-                db.add(historial)
-                
-                suscripcion.estado_actual = estado_nuevo
-                suscripcion.ultima_verificacion = ahora
-                
-                if guia_llego_a_destino(estado_nuevo):
-                    logger.info(f"🎉 Guia {suscripcion.numero_guia} llego a destino! Estado: {estado_nuevo}")
-                    
-                    # ✅ AGREGAR DATOS DE OFICINA
-                    nombre_oficina = extraer_nombre_oficina(estado_nuevo, suscripcion.destino)
-                    
-                    background_tasks.add_task(
-                        enviar_push_notification,
-                        suscripcion.onesignal_user_id,
-                        "¡Tu encomienda llegó! 🎉",
-                        f"La guía {suscripcion.numero_guia} ya está disponible para recoger en {nombre_oficina}",
-                        {
-                            "tipo": "llegada",
-                            "numero_guia": suscripcion.numero_guia,
-                            "estado": estado_nuevo,
-                            "oficina_nombre": nombre_oficina,
-                            # La app Flutter completará coordenadas/dirección/horario con OficinasData
-                        }
-                    )
-                    
-                    suscripcion.fecha_entrega = ahora
-                    suscripcion.proxima_verificacion = None
-                    suscripcion.activo = False
-                    notificaciones_enviadas += 1
-                    
-                    logger.info(f"✅ Notificación enviada para {suscripcion.numero_guia}")
-                    logger.info(f"🏢 Oficina destino: {nombre_oficina}")
-                
-                elif not debe_continuar_verificando(estado_nuevo):
-                    logger.info(f"⚠️ Guia {suscripcion.numero_guia} en estado final: {estado_nuevo}")
-                    suscripcion.activo = False
-                    suscripcion.proxima_verificacion = None
-                    desactivadas_por_estado_final += 1
-                
-                else:
-                    # ✅ CORRECCIÓN CRÍTICA: Pasar la trazabilidad
-                    proxima = calcular_proxima_verificacion(
-                        estado_actual=estado_nuevo,
-                        origen=suscripcion.origen,
-                        destino=suscripcion.destino,
-                        fecha_admision=suscripcion.fecha_admision,
-                        verificaciones_realizadas=suscripcion.verificaciones_realizadas + 1,
-                        trazabilidad=info_guia.get('trazabilidad')  # ← NUEVO
-                    )
-                    suscripcion.proxima_verificacion = proxima
-                    logger.info(f"📅 Proxima verificacion en: {proxima}")
+                RESULTADOS_VERIFICACION.labels(resultado_guia).inc()
+                if resultado_guia == "llegada":
+                    conteo["llegadas"] += len(suscripciones)
+                elif resultado_guia == "estado_final":
+                    conteo["finales"] += len(suscripciones)
                 
-                suscripcion.verificaciones_realizadas += 1
-                verificadas += 1
+                conteo["verificadas"] += 1
                 
             except Exception as e:
-                logger.error(f"❌ Error verificando {suscripcion.numero_guia}: {e}")
-                suscripcion.proxima_verificacion = ahora + timedelta(hours=1)
+                logger.error("❌ Error verificando %s: %s", guia.numero_guia, e)
+                guia.proxima_verificacion = ahora + timedelta(hours=1)
+                RESULTADOS_VERIFICACION.labels("error").inc()
                 continue
+    
+    with span("db.commit"):
+        # _rechazar_guia ya descontó sus activas
+        await ajustar_contadores(
+            db,
+            activas=-(conteo["llegadas"] + conteo["finales"]),
+            completadas=conteo["llegadas"]
+        )
+        await db.commit()
+    
+    # Todas las guías procesadas cambiaron (estado o próxima verificación)
+    _agendar(*guias)
+    for guia in guias:
+        invalidar_suscripcion(guia.numero_guia, None)
+        for suscripcion in suscriptores.get(guia.id, []):
+            invalidar_suscripcion(suscripcion.numero_guia, suscripcion.onesignal_user_id)
+    
+    return conteo
+
+async def _ejecutar_verificacion(background_tasks: BackgroundTasks, db: AsyncSession) -> dict:
+    """
+    Verifica las guías vencidas por lotes de VERIFICACION_TAMANO_LOTE (keyset por id)
+    
+    Una consulta a la API de rastreo por guía, sin importar cuántos
+    dispositivos la sigan; el resultado se aplica a todas sus suscripciones
+    activas. Cada lote hace su propio commit, para no retener filas ni
+    memoria de toda la ejecución.
+    """
+    ahora = ahora_reloj()
+    logger.info("🔍 Iniciando verificacion de guias: %s", ahora)
+    EJECUCIONES_VERIFICACION.inc()
+    
+    verificadas = 0
+    notificaciones_enviadas = 0
+    errores_timeout = 0
+    desactivadas_por_estado_final = 0
+    ultimo_id = 0
+    lotes = 0
+    
+    while True:
+        with span("db.consultar_pendientes"):
+            resultado = await db.scalars(
+                select(Guia).where(
+                    Guia.proxima_verificacion <= ahora,
+                    Guia.id > ultimo_id,
+                    con_suscriptores_activos()
+                )
+                .order_by(Guia.id)
+                .limit(VERIFICACION_TAMANO_LOTE)
+                .with_for_update(skip_locked=True)
+            )
+            guias = resultado.all()
         
-        db.commit()
+        if not guias:
+            break
         
-        limite_limpieza = ahora - timedelta(hours=48)
-        suscripciones_a_eliminar = db.query(Suscripcion.id).filter(
-            Suscripcion.fecha_entrega != None,
-            Suscripcion.fecha_entrega < limite_limpieza
-        ).all()
-        
-        ids_a_eliminar = [s.id for s in suscripciones_a_eliminar]
-        historial_eliminado = 0
-        suscripciones_eliminadas = 0
-        
-        if ids_a_eliminar:
-            historial_eliminado = db.query(HistorialVerificacion).filter(
-                HistorialVerificacion.suscripcion_id.in_(ids_a_eliminar)
-            ).delete(synchronize_session=False)
+        lotes += 1
+        ultimo_id = guias[-1].id
+        
+        with _reservar_guias([g.id for g in guias]) as reservadas:
+            propias = [g for g in guias if g.id in reservadas]
+            if len(propias) < len(guias):
+                logger.info("🗓️ Lote %s: %s guias ya en verificacion por la agenda, se omiten", lotes, len(guias) - len(propias))
+            logger.info("📦 Lote %s: %s guias a verificar", lotes, len(propias))
             
-            suscripciones_eliminadas = db.query(Suscripcion).filter(
-                Suscripcion.id.in_(ids_a_eliminar)
-            ).delete(synchronize_session=False)
+            with span("lote", numero=lotes, guias=len(propias)):
+                conteo = await _verificar_lote(db, propias, ahora, background_tasks)
         
-        db.commit()
+        verificadas += conteo["verificadas"]
+        notificaciones_enviadas += conteo["llegadas"]
+        desactivadas_por_estado_final += conteo["finales"]
+        errores_timeout += conteo["errores_timeout"]
         
-        logger.info(f"✅ Verificacion completada:")
-        logger.info(f"   - Verificadas: {verificadas}")
-        logger.info(f"   - Notificaciones enviadas: {notificaciones_enviadas}")
-        logger.info(f"   - Desactivadas (estado final): {desactivadas_por_estado_final}")
-        logger.info(f"   - Errores/Timeouts: {errores_timeout}")
-        logger.info(f"   - Historial eliminado: {historial_eliminado}")
-        logger.info(f"   - Suscripciones eliminadas: {suscripciones_eliminadas}")
+        if len(guias) < VERIFICACION_TAMANO_LOTE:
+            break
+    
+    with span("limpieza"):
+        limite_limpieza = ahora - timedelta(hours=48)
+        resultado = await db.execute(
+            delete(Suscripcion).where(
+                Suscripcion.fecha_entrega != None,
+                Suscripcion.fecha_entrega < limite_limpieza
+            )
+        )
+        suscripciones_eliminadas = resultado.rowcount
         
-        return {
-            "timestamp": ahora.isoformat(),
-            "guias_verificadas": verificadas,
-            "notificaciones_enviadas": notificaciones_enviadas,
-            "desactivadas_estado_final": desactivadas_por_estado_final,
-            "errores_timeout": errores_timeout,
-            "historial_eliminado": historial_eliminado,
-            "suscripciones_eliminadas": suscripciones_eliminadas
-        }
-    except Exception as e:
-        logger.error(f"❌ Error en verificacion: {e}")
-        db.rollback()
-        raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        db.close()
+        if suscripciones_eliminadas:
+            # Solo se eliminan guías entregadas (ya inactivas)
+            await ajustar_contadores(
+                db,
+                total_suscripciones=-suscripciones_eliminadas,
+                completadas=-suscripciones_eliminadas
+            )
+        
+        # Guías que ya no tienen ninguna suscripción (entregadas y limpiadas, o rechazadas)
+        huerfanas = (
+            select(Guia.id)
+            .where(~select(Suscripcion.id).where(Suscripcion.guia_id == Guia.id).exists())
+            .scalar_subquery()
+        )
+        resultado = await db.execute(
+            delete(HistorialVerificacion).where(HistorialVerificacion.guia_id.in_(huerfanas))
+        )
+        historial_eliminado = resultado.rowcount
+        resultado = await db.execute(delete(Guia).where(Guia.id.in_(huerfanas)))
+        guias_eliminadas = resultado.rowcount
+        
+        # Guías vencidas sin suscriptores activos (todas canceladas): dejan de
+        # programarse; si alguien se vuelve a suscribir se validan de nuevo
+        await db.execute(
+            update(Guia)
+            .where(Guia.proxima_verificacion <= ahora, ~con_suscriptores_activos())
+            .values(proxima_verificacion=None)
+            .execution_options(synchronize_session=False)
+        )
+        
+        resultado = await db.execute(
+            delete(ClaveIdempotencia).where(
+                ClaveIdempotencia.fecha_creacion < ahora - timedelta(hours=IDEMPOTENCIA_HORAS)
+            )
+        )
+        claves_eliminadas = resultado.rowcount
+        
+        # Registros vencidos: el próximo arranque de la app vuelve a pasar por OneSignal
+        resultado = await db.execute(
+            delete(Dispositivo).where(
+                Dispositivo.fecha_registro < ahora - timedelta(hours=DISPOSITIVO_REGISTRO_HORAS)
+            )
+        )
+        dispositivos_eliminados = resultado.rowcount
+        
+        await db.commit()
+    
+    logger.info(
+        "✅ Verificacion completada: lotes=%s verificadas=%s notificaciones=%s estado_final=%s "
+        "errores=%s historial_eliminado=%s suscripciones_eliminadas=%s guias_eliminadas=%s "
+        "claves_idempotencia_eliminadas=%s dispositivos_eliminados=%s",
+        lotes, verificadas, notificaciones_enviadas, desactivadas_por_estado_final,
+        errores_timeout, historial_eliminado, suscripciones_eliminadas, guias_eliminadas, claves_eliminadas,
+        dispositivos_eliminados
+    )
+    
+    return {
+        "timestamp": a_colombia(ahora).isoformat(),
+        "lotes": lotes,
+        "guias_verificadas": verificadas,
+        "notificaciones_enviadas": notificaciones_enviadas,
+        "desactivadas_estado_final": desactivadas_por_estado_final,
+        "errores_timeout": errores_timeout,
+        "historial_eliminado": historial_eliminado,
+        "suscripciones_eliminadas": suscripciones_eliminadas,
+        "guias_eliminadas": guias_eliminadas,
+        "claves_idempotencia_eliminadas": claves_eliminadas,
+        "dispositivos_eliminados": dispositivos_eliminados
+    }
 
-@app.get("/api/stats", response_model=EstadisticasResponse)
-def obtener_estadisticas():
-    db = SessionLocal()
+async def _cargar_agenda():
+    """Carga en la agenda las guías programadas que tienen suscriptores activos"""
+    async with AsyncSessionLocal() as db:
+        resultado = await db.execute(
+            select(Guia.id, Guia.proxima_verificacion).where(
+                Guia.proxima_verificacion != None,
+                con_suscriptores_activos()
+            )
+        )
+        agenda_verificaciones.cargar(resultado.all())
+    logger.info("🗓️ Agenda cargada: %s guias programadas", len(agenda_verificaciones))
+
+async def _verificar_agendadas(guia_ids: List[int]):
+    """
+    Worker de la agenda: verifica las guías que acaban de vencer
+    
+    Relee cada guía antes de verificarla: si otra instancia (o el cron) ya la
+    reprogramó se vuelve a agendar con su fecha real, y si ya no tiene
+    suscriptores activos sale de la agenda. Las que el cron está verificando
+    en ese momento se omiten: su lote las vuelve a agendar al terminar (o la
+    resincronización, si las bloqueó otra instancia).
+    """
+    ahora = ahora_reloj()
+    background_tasks = BackgroundTasks()
+    
+    with _reservar_guias(guia_ids) as reservadas:
+        if not reservadas:
+            return
+        async with AsyncSessionLocal() as db:
+            with span("agenda.verificacion", guias=len(reservadas)):
+                resultado = await db.scalars(
+                    select(Guia)
+                    .where(Guia.id.in_(reservadas), con_suscriptores_activos())
+                    .with_for_update(skip_locked=True)
+                )
+                vencidas = []
+                for guia in resultado.all():
+                    if guia.proxima_verificacion is not None and guia.proxima_verificacion <= ahora:
+                        vencidas.append(guia)
+                    else:
+                        _agendar(guia)
+                
+                if vencidas:
+                    conteo = await _verificar_lote(db, vencidas, ahora, background_tasks)
+                    logger.info(
+                        "🗓️ Agenda: verificadas=%s notificaciones=%s estado_final=%s errores=%s",
+                        conteo["verificadas"], conteo["llegadas"], conteo["finales"], conteo["errores_timeout"]
+                    )
+    
+    # Fuera de un request nadie corre las tareas en segundo plano (pushes)
+    await background_tasks()
+
+@app.post("/api/webhooks/rastreo")
+async def webhook_rastreo(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    x_rastreo_timestamp: Optional[str] = Header(None),
+    x_rastreo_firma: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Recibe cambios de estado empujados por el backend de rastreo
+    
+    Cuerpo: un evento {"numero_guia", "estado_actual", "trazabilidad"?} o un
+    lote {"eventos": [...]}. Firma: X-Rastreo-Firma = sha256=HMAC(secreto,
+    "<X-Rastreo-Timestamp>.<cuerpo>"). Cada evento pasa por la misma máquina
+    de estados que el verificador; las guías que siguen en tránsito posponen
+    su próxima verificación (el polling queda como respaldo).
+    """
+    if not WEBHOOK_RASTREO_SECRETO:
+        raise HTTPException(status_code=503, detail="Webhook de rastreo no configurado")
+    
+    cuerpo = await request.body()
+    if not firma_webhook_valida(
+        WEBHOOK_RASTREO_SECRETO, x_rastreo_timestamp, x_rastreo_firma, cuerpo, WEBHOOK_TOLERANCIA_SEGUNDOS
+    ):
+        logger.warning("🔒 Webhook de rastreo con firma invalida o vencida")
+        raise HTTPException(status_code=401, detail="Firma invalida")
+    
     try:
-        total = db.query(Suscripcion).count()
-        activas = db.query(Suscripcion).filter(Suscripcion.activo == True).count()
-        completadas = db.query(Suscripcion).filter(Suscripcion.fecha_entrega != None).count()
+        datos = json.loads(cuerpo)
+        if isinstance(datos, dict) and "eventos" in datos:
+            eventos = LoteEventosRastreo.model_validate(datos).eventos
+        else:
+            eventos = [EventoRastreo.model_validate(datos)]
+    except (ValueError, ValidationError) as e:
+        raise HTTPException(status_code=422, detail=f"Cuerpo invalido: {e}")
+    
+    if len(eventos) > WEBHOOK_MAX_EVENTOS:
+        raise HTTPException(status_code=413, detail=f"Maximo {WEBHOOK_MAX_EVENTOS} eventos por lote")
+    
+    ahora = ahora_reloj()
+    respaldo = ahora + timedelta(hours=WEBHOOK_HORAS_RESPALDO)
+    
+    # Una consulta para las guías del lote y otra para sus suscriptores activos.
+    # Las que está verificando /api/verificar o la agenda (filas bloqueadas en
+    # PostgreSQL o reservadas en este proceso) se omiten como "sin_cambios":
+    # esa verificación consulta el estado real
+    numeros = {e.numero_guia for e in eventos}
+    resultado = await db.scalars(
+        select(Guia)
+        .where(Guia.numero_guia.in_(numeros), con_suscriptores_activos())
+        .with_for_update(skip_locked=True)
+    )
+    encontradas = resultado.all()
+    
+    with _reservar_guias([g.id for g in encontradas]) as reservadas:
+        guias = {guia.numero_guia: guia for guia in encontradas if guia.id in reservadas}
+        ocupadas = {guia.numero_guia for guia in encontradas if guia.id not in reservadas}
+        faltantes = numeros - guias.keys() - ocupadas
+        if faltantes:
+            # SKIP LOCKED no distingue una guía bloqueada de una sin suscriptores
+            ocupadas |= set((await db.scalars(
+                select(Guia.numero_guia).where(Guia.numero_guia.in_(faltantes), con_suscriptores_activos())
+            )).all())
+        suscriptores = await _suscriptores_activos(db, [g.id for g in guias.values()])
         
-        ahora = datetime.now()
-        pendientes = db.query(Suscripcion).filter(
-            Suscripcion.activo == True,
-            Suscripcion.proxima_verificacion <= ahora
-        ).count()
+        conteo = {"llegada": 0, "estado_final": 0, "reprogramada": 0, "sin_cambios": 0, "pendiente": 0, "sin_suscripcion": 0}
+        notificadas = 0
+        desactivadas = 0
+        afectadas = {}
         
+        for evento in eventos:
+            if evento.numero_guia in ocupadas:
+                conteo["sin_cambios"] += 1
+                EVENTOS_WEBHOOK.labels("sin_cambios").inc()
+                continue
+            
+            guia = guias.get(evento.numero_guia)
+            # Los eventos se aplican en orden; una guía ya cerrada ignora los siguientes
+            suscripciones = [s for s in suscriptores.get(guia.id, []) if s.activo] if guia else []
+            if not suscripciones:
+                conteo["sin_suscripcion"] += 1
+                EVENTOS_WEBHOOK.labels("sin_suscripcion").inc()
+                continue
+            
+            if guia.estado_actual == ESTADO_PENDIENTE:
+                # Aún sin origen/destino: la validación en segundo plano trae el estado completo
+                conteo["pendiente"] += 1
+                EVENTOS_WEBHOOK.labels("pendiente").inc()
+                continue
+            
+            resultado_guia = _aplicar_estado_guia(
+                db, guia, suscripciones, evento.model_dump(), ahora, background_tasks, es_verificacion=False
+            )
+            if resultado_guia in ("reprogramada", "sin_cambios"):
+                guia.proxima_verificacion = max(guia.proxima_verificacion or respaldo, respaldo)
+            elif resultado_guia == "llegada":
+                notificadas += len(suscripciones)
+                desactivadas += len(suscripciones)
+            else:
+                desactivadas += len(suscripciones)
+            conteo[resultado_guia] += 1
+            EVENTOS_WEBHOOK.labels(resultado_guia).inc()
+            for suscripcion in suscripciones:
+                afectadas[suscripcion.id] = suscripcion
+        
+        await ajustar_contadores(db, activas=-desactivadas, completadas=notificadas)
+        await db.commit()
+        _agendar(*guias.values())
+    
+    for suscripcion in afectadas.values():
+        invalidar_suscripcion(suscripcion.numero_guia, suscripcion.onesignal_user_id)
+    
+    logger.info(
+        "📨 Webhook de rastreo: eventos=%s llegadas=%s estado_final=%s reprogramadas=%s pendientes=%s sin_suscripcion=%s",
+        len(eventos), conteo["llegada"], conteo["estado_final"], conteo["reprogramada"],
+        conteo["pendiente"], conteo["sin_suscripcion"]
+    )
+    
+    return {
+        "recibidos": len(eventos),
+        "suscripciones_actualizadas": len(afectadas),
+        "notificaciones_enviadas": notificadas,
+        "desactivadas_estado_final": desactivadas - notificadas,
+        "reprogramadas": conteo["reprogramada"],
+        "sin_cambios": conteo["sin_cambios"],
+        "pendientes": conteo["pendiente"],
+        "sin_suscripcion": conteo["sin_suscripcion"],
+    }
+
+async def _contar(db: AsyncSession, *condiciones) -> int:
+    """SELECT COUNT(*) sobre suscripciones (con su guía) con las condiciones dadas"""
+    consulta = select(func.count()).select_from(Suscripcion).outerjoin(Guia, Suscripcion.guia_id == Guia.id)
+    if condiciones:
+        consulta = consulta.where(*condiciones)
+    return await db.scalar(consulta)
+
+@app.get("/api/stats", response_model=EstadisticasResponse)
+async def obtener_estadisticas(
+    fuente: str = Query("consulta", pattern="^(consulta|contadores)$"),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Estadísticas generales
+    
+    - fuente=consulta: una sola pasada con COUNT(*) FILTER (exacto)
+    - fuente=contadores: contadores materializados (O(1)); solo las
+      verificaciones pendientes se cuentan con el índice de proxima_verificacion
+    
+    verificaciones_pendientes cuenta guías (una consulta por guía), no suscripciones.
+    """
+    ahora = ahora_reloj()
+    
+    if fuente == "contadores":
+        contadores = await leer_contadores(db)
+        pendientes, _ = (await db.execute(consulta_guias_pendientes(ahora))).one()
         return EstadisticasResponse(
-            total_suscripciones=total,
-            activas=activas,
-            completadas=completadas,
+            total_suscripciones=contadores.get("total_suscripciones", 0),
+            activas=contadores.get("activas", 0),
+            completadas=contadores.get("completadas", 0),
             verificaciones_pendientes=pendientes
         )
-    finally:
-        db.close()
+    
+    fila = (await db.execute(consulta_estadisticas(ahora))).one()
+    
+    return EstadisticasResponse(
+        total_suscripciones=fila.total_suscripciones,
+        activas=fila.activas,
+        completadas=fila.completadas,
+        verificaciones_pendientes=fila.verificaciones_pendientes
+    )
+
+@app.get("/api/stats/detalle")
+async def obtener_estadisticas_detalle(
+    max_rutas: int = Query(50, ge=1, le=500),
+    db: AsyncSession = Depends(get_db)
+):
+    """Suscripciones activas agrupadas por ruta (origen → destino) y por estado"""
+    por_ruta = await db.execute(
+        select(Guia.origen, Guia.destino, func.count().label("cantidad"))
+        .select_from(Suscripcion)
+        .join(Guia, Suscripcion.guia_id == Guia.id)
+        .where(Suscripcion.activo == True)
+        .group_by(Guia.origen, Guia.destino)
+        .order_by(func.count().desc())
+        .limit(max_rutas)
+    )
+    por_estado = await db.execute(
+        select(Guia.estado_actual, func.count().label("cantidad"))
+        .select_from(Suscripcion)
+        .join(Guia, Suscripcion.guia_id == Guia.id)
+        .where(Suscripcion.activo == True)
+        .group_by(Guia.estado_actual)
+        .order_by(func.count().desc())
+    )
+    
+    return {
+        "por_ruta": [
+            {"origen": fila.origen, "destino": fila.destino, "cantidad": fila.cantidad}
+            for fila in por_ruta
+        ],
+        "por_estado": [
+            {"estado": fila.estado_actual, "cantidad": fila.cantidad}
+            for fila in por_estado
+        ]
+    }
+
+@app.post("/api/admin/recalcular-contadores")
+async def recalcular_contadores_estadisticas(db: AsyncSession = Depends(get_db)):
+    """Recalcula los contadores materializados desde la tabla (endpoint administrativo)"""
+    valores = await recalcular_contadores(db)
+    logger.info("🔢 Contadores recalculados: %s", valores)
+    return valores
+
+@app.get("/metrics")
+async def metricas_prometheus(db: AsyncSession = Depends(get_db)):
+    """Métricas en formato Prometheus (backlog y pool se calculan en cada scrape)"""
+    ahora = ahora_reloj()
+    
+    pendientes, mas_antigua = (await db.execute(consulta_guias_pendientes(ahora))).one()
+    
+    VERIFICACIONES_PENDIENTES.set(pendientes)
+    ATRASO_MAXIMO.set((ahora - mas_antigua).total_seconds() if mas_antigua else 0)
+    GUIAS_AGENDADAS.set(len(agenda_verificaciones))
+    
+    pool = obtener_metricas_pool()
+    POOL_EN_USO.set(pool.get("en_uso", 0))
+    POOL_OVERFLOW.set(pool.get("overflow", 0))
+    
+    return Response(content=generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
 
 @app.get("/api/health")
 def health_check():
@@ -661,117 +1956,341 @@ def health_check():
     
     return {
         "status": "ok",
-        "timestamp": datetime.now().isoformat(),
+        "timestamp": a_colombia(ahora_reloj()).isoformat(),
         "version": "1.0.0",
         "database": "postgresql",
-        "onesignal": onesignal_status
+        "onesignal": onesignal_status,
+        "proveedor_push": controlador_envios.proveedor.nombre
     }
 
 @app.get("/api/suscripciones/user/{onesignal_user_id}")
-def obtener_suscripciones_por_usuario(onesignal_user_id: str):
+async def obtener_suscripciones_por_usuario(
+    onesignal_user_id: str,
+    if_none_match: Optional[str] = Header(None),
+    sesion: SesionPerezosa = Depends(get_db_perezoso)
+):
     """Obtiene todas las suscripciones activas de un usuario"""
-    db = SessionLocal()
+    entrada = cache_lectura.obtener(clave_usuario(onesignal_user_id))
+    if entrada:
+        return respuesta_cacheada(entrada, if_none_match)
+    
+    version = cache_lectura.version()
+    db = await sesion()
     try:
-        suscripciones = db.query(Suscripcion).filter(
-            Suscripcion.onesignal_user_id == onesignal_user_id,
-            Suscripcion.activo == True
-        ).all()
+        resultado_consulta = await db.scalars(
+            select(Suscripcion).where(
+                Suscripcion.onesignal_user_id == onesignal_user_id,
+                Suscripcion.activo == True
+            )
+        )
+        suscripciones = resultado_consulta.all()
         
         resultado = []
         for s in suscripciones:
             resultado.append({
                 "numero_guia": s.numero_guia,
-                "estado_actual": s.estado_actual,
-                "origen": s.origen,
-                "destino": s.destino,
-                "fecha_creacion": s.fecha_creacion.isoformat() if s.fecha_creacion else None,
-                "proxima_verificacion": s.proxima_verificacion.isoformat() if s.proxima_verificacion else None,
+                "estado_actual": s.guia.estado_actual,
+                "origen": s.guia.origen,
+                "destino": s.guia.destino,
+                "fecha_creacion": a_colombia(s.fecha_creacion).isoformat() if s.fecha_creacion else None,
+                "proxima_verificacion": a_colombia(s.guia.proxima_verificacion).isoformat() if s.guia.proxima_verificacion else None,
             })
         
-        logger.info(f"📋 Usuario {onesignal_user_id}: {len(resultado)} suscripciones activas")
-        return resultado
+        logger.debug("📋 Usuario %s: %s suscripciones activas", onesignal_user_id, len(resultado))
+        entrada = cache_lectura.guardar(clave_usuario(onesignal_user_id), resultado, version)
+        return respuesta_cacheada(entrada, if_none_match)
         
     except Exception as e:
-        logger.error(f"❌ Error consultando suscripciones de usuario: {e}")
+        logger.error("❌ Error consultando suscripciones de usuario: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        db.close()
+
+# Solo las columnas que muestra el listado administrativo (sin cargar objetos ORM)
+COLUMNAS_ADMIN = (
+    Suscripcion.id,
+    Suscripcion.numero_guia,
+    Suscripcion.onesignal_user_id,
+    Guia.estado_actual,
+    Suscripcion.fecha_creacion,
+    Guia.proxima_verificacion,
+)
+
+def _consulta_pagina_admin(despues_de_id: int, limite: int):
+    """Página por keyset: filas activas con id > cursor, ordenadas por id"""
+    return (
+        select(*COLUMNAS_ADMIN)
+        .outerjoin(Guia, Suscripcion.guia_id == Guia.id)
+        .where(Suscripcion.activo == True, Suscripcion.id > despues_de_id)
+        .order_by(Suscripcion.id)
+        .limit(limite)
+    )
+
+def _fila_admin(fila) -> dict:
+    return {
+        "id": fila.id,
+        "numero_guia": fila.numero_guia,
+        "onesignal_user_id": fila.onesignal_user_id,
+        "estado_actual": fila.estado_actual,
+        "fecha_creacion": a_colombia(fila.fecha_creacion).isoformat() if fila.fecha_creacion else None,
+        "proxima_verificacion": a_colombia(fila.proxima_verificacion).isoformat() if fila.proxima_verificacion else None,
+    }
+
+async def _stream_ndjson_admin(despues_de_id: int, tamano_lote: int):
+    """
+    Genera una línea JSON por suscripción activa, consultando por lotes
+    Usa su propia sesión: la del request puede cerrarse antes de terminar el stream
+    """
+    cursor = despues_de_id
+    async with AsyncSessionLocal() as db:
+        while True:
+            filas = (await db.execute(_consulta_pagina_admin(cursor, tamano_lote))).all()
+            if not filas:
+                break
+            
+            yield "".join(json.dumps(_fila_admin(fila), ensure_ascii=False) + "\n" for fila in filas)
+            cursor = filas[-1].id
+            # Liberar la conexión entre lotes para no retener el pool
+            await db.commit()
 
 @app.get("/api/admin/ver-suscripciones")
-def ver_todas_suscripciones():
-    """Ver todas las suscripciones activas (endpoint administrativo)"""
-    db = SessionLocal()
+async def ver_todas_suscripciones(
+    limite: int = Query(500, ge=1, le=5000),
+    despues_de_id: int = Query(0, ge=0),
+    formato: str = Query("json", pattern="^(json|ndjson)$"),
+    incluir_total: bool = False,
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Ver suscripciones activas (endpoint administrativo)
+    
+    - formato=json: una página de `limite` filas; usar `siguiente_cursor`
+      como `despues_de_id` para pedir la siguiente
+    - formato=ndjson: todas las filas desde el cursor, en streaming por
+      lotes de `limite` (memoria constante)
+    """
+    if formato == "ndjson":
+        logger.info("📊 Streaming NDJSON de suscripciones activas desde id %s", despues_de_id)
+        # El stream abre su propia sesión: devolver ya la conexión de este request
+        await db.close()
+        return StreamingResponse(
+            _stream_ndjson_admin(despues_de_id, limite),
+            media_type="application/x-ndjson"
+        )
+    
+    filas = (await db.execute(_consulta_pagina_admin(despues_de_id, limite))).all()
+    resultado = [_fila_admin(fila) for fila in filas]
+    
+    logger.info("📊 Consultando suscripciones activas: %s desde id %s", len(resultado), despues_de_id)
+    
+    respuesta = {
+        "cantidad": len(resultado),
+        "siguiente_cursor": resultado[-1]["id"] if len(resultado) == limite else None,
+        "suscripciones": resultado
+    }
+    
+    if incluir_total:
+        respuesta["total_activas"] = await _contar(db, Suscripcion.activo == True)
+    
+    return respuesta
+
+@app.get("/api/admin/pool")
+def ver_pool_conexiones():
+    """Estado del pool de conexiones a la base de datos (endpoint administrativo)"""
+    return obtener_metricas_pool()
+
+@app.get("/api/admin/perfiles")
+def ver_perfiles():
+    """Reportes de perfilado disponibles (endpoint administrativo)"""
+    return {"perfiles": listar_perfiles()}
+
+@app.get("/api/admin/perfiles/{nombre}")
+def descargar_perfil(nombre: str):
+    """Descarga un reporte de perfilado (.txt, .prof o .html)"""
+    ruta = ruta_perfil(nombre)
+    if not ruta:
+        raise HTTPException(status_code=404, detail="Perfil no encontrado")
+    return FileResponse(ruta, filename=nombre)
+
+@app.get("/api/admin/cache")
+def ver_cache_lectura():
+    """Aciertos, fallos e invalidaciones de la caché de lectura (endpoint administrativo)"""
+    return cache_lectura.estadisticas()
+
+@app.get("/api/admin/envios")
+def ver_controlador_envios():
+    """Push en cola por carril y pausa por 429 del controlador de envíos (endpoint administrativo)"""
+    return controlador_envios.estadisticas()
+
+@app.get("/api/admin/agenda")
+def ver_agenda():
+    """Guías en la agenda en memoria, próxima fecha y disparos del worker (endpoint administrativo)"""
+    return agenda_verificaciones.estadisticas()
+
+async def _desactivar_en_lotes(
+    db: AsyncSession,
+    condiciones: list,
+    tamano_lote: int,
+    tamano_muestra: int = 20
+) -> dict:
+    """
+    Desactiva por lotes las suscripciones activas que cumplen las condiciones
+    
+    Cada lote es un único UPDATE ... WHERE id IN (SELECT ... LIMIT n) RETURNING
+    con commit propio, para no bloquear la tabla en operaciones grandes.
+    RETURNING entrega guía y usuario para invalidar la caché con precisión.
+    
+    Returns:
+        Resumen: total desactivadas, lotes, conteo por estado y una muestra de guías
+    """
+    desactivadas = 0
+    lotes = 0
+    por_estado = {}
+    muestra = []
+    
+    while True:
+        ids_lote = (
+            select(Suscripcion.id)
+            .outerjoin(Guia, Suscripcion.guia_id == Guia.id)
+            .where(Suscripcion.activo == True, *condiciones)
+            .order_by(Suscripcion.id)
+            .limit(tamano_lote)
+            .scalar_subquery()
+        )
+        resultado = await db.execute(
+            update(Suscripcion)
+            .where(Suscripcion.id.in_(ids_lote))
+            .values(activo=False)
+            .returning(Suscripcion.numero_guia, Suscripcion.onesignal_user_id, Suscripcion.guia_id)
+            .execution_options(synchronize_session=False)
+        )
+        filas = resultado.all()
+        estados = dict((await db.execute(
+            select(Guia.id, Guia.estado_actual).where(Guia.id.in_({fila.guia_id for fila in filas}))
+        )).all()) if filas else {}
+        await ajustar_contadores(db, activas=-len(filas))
+        await db.commit()
+        
+        if not filas:
+            break
+        
+        lotes += 1
+        desactivadas += len(filas)
+        for fila in filas:
+            invalidar_suscripcion(fila.numero_guia, fila.onesignal_user_id)
+            estado = estados.get(fila.guia_id) or "SIN ESTADO"
+            por_estado[estado] = por_estado.get(estado, 0) + 1
+            if len(muestra) < tamano_muestra:
+                muestra.append(fila.numero_guia)
+        
+        if len(filas) < tamano_lote:
+            break
+    
+    return {
+        "desactivadas": desactivadas,
+        "lotes": lotes,
+        "por_estado": por_estado,
+        "muestra_guias": muestra
+    }
+
+def _condiciones_operacion(filtros: OperacionMasivaRequest) -> list:
+    """Traduce los filtros de una operación masiva a condiciones SQL"""
+    condiciones = []
+    
+    if filtros.creadas_hace_mas_de_horas is not None:
+        limite = ahora_reloj() - timedelta(hours=filtros.creadas_hace_mas_de_horas)
+        condiciones.append(Suscripcion.fecha_creacion < limite)
+    if filtros.onesignal_user_id:
+        condiciones.append(Suscripcion.onesignal_user_id == filtros.onesignal_user_id)
+    if filtros.excluir_onesignal_user_id:
+        condiciones.append(Suscripcion.onesignal_user_id != filtros.excluir_onesignal_user_id)
+    if filtros.estado:
+        condiciones.append(Guia.estado_actual.ilike(f"%{filtros.estado}%"))
+    if filtros.origen:
+        condiciones.append(Guia.origen.ilike(f"%{filtros.origen}%"))
+    if filtros.destino:
+        condiciones.append(Guia.destino.ilike(f"%{filtros.destino}%"))
+    
+    return condiciones
+
+@app.post("/api/admin/operaciones/desactivar")
+async def desactivar_suscripciones_masivo(
+    filtros: OperacionMasivaRequest,
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Desactiva en bloque las suscripciones activas que cumplen los filtros (endpoint administrativo)
+    
+    Con dry_run=true solo cuenta las coincidencias y devuelve una muestra
+    """
+    condiciones = _condiciones_operacion(filtros)
+    
+    if not condiciones:
+        raise HTTPException(
+            status_code=400,
+            detail="Debe indicar al menos un filtro (antigüedad, usuario, estado u origen/destino)"
+        )
+    
     try:
-        suscripciones = db.query(Suscripcion).filter(
-            Suscripcion.activo == True
-        ).all()
+        inicio = time.perf_counter()
         
-        resultado = []
-        for s in suscripciones:
-            resultado.append({
-                "id": s.id,
-                "numero_guia": s.numero_guia,
-                "onesignal_user_id": s.onesignal_user_id,
-                "estado_actual": s.estado_actual,
-                "fecha_creacion": s.fecha_creacion.isoformat() if s.fecha_creacion else None,
-                "proxima_verificacion": s.proxima_verificacion.isoformat() if s.proxima_verificacion else None,
-            })
+        if filtros.dry_run:
+            coincidencias = await _contar(db, Suscripcion.activo == True, *condiciones)
+            muestra = await db.scalars(
+                select(Suscripcion.numero_guia)
+                .outerjoin(Guia, Suscripcion.guia_id == Guia.id)
+                .where(Suscripcion.activo == True, *condiciones)
+                .order_by(Suscripcion.id)
+                .limit(20)
+            )
+            logger.info("🧪 Dry-run desactivación masiva: %s coincidencias", coincidencias)
+            return {
+                "dry_run": True,
+                "coincidencias": coincidencias,
+                "muestra_guias": muestra.all()
+            }
         
-        logger.info(f"📊 Consultando suscripciones activas: {len(resultado)}")
+        resumen = await _desactivar_en_lotes(db, condiciones, filtros.tamano_lote)
+        duracion = time.perf_counter() - inicio
+        
+        logger.info(
+            "🧹 Desactivación masiva: %s en %s lotes (%.2fs)",
+            resumen["desactivadas"], resumen["lotes"], duracion
+        )
         
         return {
-            "total_activas": len(resultado),
-            "suscripciones": resultado
+            "dry_run": False,
+            **resumen,
+            "duracion_segundos": round(duracion, 3)
         }
-    finally:
-        db.close()
+    except Exception as e:
+        logger.error("❌ Error en desactivación masiva: %s", e)
+        await db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/admin/limpiar-suscripciones")
-def limpiar_suscripciones_antiguas(user_id_actual: str):
-    """Desactiva suscripciones antiguas (endpoint administrativo)"""
-    db = SessionLocal()
+async def limpiar_suscripciones_antiguas(user_id_actual: str, db: AsyncSession = Depends(get_db)):
+    """Desactiva las suscripciones de otros usuarios (endpoint administrativo)"""
     try:
-        logger.info(f"🧹 Limpiando suscripciones antiguas...")
-        logger.info(f"✅ Mantener activas: User ID = {user_id_actual}")
-        
-        total_antes = db.query(Suscripcion).filter(Suscripcion.activo == True).count()
-        
-        suscripciones_antiguas = db.query(Suscripcion).filter(
-            Suscripcion.activo == True,
-            Suscripcion.onesignal_user_id != user_id_actual
-        ).all()
-        
-        desactivadas = []
-        for suscripcion in suscripciones_antiguas:
-            desactivadas.append({
-                "guia": suscripcion.numero_guia,
-                "user_id": suscripcion.onesignal_user_id,
-                "estado": suscripcion.estado_actual
-            })
-            suscripcion.activo = False
-        
-        db.commit()
+        logger.info("🧹 Limpiando suscripciones antiguas...")
+        logger.info("✅ Mantener activas: User ID = %s", user_id_actual)
         
-        total_despues = db.query(Suscripcion).filter(Suscripcion.activo == True).count()
+        resumen = await _desactivar_en_lotes(
+            db,
+            [Suscripcion.onesignal_user_id != user_id_actual],
+            tamano_lote=1000
+        )
         
-        logger.info(f"✅ Limpieza completada:")
-        logger.info(f"   - Antes: {total_antes} activas")
-        logger.info(f"   - Desactivadas: {len(desactivadas)}")
-        logger.info(f"   - Después: {total_despues} activas")
+        logger.info(
+            "✅ Limpieza completada: %s desactivadas en %s lotes", resumen['desactivadas'], resumen['lotes']
+        )
         
         return {
             "mensaje": "Limpieza exitosa",
-            "antes": total_antes,
-            "desactivadas": len(desactivadas),
-            "despues": total_despues,
-            "detalle_desactivadas": desactivadas
+            **resumen
         }
     except Exception as e:
-        logger.error(f"❌ Error en limpieza: {e}")
-        db.rollback()
+        logger.error("❌ Error en limpieza: %s", e)
+        await db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        db.close()
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,142 @@
+"""
+Métricas Prometheus del pipeline de verificación
+
+Se exponen en GET /metrics. Los histogramas y contadores se actualizan en
+el camino caliente (costo: una suma bajo lock); los gauges de backlog se
+calculan solo cuando Prometheus hace scrape.
+"""
+
+import time
+
+from prometheus_client import Counter, Gauge, Histogram
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Buckets pensados para llamadas HTTP externas (la API de rastreo puede tardar 15 s)
+_BUCKETS_HTTP = (0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 8, 12, 15, 20)
+_BUCKETS_DB = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+LATENCIA_RASTREO = Histogram(
+    "rastreo_consulta_segundos",
+    "Latencia de consultar_guia_rastreo",
+    ["resultado"],
+    buckets=_BUCKETS_HTTP,
+)
+
+LATENCIA_PUSH = Histogram(
+    "push_envio_segundos",
+    "Latencia de las peticiones al proveedor de push",
+    ["proveedor", "resultado"],
+    buckets=_BUCKETS_HTTP,
+)
+
+RESULTADOS_VERIFICACION = Counter(
+    "verificacion_guias_total",
+    "Guías procesadas por el verificador según resultado",
+    ["resultado"],  # llegada | estado_final | reprogramada | sin_cambios | validada | rechazada | timeout | error
+)
+
+EVENTOS_WEBHOOK = Counter(
+    "webhook_rastreo_eventos_total",
+    "Eventos recibidos por el webhook de rastreo según resultado",
+    ["resultado"],  # llegada | estado_final | reprogramada | sin_cambios | pendiente | sin_suscripcion
+)
+
+SUSCRIPCIONES_LOTE = Counter(
+    "suscripciones_lote_items_total",
+    "Items procesados por /api/suscribir/lote según resultado",
+    ["resultado"],  # creada | existente | duplicada | rechazada | error
+)
+
+REGISTROS_DISPOSITIVO = Counter(
+    "registros_dispositivo_total",
+    "Registros de dispositivos según resultado",
+    ["resultado"],  # registrado | existente | duplicado | error
+)
+
+HITOS_NOTIFICADOS = Counter(
+    "hitos_notificados_total",
+    "Notificaciones de hitos intermedios encoladas",
+    ["tipo"],  # despacho | transito
+)
+
+EJECUCIONES_VERIFICACION = Counter(
+    "verificacion_ejecuciones_total",
+    "Ejecuciones de /api/verificar",
+)
+
+VERIFICACIONES_PENDIENTES = Gauge(
+    "verificaciones_pendientes",
+    "Guías con suscriptores activos y proxima_verificacion vencida",
+)
+
+ATRASO_MAXIMO = Gauge(
+    "verificacion_atraso_maximo_segundos",
+    "Segundos desde la proxima_verificacion vencida más antigua",
+)
+
+COLA_PUSH = Gauge(
+    "push_cola_profundidad",
+    "Push encolados pendientes de envío",
+    ["carril"],  # llegada | informativa
+)
+
+PUSH_ENVIOS = Counter(
+    "push_envios_total",
+    "Push enviados por el controlador de envíos",
+    ["carril", "resultado"],  # resultado: enviado | fallido
+)
+
+PUSH_DESCARTADOS = Counter(
+    "push_descartados_total",
+    "Push descartados sin enviar",
+    ["carril", "motivo"],  # motivo: cola_llena | reintentos_agotados
+)
+
+PUSH_LIMITADOS = Counter(
+    "push_429_total",
+    "Respuestas 429 (cuota excedida) del proveedor de push",
+)
+
+GUIAS_AGENDADAS = Gauge(
+    "agenda_guias",
+    "Guías en la agenda en memoria del worker de verificación",
+)
+
+LATENCIA_DB = Histogram(
+    "db_consulta_segundos",
+    "Duración de sentencias SQL",
+    ["operacion"],  # SELECT | INSERT | UPDATE | DELETE | OTRA
+    buckets=_BUCKETS_DB,
+)
+
+POOL_EN_USO = Gauge("db_pool_conexiones_en_uso", "Conexiones del pool en uso")
+POOL_OVERFLOW = Gauge("db_pool_overflow", "Conexiones abiertas por encima del tamaño del pool")
+
+_OPERACIONES_SQL = ("SELECT", "INSERT", "UPDATE", "DELETE")
+
+
+def _operacion_sql(sentencia: str) -> str:
+    operacion = sentencia.lstrip()[:6].upper()
+    return operacion if operacion in _OPERACIONES_SQL else "OTRA"
+
+
+def instrumentar_engine(engine: Engine):
+    """
+    Registra la duración de cada sentencia SQL ejecutada por el motor
+    
+    El inicio se guarda en el contexto de ejecución (uno por sentencia), no
+    en la conexión: si la sentencia falla after_cursor_execute no corre y el
+    contexto simplemente se descarta, sin acumular nada en conexiones del pool.
+    """
+    
+    @event.listens_for(engine, "before_cursor_execute")
+    def _antes(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._inicio_sql = time.perf_counter()
+    
+    @event.listens_for(engine, "after_cursor_execute")
+    def _despues(conn, cursor, statement, parameters, context, executemany):
+        inicio = getattr(context, "_inicio_sql", None)
+        if inicio is not None:
+            LATENCIA_DB.labels(_operacion_sql(statement)).observe(time.perf_counter() - inicio)
@@ -0,0 +1,143 @@
+"""
+Perfilado opcional de ejecuciones del verificador y de /api/suscribir
+
+Se activa para todas las ejecuciones con PERFILADO_ACTIVO=true, o para una
+sola con el query param ?perfilar=true si PERFILADO_PERMITIR_PARAMETRO=true
+(desactivado por defecto: el parámetro llega por endpoints públicos). Los
+reportes quedan en PERFILES_DIR y se descargan desde /api/admin/perfiles.
+
+Motores (PERFILADO_MOTOR):
+    cprofile     (por defecto) reporte de texto + archivo .prof para snakeviz
+    pyinstrument muestreo, reporte HTML (requiere `pip install pyinstrument`)
+
+Solo se perfila una ejecución a la vez: cProfile mide el hilo completo y
+dos perfiles simultáneos se pisarían. Los reportes se escriben en un hilo
+(asyncio.to_thread) para no bloquear el event loop.
+"""
+
+import asyncio
+import cProfile
+import io
+import logging
+import os
+import pstats
+import re
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import List, Optional
+
+from reloj import a_colombia
+
+logger = logging.getLogger(__name__)
+
+PERFILADO_ACTIVO = os.environ.get("PERFILADO_ACTIVO", "false").lower() == "true"
+PERFILADO_PERMITIR_PARAMETRO = os.environ.get("PERFILADO_PERMITIR_PARAMETRO", "false").lower() == "true"
+PERFILADO_MOTOR = os.environ.get("PERFILADO_MOTOR", "cprofile").lower()
+PERFILES_DIR = os.environ.get("PERFILES_DIR", "perfiles")
+PERFILES_MAX = int(os.environ.get("PERFILES_MAX", "20"))
+
+_NOMBRE_VALIDO = re.compile(r"^[\w.-]+$")
+
+_perfil_en_curso = False
+
+
+def _debe_perfilar(solicitado: bool) -> bool:
+    return PERFILADO_ACTIVO or (solicitado and PERFILADO_PERMITIR_PARAMETRO)
+
+
+def _rotar_perfiles():
+    """Conserva solo los PERFILES_MAX reportes más recientes"""
+    reportes = sorted(listar_perfiles(), key=lambda p: p["modificado"], reverse=True)
+    for reporte in reportes[PERFILES_MAX:]:
+        os.remove(os.path.join(PERFILES_DIR, reporte["nombre"]))
+
+
+def _guardar(nombre: str, contenido, binario: bool = False):
+    ruta = os.path.join(PERFILES_DIR, nombre)
+    with open(ruta, "wb" if binario else "w", encoding=None if binario else "utf-8") as archivo:
+        archivo.write(contenido)
+
+
+def _guardar_cprofile(perfilador: cProfile.Profile, base: str):
+    texto = io.StringIO()
+    pstats.Stats(perfilador, stream=texto).sort_stats("cumulative").print_stats(60)
+    _guardar(f"{base}.txt", texto.getvalue())
+    perfilador.dump_stats(os.path.join(PERFILES_DIR, f"{base}.prof"))
+
+
+@asynccontextmanager
+async def perfilar(etiqueta: str, solicitado: bool = False):
+    """
+    Perfila el bloque si está activado globalmente o se solicitó
+    
+    Example:
+        async with perfilar("verificacion", perfilar_param):
+            ...
+    """
+    global _perfil_en_curso
+    
+    if not _debe_perfilar(solicitado):
+        yield None
+        return
+    
+    if _perfil_en_curso:
+        logger.warning("⚠️ Ya hay un perfilado en curso, se omite el de %s", etiqueta)
+        yield None
+        return
+    
+    await asyncio.to_thread(os.makedirs, PERFILES_DIR, exist_ok=True)
+    base = f"{datetime.now():%Y%m%d_%H%M%S_%f}_{etiqueta}"
+    _perfil_en_curso = True
+    
+    try:
+        if PERFILADO_MOTOR == "pyinstrument":
+            from pyinstrument import Profiler
+            
+            perfilador = Profiler(async_mode="enabled")
+            perfilador.start()
+            try:
+                yield base
+            finally:
+                perfilador.stop()
+                await asyncio.to_thread(lambda: _guardar(f"{base}.html", perfilador.output_html()))
+        else:
+            perfilador = cProfile.Profile()
+            perfilador.enable()
+            try:
+                yield base
+            finally:
+                perfilador.disable()
+                await asyncio.to_thread(_guardar_cprofile, perfilador, base)
+        
+        logger.info("🧪 Perfil guardado: %s", base)
+        await asyncio.to_thread(_rotar_perfiles)
+    finally:
+        _perfil_en_curso = False
+
+
+def listar_perfiles() -> List[dict]:
+    """Reportes disponibles, del más reciente al más antiguo"""
+    if not os.path.isdir(PERFILES_DIR):
+        return []
+    
+    reportes = []
+    for nombre in os.listdir(PERFILES_DIR):
+        ruta = os.path.join(PERFILES_DIR, nombre)
+        if os.path.isfile(ruta):
+            info = os.stat(ruta)
+            reportes.append({
+                "nombre": nombre,
+                "bytes": info.st_size,
+                "modificado": a_colombia(datetime.fromtimestamp(info.st_mtime, tz=timezone.utc)).isoformat(),
+            })
+    
+    return sorted(reportes, key=lambda r: r["modificado"], reverse=True)
+
+
+def ruta_perfil(nombre: str) -> Optional[str]:
+    """Ruta del reporte solicitado (None si no existe o el nombre no es válido)"""
+    if not _NOMBRE_VALIDO.match(nombre):
+        return None
+    
+    ruta = os.path.join(PERFILES_DIR, nombre)
+    return ruta if os.path.isfile(ruta) else None
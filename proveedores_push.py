@@ -0,0 +1,385 @@
+"""
+Proveedores de notificaciones push intercambiables
+
+El controlador de envíos (envios.py) arma lotes de MensajePush y se los pasa
+al proveedor elegido con PUSH_PROVEEDOR; ni el verificador ni el controlador
+saben a quién le hablan:
+
+- onesignal: API REST v1 (include_player_ids). Los mensajes de un lote con el
+  mismo contenido salen en una sola petición
+- fcm: Firebase Cloud Messaging HTTP v1 directo al token_fcm de la suscripción.
+  FCM v1 acepta un mensaje por petición, así que el lote sale en peticiones
+  concurrentes (requiere `pip install google-auth` o FCM_TOKEN_ACCESO)
+- memoria: guarda los mensajes en una lista (pruebas y benchmarks sin red)
+- archivo: agrega cada mensaje como una línea JSON a PUSH_ARCHIVO
+"""
+
+import asyncio
+import json
+import logging
+import re
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, Hashable, List, Optional, Tuple
+
+import httpx
+
+from config import (
+    ONESIGNAL_API_KEY, ONESIGNAL_APP_ID, ONESIGNAL_API_URL,
+    PUSH_PROVEEDOR, PUSH_ARCHIVO, FCM_PROYECTO, FCM_CREDENCIALES, FCM_TOKEN_ACCESO, FCM_API_URL
+)
+from metricas import LATENCIA_PUSH
+from reloj import ahora
+from utils import obtener_cliente_http
+
+logger = logging.getLogger(__name__)
+
+PLAYER_ID_REGEX = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$', re.IGNORECASE)
+
+
+class CuotaProveedorExcedida(Exception):
+    """El proveedor respondió 429; reintentar_en viene del header Retry-After (segundos) si lo envió"""
+    
+    def __init__(self, reintentar_en: Optional[float] = None):
+        super().__init__(f"Proveedor push 429 (Retry-After: {reintentar_en})")
+        self.reintentar_en = reintentar_en
+
+
+def _segundos_retry_after(valor: Optional[str]) -> Optional[float]:
+    """Header Retry-After en segundos; la variante con fecha HTTP se ignora (None)"""
+    try:
+        return max(float(valor), 0) if valor else None
+    except ValueError:
+        return None
+
+
+class MensajePush:
+    """Un push dirigido a un suscriptor (cada proveedor usa el identificador que le sirve)"""
+    
+    __slots__ = ("onesignal_user_id", "titulo", "mensaje", "datos_extra", "token_fcm")
+    
+    def __init__(
+        self,
+        onesignal_user_id: str,
+        titulo: str,
+        mensaje: str,
+        datos_extra: Optional[dict] = None,
+        token_fcm: Optional[str] = None
+    ):
+        self.onesignal_user_id = onesignal_user_id
+        self.titulo = titulo
+        self.mensaje = mensaje
+        self.datos_extra = datos_extra
+        self.token_fcm = token_fcm
+    
+    def como_dict(self) -> dict:
+        return {
+            "onesignal_user_id": self.onesignal_user_id,
+            "titulo": self.titulo,
+            "mensaje": self.mensaje,
+            "datos_extra": self.datos_extra,
+        }
+
+
+class ProveedorPush(ABC):
+    """
+    Interfaz de un proveedor de push (un proveedor sin enviar_lote no se puede instanciar)
+    
+    enviar_lote devuelve un resultado por mensaje, en el mismo orden:
+    True (enviado), False (fallido, no se reintenta) o una instancia de
+    CuotaProveedorExcedida (el controlador pausa y lo vuelve a encolar).
+    """
+    
+    nombre = "base"
+    # Máximo de mensajes que el controlador junta en un lote
+    max_lote = 1
+    
+    def clave_peticion(self, mensaje: MensajePush) -> Hashable:
+        """Mensajes con la misma clave salen en la misma petición (por defecto, una por mensaje)"""
+        return mensaje
+    
+    def solicitudes(self, mensajes: List[MensajePush]) -> int:
+        """Peticiones que consume el lote (fichas de la cuota por segundo)"""
+        return len({self.clave_peticion(m) for m in mensajes})
+    
+    @abstractmethod
+    async def enviar_lote(self, mensajes: List[MensajePush]) -> list:
+        """Envía el lote; un resultado por mensaje (ver la clase)"""
+
+
+# ============ ONESIGNAL ============
+
+class ProveedorOneSignal(ProveedorPush):
+    """API REST v1 de OneSignal con include_player_ids (hasta 2000 por petición)"""
+    
+    nombre = "onesignal"
+    max_lote = 2000
+    
+    def clave_peticion(self, mensaje: MensajePush) -> Tuple[str, str, str]:
+        """Contenido idéntico comparte petición (include_player_ids)"""
+        return (
+            mensaje.titulo, mensaje.mensaje,
+            json.dumps(mensaje.datos_extra or {}, sort_keys=True, default=str)
+        )
+    
+    def _agrupar(self, mensajes: List[MensajePush]) -> Dict[Tuple[str, str, str], List[int]]:
+        """Índices de los mensajes agrupados por contenido idéntico"""
+        grupos: Dict[Tuple[str, str, str], List[int]] = {}
+        for i, m in enumerate(mensajes):
+            grupos.setdefault(self.clave_peticion(m), []).append(i)
+        return grupos
+    
+    async def enviar_lote(self, mensajes: List[MensajePush]) -> list:
+        resultados: list = [False] * len(mensajes)
+        if not ONESIGNAL_API_KEY or not ONESIGNAL_APP_ID:
+            logger.warning("⚠️ OneSignal no configurado")
+            return resultados
+        
+        peticiones = []
+        for indices in self._agrupar(mensajes).values():
+            validos = []
+            for i in indices:
+                player_id = (mensajes[i].onesignal_user_id or "").strip()
+                if not PLAYER_ID_REGEX.match(player_id):
+                    logger.warning("⚠️ Player ID con formato inválido: %s", player_id)
+                    continue
+                validos.append(i)
+            if validos:
+                peticiones.append(validos)
+        
+        respuestas = await asyncio.gather(*(
+            self._enviar_grupo([mensajes[i] for i in indices]) for indices in peticiones
+        ))
+        for indices, por_mensaje in zip(peticiones, respuestas):
+            for i, resultado in zip(indices, por_mensaje):
+                resultados[i] = resultado
+        return resultados
+    
+    async def _enviar_grupo(self, mensajes: List[MensajePush]) -> list:
+        """Una petición para varios Player IDs con el mismo contenido"""
+        primero = mensajes[0]
+        player_ids = [m.onesignal_user_id.strip() for m in mensajes]
+        logger.debug("📲 Enviando push OneSignal '%s' a %s player(s)", primero.titulo, len(player_ids))
+        
+        headers = {
+            "Authorization": f"Basic {ONESIGNAL_API_KEY}",
+            "Content-Type": "application/json; charset=utf-8"
+        }
+        
+        # ✅ CRÍTICO: Usar include_player_ids para API V1 (include_aliases causaba error)
+        payload = {
+            "app_id": ONESIGNAL_APP_ID,
+            "include_player_ids": player_ids,
+            "headings": {"en": primero.titulo},
+            "contents": {"en": primero.mensaje},
+            "priority": 10
+        }
+        if primero.datos_extra:
+            payload["data"] = primero.datos_extra
+        
+        inicio = time.perf_counter()
+        resultado = "error"
+        try:
+            response = await obtener_cliente_http().post(
+                f"{ONESIGNAL_API_URL}/notifications",
+                json=payload,
+                headers=headers,
+                timeout=10
+            )
+            
+            if response.status_code == 429:
+                resultado = "limitado"
+                cuota = CuotaProveedorExcedida(_segundos_retry_after(response.headers.get("Retry-After")))
+                return [cuota] * len(mensajes)
+            
+            result = response.json()
+            
+            if response.status_code != 200:
+                resultado = "http_error"
+                logger.error("❌ Error HTTP al enviar push: %s - %s", response.status_code, result)
+                return [False] * len(mensajes)
+            
+            if result.get("recipients", 0) <= 0:
+                resultado = "sin_destinatarios"
+                logger.debug("OneSignal sin recipients: %s", result)
+                return [False] * len(mensajes)
+            
+            resultado = "ok"
+            logger.info(
+                "✅ Push enviado (recipients=%s, id=%s)",
+                result.get("recipients"), result.get("id", "N/A")
+            )
+            errores = result.get("errors")
+            invalidos = set(errores.get("invalid_player_ids", [])) if isinstance(errores, dict) else set()
+            return [player_id not in invalidos for player_id in player_ids]
+        
+        except httpx.TimeoutException:
+            resultado = "timeout"
+            logger.error("❌ Timeout al enviar notificación OneSignal")
+            return [False] * len(mensajes)
+        except Exception as e:
+            logger.error("❌ Error enviando push: %s", e)
+            return [False] * len(mensajes)
+        finally:
+            LATENCIA_PUSH.labels(self.nombre, resultado).observe(time.perf_counter() - inicio)
+
+
+# ============ FIREBASE CLOUD MESSAGING ============
+
+class ProveedorFCM(ProveedorPush):
+    """
+    FCM HTTP v1 (projects/{proyecto}/messages:send), un mensaje por petición
+    
+    El token OAuth sale de la cuenta de servicio FCM_CREDENCIALES (google-auth)
+    o, si está definido, de FCM_TOKEN_ACCESO (stubs o token gestionado afuera).
+    """
+    
+    nombre = "fcm"
+    max_lote = 500
+    
+    _SCOPE = "https://www.googleapis.com/auth/firebase.messaging"
+    
+    def __init__(self, proyecto: str, credenciales: str, api_url: str, token_acceso: str = ""):
+        self.url = f"{api_url}/projects/{proyecto}/messages:send"
+        self.credenciales = credenciales
+        self.token_acceso = token_acceso
+        self._credenciales_google = None
+        if not proyecto:
+            logger.warning("⚠️ FCM no configurado - falta FCM_PROYECTO")
+    
+    async def _token(self) -> str:
+        if self.token_acceso:
+            return self.token_acceso
+        if self._credenciales_google is None:
+            from google.oauth2 import service_account
+            
+            self._credenciales_google = service_account.Credentials.from_service_account_file(
+                self.credenciales, scopes=[self._SCOPE]
+            )
+        if not self._credenciales_google.valid:
+            from google.auth.transport.requests import Request
+            
+            # refresh() hace I/O bloqueante: fuera del event loop
+            await asyncio.to_thread(self._credenciales_google.refresh, Request())
+        return self._credenciales_google.token
+    
+    async def enviar_lote(self, mensajes: List[MensajePush]) -> list:
+        try:
+            token = await self._token()
+        except Exception as e:
+            logger.error("❌ No se pudo obtener el token de FCM: %s", e)
+            return [False] * len(mensajes)
+        return list(await asyncio.gather(*(self._enviar(m, token) for m in mensajes)))
+    
+    async def _enviar(self, mensaje: MensajePush, token: str):
+        if not mensaje.token_fcm:
+            logger.debug("Suscripción sin token FCM: %s", mensaje.onesignal_user_id)
+            return False
+        
+        payload = {
+            "message": {
+                "token": mensaje.token_fcm,
+                "notification": {"title": mensaje.titulo, "body": mensaje.mensaje},
+                # FCM solo acepta strings en data
+                "data": {clave: str(valor) for clave, valor in (mensaje.datos_extra or {}).items()},
+                "android": {"priority": "high"},
+            }
+        }
+        
+        inicio = time.perf_counter()
+        resultado = "error"
+        try:
+            response = await obtener_cliente_http().post(
+                self.url,
+                json=payload,
+                headers={"Authorization": f"Bearer {token}"},
+                timeout=10
+            )
+            if response.status_code == 429:
+                resultado = "limitado"
+                return CuotaProveedorExcedida(_segundos_retry_after(response.headers.get("Retry-After")))
+            if response.status_code == 401:
+                # Token vencido: el siguiente lote lo renueva
+                self._credenciales_google = None
+            if response.status_code != 200:
+                resultado = "http_error"
+                logger.error("❌ Error HTTP al enviar push FCM: %s - %s", response.status_code, response.text[:200])
+                return False
+            resultado = "ok"
+            return True
+        except httpx.TimeoutException:
+            resultado = "timeout"
+            logger.error("❌ Timeout al enviar notificación FCM")
+            return False
+        except Exception as e:
+            logger.error("❌ Error enviando push FCM: %s", e)
+            return False
+        finally:
+            LATENCIA_PUSH.labels(self.nombre, resultado).observe(time.perf_counter() - inicio)
+
+
+# ============ SUMIDEROS LOCALES ============
+
+class ProveedorMemoria(ProveedorPush):
+    """Guarda los mensajes en `enviados` (pruebas y benchmarks sin red)"""
+    
+    nombre = "memoria"
+    max_lote = 1000
+    
+    def __init__(self):
+        self.enviados: List[MensajePush] = []
+    
+    def clave_peticion(self, mensaje: MensajePush) -> Hashable:
+        return self.nombre
+    
+    async def enviar_lote(self, mensajes: List[MensajePush]) -> list:
+        self.enviados.extend(mensajes)
+        return [True] * len(mensajes)
+
+
+class ProveedorArchivo(ProveedorPush):
+    """Agrega cada mensaje como una línea JSON al archivo (el token FCM no se escribe)"""
+    
+    nombre = "archivo"
+    max_lote = 1000
+    
+    def __init__(self, ruta: str):
+        self.ruta = ruta
+    
+    def clave_peticion(self, mensaje: MensajePush) -> Hashable:
+        return self.nombre
+    
+    def _escribir(self, lineas: List[str]):
+        with open(self.ruta, "a", encoding="utf-8") as archivo:
+            archivo.writelines(lineas)
+    
+    async def enviar_lote(self, mensajes: List[MensajePush]) -> list:
+        fecha = ahora().isoformat()
+        lineas = [
+            json.dumps({"fecha": fecha, **m.como_dict()}, ensure_ascii=False, default=str) + "\n"
+            for m in mensajes
+        ]
+        try:
+            await asyncio.to_thread(self._escribir, lineas)
+        except OSError as e:
+            logger.error("❌ No se pudo escribir %s: %s", self.ruta, e)
+            return [False] * len(mensajes)
+        return [True] * len(mensajes)
+
+
+def crear_proveedor(nombre: str = PUSH_PROVEEDOR) -> ProveedorPush:
+    """
+    Instancia el proveedor configurado
+    
+    Raises:
+        ValueError: Si el nombre no corresponde a ningún proveedor
+    """
+    if nombre == "onesignal":
+        return ProveedorOneSignal()
+    if nombre == "fcm":
+        return ProveedorFCM(FCM_PROYECTO, FCM_CREDENCIALES, FCM_API_URL, FCM_TOKEN_ACCESO)
+    if nombre == "memoria":
+        return ProveedorMemoria()
+    if nombre == "archivo":
+        return ProveedorArchivo(PUSH_ARCHIVO)
+    raise ValueError(f"PUSH_PROVEEDOR desconocido: {nombre} (onesignal | fcm | memoria | archivo)")
@@ -0,0 +1,95 @@
+"""
+Reloj inyectable del planificador y el verificador
+
+Todo el código que decide *cuándo* verificar una guía lee la hora con
+`ahora()` en lugar de `datetime.now()`. En producción es el reloj del
+sistema; en simulaciones y benchmarks se reemplaza por un `RelojSimulado`
+que avanza a voluntad, de modo que una semana de verificaciones se
+reproduce en segundos.
+
+Modelo de tiempo: todas las fechas internas y en base de datos son
+`datetime` con zona UTC, sin importar la zona del servidor. La hora de
+Colombia solo aparece en los bordes: al leer las fechas de la API de
+rastreo (hora local sin zona) y al responder a la app.
+"""
+
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Iterator
+from zoneinfo import ZoneInfo
+
+ZONA_COLOMBIA = ZoneInfo("America/Bogota")
+
+
+def a_colombia(momento: datetime) -> datetime:
+    """Convierte una fecha UTC (o con cualquier zona) a hora de Colombia"""
+    return momento.astimezone(ZONA_COLOMBIA)
+
+
+def desde_hora_colombia(momento: datetime) -> datetime:
+    """Interpreta una fecha local sin zona (p. ej. de la API de rastreo) como hora Colombia y la pasa a UTC"""
+    return momento.replace(tzinfo=ZONA_COLOMBIA).astimezone(timezone.utc)
+
+
+class Reloj:
+    """Reloj del sistema (UTC con zona)"""
+    
+    def ahora(self) -> datetime:
+        return datetime.now(timezone.utc)
+
+
+class RelojSimulado(Reloj):
+    """
+    Reloj que solo avanza cuando se le indica (fechas UTC con zona)
+    
+    Example:
+        with reloj_simulado(datetime(2025, 10, 1, 11, 0, tzinfo=timezone.utc)) as reloj:
+            reloj.avanzar(timedelta(hours=2))
+    """
+    
+    def __init__(self, inicio: datetime):
+        if inicio.tzinfo is None:
+            raise ValueError("El reloj simulado necesita una fecha con zona horaria")
+        self._actual = inicio.astimezone(timezone.utc)
+    
+    def ahora(self) -> datetime:
+        return self._actual
+    
+    def fijar(self, momento: datetime):
+        if momento < self._actual:
+            raise ValueError(f"El reloj simulado no retrocede ({momento} < {self._actual})")
+        self._actual = momento
+    
+    def avanzar(self, delta: timedelta):
+        self.fijar(self._actual + delta)
+
+
+_reloj_actual: Reloj = Reloj()
+
+
+def ahora() -> datetime:
+    """Hora actual (UTC con zona) según el reloj activo"""
+    return _reloj_actual.ahora()
+
+
+def usar_reloj(reloj: Reloj) -> Reloj:
+    """
+    Instala un reloj global
+    
+    Returns:
+        El reloj anterior (para restaurarlo)
+    """
+    global _reloj_actual
+    anterior, _reloj_actual = _reloj_actual, reloj
+    return anterior
+
+
+@contextmanager
+def reloj_simulado(inicio: datetime) -> Iterator[RelojSimulado]:
+    """Instala un RelojSimulado durante el bloque y restaura el anterior al salir"""
+    reloj = RelojSimulado(inicio)
+    anterior = usar_reloj(reloj)
+    try:
+        yield reloj
+    finally:
+        usar_reloj(anterior)
@@ -0,0 +1,81 @@
+"""
+Configuración común de las pruebas
+
+Pone la raíz del repositorio en sys.path (los módulos son planos, como en
+benchmarks/) y apunta DATABASE_URL a un SQLite temporal ANTES de que
+alguna prueba importe config/database. Los push van al proveedor en
+memoria y la API de rastreo se reemplaza por RastreoFalso.
+
+Las pruebas asíncronas usan el plugin de anyio (pytest.mark.anyio).
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+
+import httpx
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault(
+    "DATABASE_URL",
+    f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='pruebas_'), 'pruebas.db')}"
+)
+os.environ.setdefault("LOG_ASINCRONO", "false")
+os.environ.setdefault("PUSH_PROVEEDOR", "memoria")
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+class RastreoFalso:
+    """API de rastreo en memoria: estado por guía (ADMITIDA si no se fijó) y consultas hechas"""
+    
+    def __init__(self):
+        self.estados = {}
+        self.consultas = []
+        self.espera = 0.0
+    
+    async def consultar(self, numero_guia: str) -> dict:
+        self.consultas.append(numero_guia)
+        if self.espera:
+            await asyncio.sleep(self.espera)
+        return {
+            "estado_actual": self.estados.get(numero_guia, "ADMITIDA"),
+            "origen": "MEDELLIN (ANTIOQUIA)",
+            "destino": "BOGOTA",
+            "fecha_admision": "2025/10/03 13:07",
+            "trazabilidad": [{"detalle": "ADMITIDA", "fecha": "2025/10/03 13:07"}],
+        }
+
+
+@pytest.fixture
+def rastreo(monkeypatch):
+    import main
+    import utils
+    
+    falso = RastreoFalso()
+    monkeypatch.setattr(utils, "consultar_guia_rastreo", falso.consultar)
+    monkeypatch.setattr(main, "consultar_guia_rastreo", falso.consultar)
+    return falso
+
+
+@pytest.fixture
+async def cliente(rastreo):
+    """Cliente HTTP contra la app, con el startup y el shutdown de FastAPI"""
+    import main
+    
+    await main.startup_event()
+    # Tras el dispose() del shutdown anterior, dos primeras conexiones
+    # simultáneas al pool recreado se bloquean (SQLAlchemy 2.0): una antes
+    async with main.async_engine.connect():
+        pass
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://pruebas") as c:
+            yield c
+    finally:
+        await main.shutdown_event()
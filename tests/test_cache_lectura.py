@@ -0,0 +1,93 @@
+"""
+Caché de lectura de GET /api/suscripcion/{numero_guia}: ETag/304, invalidación
+al escribir y llenados que compiten con una escritura
+"""
+
+import pytest
+from sqlalchemy import update
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import main
+from cache import cache_lectura, invalidar_suscripcion
+from database import SessionLocal, Suscripcion
+
+pytestmark = pytest.mark.anyio
+
+
+async def _suscribir(cliente, numero_guia: str, usuario: str):
+    respuesta = await cliente.post("/api/suscribir", json={"numero_guia": numero_guia, "onesignal_user_id": usuario})
+    assert respuesta.status_code == 200
+
+
+async def test_etag_304_e_invalidacion_al_cancelar(cliente):
+    await _suscribir(cliente, "CACHE-1", "usuario-cache-1")
+    
+    primera = await cliente.get("/api/suscripcion/CACHE-1")
+    etag = primera.headers["ETag"]
+    assert primera.status_code == 200 and primera.json()["activo"] is True
+    
+    aciertos = cache_lectura.aciertos
+    no_modificada = await cliente.get("/api/suscripcion/CACHE-1", headers={"If-None-Match": etag})
+    assert no_modificada.status_code == 304
+    assert no_modificada.content == b""
+    assert cache_lectura.aciertos == aciertos + 1
+    
+    otra_version = await cliente.get("/api/suscripcion/CACHE-1", headers={"If-None-Match": '"otra"'})
+    assert otra_version.status_code == 200 and otra_version.headers["ETag"] == etag
+    
+    assert (await cliente.delete("/api/suscripcion/CACHE-1")).status_code == 200
+    
+    # La cancelación invalidó la entrada: nada de 200 ni 304 con la versión vieja
+    assert (await cliente.get("/api/suscripcion/CACHE-1")).status_code == 404
+    assert (await cliente.get("/api/suscripcion/CACHE-1", headers={"If-None-Match": etag})).status_code == 404
+
+
+async def test_escritura_entre_fallo_y_llenado_no_deja_dato_viejo(cliente, monkeypatch):
+    await _suscribir(cliente, "CACHE-2", "usuario-cache-2")
+    original = main._respuesta_suscripcion
+    
+    def cancelar_durante_la_lectura(suscripcion, guia=None):
+        # Ya se leyó la fila activa; otra petición cancela y hace commit antes del llenado
+        with SessionLocal() as db:
+            db.execute(update(Suscripcion).where(Suscripcion.id == suscripcion.id).values(activo=False))
+            db.commit()
+        invalidar_suscripcion(suscripcion.numero_guia, suscripcion.onesignal_user_id)
+        monkeypatch.setattr(main, "_respuesta_suscripcion", original)
+        return original(suscripcion, guia)
+    
+    monkeypatch.setattr(main, "_respuesta_suscripcion", cancelar_durante_la_lectura)
+    descartadas = cache_lectura.descartadas
+    
+    # La lectura que compitió responde lo que leyó, pero no lo guarda
+    assert (await cliente.get("/api/suscripcion/CACHE-2")).status_code == 200
+    assert cache_lectura.descartadas == descartadas + 1
+    assert (await cliente.get("/api/suscripcion/CACHE-2")).status_code == 404
+
+
+async def test_resuscribir_invalida_lectura_por_usuario(cliente):
+    await _suscribir(cliente, "CACHE-3", "usuario-cache-3")
+    antes = (await cliente.get("/api/suscripciones/user/usuario-cache-3")).json()
+    
+    await _suscribir(cliente, "CACHE-4", "usuario-cache-3")
+    despues = (await cliente.get("/api/suscripciones/user/usuario-cache-3")).json()
+    
+    assert [s["numero_guia"] for s in antes] == ["CACHE-3"]
+    assert sorted(s["numero_guia"] for s in despues) == ["CACHE-3", "CACHE-4"]
+
+
+async def test_pool_saturado_responde_503_solo_sin_cache(cliente, monkeypatch):
+    await _suscribir(cliente, "CACHE-4", "usuario-cache-4")
+    assert (await cliente.get("/api/suscripcion/CACHE-4")).status_code == 200
+    
+    async def sin_conexiones(self, *args, **kwargs):
+        raise PoolTimeoutError("QueuePool limit reached")
+    
+    monkeypatch.setattr(AsyncSession, "connection", sin_conexiones)
+    
+    # Un acierto no toca el pool; un fallo (o get_db) responde 503, no 500
+    assert (await cliente.get("/api/suscripcion/CACHE-4")).status_code == 200
+    fallo = await cliente.get("/api/suscripcion/CACHE-OTRA")
+    assert fallo.status_code == 503
+    assert "saturada" in fallo.json()["detail"]
+    assert (await cliente.delete("/api/suscripcion/CACHE-4")).status_code == 503
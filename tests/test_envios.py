@@ -0,0 +1,115 @@
+"""
+Controlador de envíos push: carriles de prioridad, cuota por segundo y pausa ante 429
+"""
+
+import logging
+import time
+
+import pytest
+
+from envios import ControladorEnvios
+from proveedores_push import CuotaProveedorExcedida, MensajePush, ProveedorPush
+
+pytestmark = pytest.mark.anyio
+
+
+class ProveedorFalso(ProveedorPush):
+    """Registra cada petición; las primeras `limitadas` responden 429 con Retry-After"""
+    
+    nombre = "falso"
+    
+    def __init__(self, limitadas: int = 0, retry_after: float = 0.0, max_lote: int = 1):
+        self.limitadas = limitadas
+        self.retry_after = retry_after
+        self.max_lote = max_lote
+        self.peticiones = []
+        self.enviados = []
+    
+    async def enviar_lote(self, mensajes):
+        self.peticiones.append((time.monotonic(), [m.mensaje for m in mensajes]))
+        if self.limitadas:
+            self.limitadas -= 1
+            return [CuotaProveedorExcedida(self.retry_after)] * len(mensajes)
+        self.enviados.extend(m.mensaje for m in mensajes)
+        return [True] * len(mensajes)
+
+
+def _controlador(proveedor, tasa: float = 1000, concurrencia: int = 1, tamano_lote: int = 1):
+    return ControladorEnvios(
+        proveedor, tasa_por_segundo=tasa, concurrencia=concurrencia,
+        max_cola=100, max_reintentos=3, tamano_lote=tamano_lote
+    )
+
+
+def _push(texto: str) -> MensajePush:
+    return MensajePush(f"usuario-{texto}", "Titulo", texto)
+
+
+async def _terminar(controlador: ControladorEnvios):
+    assert await controlador.vaciar(espera_maxima=5)
+    # Cada get() tuvo su task_done(): join() terminó y no queda nada sin contar
+    assert controlador._cola._unfinished_tasks == 0
+    assert controlador._cola.empty()
+    await controlador.detener()
+
+
+async def test_llegadas_salen_antes_que_informativas():
+    proveedor = ProveedorFalso()
+    controlador = _controlador(proveedor)
+    
+    # encolar no cede el loop: el worker arranca con las seis ya en la cola
+    for i in range(3):
+        await controlador.encolar("informativa", _push(f"info-{i}"))
+    for i in range(3):
+        await controlador.encolar("llegada", _push(f"llegada-{i}"))
+    await _terminar(controlador)
+    
+    assert proveedor.enviados == [
+        "llegada-0", "llegada-1", "llegada-2", "info-0", "info-1", "info-2"
+    ]
+
+
+async def test_429_pausa_y_reencola_sin_perder_push(caplog):
+    proveedor = ProveedorFalso(limitadas=2, retry_after=0.3)
+    controlador = _controlador(proveedor)
+    
+    with caplog.at_level(logging.WARNING, logger="envios"):
+        await controlador.encolar("informativa", _push("info"))
+        for i in range(3):
+            await controlador.encolar("llegada", _push(f"llegada-{i}"))
+        await _terminar(controlador)
+    
+    momentos = [momento for momento, _ in proveedor.peticiones]
+    # Dos 429 seguidos: cada uno pausa Retry-After antes de la petición siguiente
+    assert momentos[1] - momentos[0] >= 0.29
+    assert momentos[2] - momentos[1] >= 0.29
+    # Nada se descarta y el limitado conserva su prioridad
+    assert sorted(proveedor.enviados) == ["info", "llegada-0", "llegada-1", "llegada-2"]
+    assert proveedor.enviados[-1] == "info"
+    assert controlador.enviados == 4 and controlador.fallidos == 0
+    assert not [r for r in caplog.records if r.levelno >= logging.ERROR]
+    assert sum("429" in r.getMessage() for r in caplog.records) == 2
+
+
+async def test_cubeta_de_fichas_limita_peticiones_por_segundo():
+    proveedor = ProveedorFalso()
+    controlador = _controlador(proveedor, tasa=10, concurrencia=4, tamano_lote=5)
+    
+    for i in range(20):
+        await controlador.encolar("llegada", _push(f"llegada-{i}"))
+    await _terminar(controlador)
+    
+    momentos = sorted(momento for momento, _ in proveedor.peticiones)
+    assert len(proveedor.enviados) == 20
+    # Una petición por push: 10 con la cubeta llena y las otras 10 a 10 por segundo
+    assert len(proveedor.peticiones) == 20
+    assert sum(1 for m in momentos if m - momentos[0] < 0.05) <= 10
+    assert 0.85 <= momentos[-1] - momentos[0] < 2
+
+
+def test_proveedor_sin_enviar_lote_falla_al_construirse():
+    class ProveedorIncompleto(ProveedorPush):
+        nombre = "incompleto"
+    
+    with pytest.raises(TypeError):
+        ProveedorIncompleto()
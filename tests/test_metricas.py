@@ -0,0 +1,32 @@
+"""
+Instrumentación de latencia SQL (metricas.instrumentar_engine)
+"""
+
+import pytest
+from prometheus_client import REGISTRY
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+
+from metricas import instrumentar_engine
+
+
+def _observaciones(operacion: str) -> float:
+    return REGISTRY.get_sample_value("db_consulta_segundos_count", {"operacion": operacion}) or 0
+
+
+def test_sentencias_fallidas_no_acumulan_estado_en_la_conexion():
+    engine = create_engine("sqlite://")
+    instrumentar_engine(engine)
+    antes = _observaciones("SELECT")
+    
+    with engine.connect() as conn:
+        for _ in range(3):
+            with pytest.raises(OperationalError):
+                conn.execute(text("SELECT * FROM tabla_inexistente"))
+        conn.execute(text("SELECT 1"))
+        
+        # Solo la sentencia exitosa se mide, y la conexión no guarda inicios pendientes
+        assert _observaciones("SELECT") == antes + 1
+        assert not any(clave.startswith("_inicio_sql") for clave in conn.info)
+    
+    engine.dispose()
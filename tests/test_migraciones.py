@@ -0,0 +1,136 @@
+"""
+Migraciones de init_db sobre una base con el esquema original
+
+La base se siembra con suscripciones activas duplicadas (misma guía y
+usuario): el índice único parcial solo puede crearse después de
+desactivarlas. Con DDL transaccional (como PostgreSQL) un fallo al crear
+índices no debe deshacer los ADD COLUMN de la misma migración.
+"""
+
+from datetime import datetime
+
+import pytest
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.orm import sessionmaker
+
+import database
+
+ESQUEMA_ORIGINAL = (
+    """
+    CREATE TABLE suscripciones (
+        id INTEGER PRIMARY KEY,
+        numero_guia VARCHAR(50) NOT NULL,
+        onesignal_user_id VARCHAR(255),
+        token_fcm VARCHAR(255),
+        telefono VARCHAR(20),
+        origen VARCHAR(100),
+        destino VARCHAR(100),
+        estado_actual VARCHAR(100),
+        fecha_admision VARCHAR(50),
+        remitente VARCHAR(200),
+        destinatario VARCHAR(200),
+        fecha_creacion DATETIME NOT NULL,
+        ultima_verificacion DATETIME,
+        proxima_verificacion DATETIME,
+        verificaciones_realizadas INTEGER,
+        activo BOOLEAN,
+        fecha_entrega DATETIME
+    )
+    """,
+    "CREATE INDEX ix_suscripciones_numero_guia ON suscripciones (numero_guia)",
+    "CREATE INDEX ix_suscripciones_proxima_verificacion ON suscripciones (proxima_verificacion)",
+    """
+    CREATE TABLE historial_verificaciones (
+        id INTEGER PRIMARY KEY,
+        suscripcion_id INTEGER NOT NULL REFERENCES suscripciones(id),
+        fecha_verificacion DATETIME NOT NULL,
+        estado_encontrado VARCHAR(100)
+    )
+    """,
+)
+
+# (id, guía, usuario, activa): 1 y 2 son la misma suscripción activa duplicada
+FILAS = (
+    (1, "G1", "u1", True),
+    (2, "G1", "u1", True),
+    (3, "G1", "u2", True),
+    (4, "G2", "u1", False),
+    (5, "G2", "u1", True),
+)
+
+
+def _engine(ruta: str, ddl_transaccional: bool):
+    engine = create_engine(f"sqlite:///{ruta}")
+    if ddl_transaccional:
+        # Receta de SQLAlchemy: pysqlite deja de hacer commit implícito antes
+        # de cada DDL, así un CREATE fallido deshace la transacción completa
+        @event.listens_for(engine, "connect")
+        def _conectar(conexion_dbapi, registro):
+            conexion_dbapi.isolation_level = None
+        
+        @event.listens_for(engine, "begin")
+        def _iniciar(conexion):
+            conexion.exec_driver_sql("BEGIN")
+    return engine
+
+
+@pytest.fixture(params=[False, True], ids=["sqlite", "ddl_transaccional"])
+def base_original(request, tmp_path, monkeypatch):
+    engine = _engine(str(tmp_path / "original.db"), request.param)
+    fecha = datetime(2025, 10, 3, 13, 7)
+    with engine.begin() as conn:
+        for sentencia in ESQUEMA_ORIGINAL:
+            conn.execute(text(sentencia))
+        for id_, guia, usuario, activa in FILAS:
+            conn.execute(
+                text(
+                    "INSERT INTO suscripciones (id, numero_guia, onesignal_user_id, estado_actual, "
+                    "origen, destino, fecha_creacion, proxima_verificacion, verificaciones_realizadas, activo) "
+                    "VALUES (:id, :guia, :usuario, 'ADMITIDA', 'MEDELLIN', 'CALI', :fecha, :fecha, 0, :activa)"
+                ),
+                {"id": id_, "guia": guia, "usuario": usuario, "fecha": fecha, "activa": activa}
+            )
+            conn.execute(
+                text(
+                    "INSERT INTO historial_verificaciones (suscripcion_id, fecha_verificacion, estado_encontrado) "
+                    "VALUES (:id, :fecha, 'ADMITIDA')"
+                ),
+                {"id": id_, "fecha": fecha}
+            )
+    
+    monkeypatch.setattr(database, "engine", engine)
+    monkeypatch.setattr(database, "SessionLocal", sessionmaker(autocommit=False, autoflush=False, bind=engine))
+    yield engine
+    engine.dispose()
+
+
+def test_init_db_con_activas_duplicadas(base_original):
+    database.init_db()
+    
+    inspector = inspect(base_original)
+    columnas = {c["name"] for c in inspector.get_columns("suscripciones")}
+    indices = {i["name"] for i in inspector.get_indexes("suscripciones")}
+    
+    assert "guia_id" in columnas and "estado_actual" not in columnas
+    assert {"ix_suscripciones_guia_id", database.INDICE_SUSCRIPCIONES_ACTIVAS.name} <= indices
+    
+    with base_original.connect() as conn:
+        activas = conn.execute(text(
+            "SELECT id FROM suscripciones WHERE activo ORDER BY id"
+        )).scalars().all()
+        sin_guia = conn.execute(text("SELECT count(*) FROM suscripciones WHERE guia_id IS NULL")).scalar()
+        historial = conn.execute(text("SELECT count(*) FROM historial_guias")).scalar()
+    
+    # Se conserva la duplicada más antigua; el resto sigue igual
+    assert activas == [1, 3, 5]
+    assert sin_guia == 0
+    assert historial == len(FILAS)
+
+
+def test_init_db_idempotente(base_original):
+    database.init_db()
+    database.init_db()
+    
+    with base_original.connect() as conn:
+        assert conn.execute(text("SELECT count(*) FROM guias")).scalar() == 2
+        assert conn.execute(text("SELECT count(*) FROM suscripciones WHERE activo")).scalar() == 3
@@ -0,0 +1,84 @@
+"""
+Suscripción sin duplicados: índice único de activas (ON CONFLICT DO NOTHING)
+e Idempotency-Key
+"""
+
+import asyncio
+
+import pytest
+from sqlalchemy import func, select
+
+from database import ClaveIdempotencia, SessionLocal, Suscripcion
+
+pytestmark = pytest.mark.anyio
+
+
+def _activas(numero_guia: str, usuario: str) -> int:
+    with SessionLocal() as db:
+        return db.scalar(
+            select(func.count()).select_from(Suscripcion).where(
+                Suscripcion.numero_guia == numero_guia,
+                Suscripcion.onesignal_user_id == usuario,
+                Suscripcion.activo == True
+            )
+        )
+
+
+async def _contadores_consistentes(cliente) -> bool:
+    exactas = (await cliente.get("/api/stats")).json()
+    materializadas = (await cliente.get("/api/stats?fuente=contadores")).json()
+    return exactas == materializadas
+
+
+async def test_misma_clave_repite_la_respuesta(cliente):
+    cuerpo = {"numero_guia": "IDEM-1", "onesignal_user_id": "usuario-idem-1"}
+    cabeceras = {"Idempotency-Key": "clave-idem-1"}
+    
+    primera = await cliente.post("/api/suscribir", json=cuerpo, headers=cabeceras)
+    repetida = await cliente.post("/api/suscribir", json=cuerpo, headers=cabeceras)
+    
+    assert primera.status_code == repetida.status_code == 200
+    assert "Idempotent-Replayed" not in primera.headers
+    assert repetida.headers["Idempotent-Replayed"] == "true"
+    assert repetida.json() == primera.json()
+    assert _activas("IDEM-1", "usuario-idem-1") == 1
+    assert await _contadores_consistentes(cliente)
+
+
+async def test_misma_clave_otro_cuerpo_es_rechazada(cliente):
+    cabeceras = {"Idempotency-Key": "clave-idem-2"}
+    
+    primera = await cliente.post(
+        "/api/suscribir", json={"numero_guia": "IDEM-2", "onesignal_user_id": "usuario-idem-2"}, headers=cabeceras
+    )
+    otra = await cliente.post(
+        "/api/suscribir", json={"numero_guia": "IDEM-3", "onesignal_user_id": "usuario-idem-2"}, headers=cabeceras
+    )
+    
+    assert primera.status_code == 200
+    assert otra.status_code == 422
+    assert _activas("IDEM-3", "usuario-idem-2") == 0
+    with SessionLocal() as db:
+        assert db.get(ClaveIdempotencia, "clave-idem-2").status_code == 200
+
+
+async def test_inserciones_simultaneas_crean_una_sola_activa(cliente, rastreo):
+    # Ambas esperan la misma consulta de rastreo y llegan juntas al INSERT
+    rastreo.espera = 0.05
+    cuerpo = {"numero_guia": "IDEM-4", "onesignal_user_id": "usuario-idem-4"}
+    
+    respuestas = await asyncio.gather(*(cliente.post("/api/suscribir", json=cuerpo) for _ in range(2)))
+    
+    assert [r.status_code for r in respuestas] == [200, 200]
+    assert respuestas[0].json()["id"] == respuestas[1].json()["id"]
+    assert _activas("IDEM-4", "usuario-idem-4") == 1
+    assert rastreo.consultas.count("IDEM-4") == 1
+    assert await _contadores_consistentes(cliente)
+
+
+async def test_otro_usuario_misma_guia_si_se_crea(cliente):
+    for usuario in ("usuario-idem-5a", "usuario-idem-5b"):
+        respuesta = await cliente.post("/api/suscribir", json={"numero_guia": "IDEM-5", "onesignal_user_id": usuario})
+        assert respuesta.status_code == 200
+    
+    assert _activas("IDEM-5", "usuario-idem-5a") == _activas("IDEM-5", "usuario-idem-5b") == 1
@@ -0,0 +1,126 @@
+"""
+Webhook de rastreo: firma HMAC, tolerancia del timestamp y aplicación de eventos
+"""
+
+import json
+import time
+
+import pytest
+from sqlalchemy import select
+
+import main
+from database import Guia, SessionLocal
+from envios import controlador_envios
+from utils import firma_webhook_valida, firmar_webhook
+
+SECRETO = "secreto-de-pruebas"
+CUERPO = b'{"numero_guia": "X1", "estado_actual": "ADMITIDA"}'
+
+
+# ============ FIRMA ============
+
+def test_firma_valida():
+    ts = str(int(time.time()))
+    assert firma_webhook_valida(SECRETO, ts, firmar_webhook(SECRETO, ts, CUERPO), CUERPO, 300)
+
+
+def test_firma_invalida():
+    ts = str(int(time.time()))
+    assert not firma_webhook_valida(SECRETO, ts, firmar_webhook("otro", ts, CUERPO), CUERPO, 300)
+    assert not firma_webhook_valida(SECRETO, ts, firmar_webhook(SECRETO, ts, CUERPO), CUERPO + b" ", 300)
+    assert not firma_webhook_valida(SECRETO, ts, None, CUERPO, 300)
+    assert not firma_webhook_valida(SECRETO, "no-es-numero", "sha256=00", CUERPO, 300)
+
+
+def test_timestamp_fuera_de_tolerancia():
+    viejo = str(int(time.time()) - 301)
+    futuro = str(int(time.time()) + 301)
+    assert not firma_webhook_valida(SECRETO, viejo, firmar_webhook(SECRETO, viejo, CUERPO), CUERPO, 300)
+    assert not firma_webhook_valida(SECRETO, futuro, firmar_webhook(SECRETO, futuro, CUERPO), CUERPO, 300)
+
+
+# ============ ENDPOINT ============
+
+@pytest.fixture
+def webhook(monkeypatch, cliente):
+    """Envía un payload firmado (o con la firma/timestamp indicados) al webhook"""
+    monkeypatch.setattr(main, "WEBHOOK_RASTREO_SECRETO", SECRETO)
+    
+    async def enviar(payload, timestamp=None, firma=None):
+        cuerpo = json.dumps(payload).encode()
+        timestamp = timestamp or str(int(time.time()))
+        return await cliente.post("/api/webhooks/rastreo", content=cuerpo, headers={
+            "X-Rastreo-Timestamp": timestamp,
+            "X-Rastreo-Firma": firma or firmar_webhook(SECRETO, timestamp, cuerpo),
+        })
+    
+    return enviar
+
+
+async def _suscribir(cliente, numero_guia: str, usuario: str = "usuario-webhook"):
+    respuesta = await cliente.post("/api/suscribir", json={"numero_guia": numero_guia, "onesignal_user_id": usuario})
+    assert respuesta.status_code == 200
+
+
+def _guia(numero_guia: str) -> Guia:
+    with SessionLocal() as db:
+        return db.scalar(select(Guia).where(Guia.numero_guia == numero_guia))
+
+
+@pytest.mark.anyio
+async def test_webhook_firma_invalida(webhook):
+    respuesta = await webhook({"numero_guia": "WH-FIRMA", "estado_actual": "ADMITIDA"}, firma="sha256=00")
+    assert respuesta.status_code == 401
+
+
+@pytest.mark.anyio
+async def test_webhook_timestamp_vencido(webhook):
+    viejo = str(int(time.time()) - 3600)
+    respuesta = await webhook({"numero_guia": "WH-VIEJO", "estado_actual": "ADMITIDA"}, timestamp=viejo)
+    assert respuesta.status_code == 401
+
+
+@pytest.mark.anyio
+async def test_webhook_firma_valida_reprograma(cliente, webhook):
+    await _suscribir(cliente, "WH-VALIDA")
+    
+    respuesta = await webhook({"numero_guia": "WH-VALIDA", "estado_actual": "DESPACHO NACIONAL BUSES"})
+    
+    assert respuesta.status_code == 200
+    assert respuesta.json()["reprogramadas"] == 1
+    assert _guia("WH-VALIDA").estado_actual == "DESPACHO NACIONAL BUSES"
+
+
+@pytest.mark.anyio
+async def test_webhook_guia_cerrada_ignora_eventos_siguientes(cliente, webhook):
+    await _suscribir(cliente, "WH-ORDEN")
+    antes = len(controlador_envios.proveedor.enviados)
+    
+    respuesta = await webhook({"eventos": [
+        {"numero_guia": "WH-ORDEN", "estado_actual": "RECLAME EN OFICINA BOGOTA"},
+        {"numero_guia": "WH-ORDEN", "estado_actual": "ENTREGADA"},
+    ]})
+    await controlador_envios.vaciar()
+    
+    cuerpo = respuesta.json()
+    assert respuesta.status_code == 200
+    assert cuerpo["notificaciones_enviadas"] == 1
+    assert cuerpo["sin_suscripcion"] == 1
+    assert _guia("WH-ORDEN").estado_actual == "RECLAME EN OFICINA BOGOTA"
+    assert len(controlador_envios.proveedor.enviados) - antes == 1
+    assert (await cliente.get("/api/suscripcion/WH-ORDEN")).status_code == 404
+
+
+@pytest.mark.anyio
+async def test_webhook_omite_guia_en_verificacion(cliente, webhook):
+    await _suscribir(cliente, "WH-OCUPADA")
+    guia = _guia("WH-OCUPADA")
+    
+    # Mientras el cron o la agenda la verifican, el evento no se aplica
+    with main._reservar_guias([guia.id]):
+        respuesta = await webhook({"numero_guia": "WH-OCUPADA", "estado_actual": "RECLAME EN OFICINA BOGOTA"})
+    
+    assert respuesta.json()["sin_cambios"] == 1
+    assert respuesta.json()["notificaciones_enviadas"] == 0
+    assert _guia("WH-OCUPADA").estado_actual == "ADMITIDA"
+    assert guia.id not in main._guias_en_verificacion
@@ -0,0 +1,271 @@
+"""
+Modelo de tiempo UTC con la hora de Colombia solo en los bordes
+
+Cada prueba corre con varias zonas horarias del servidor (variable TZ):
+ningún resultado puede depender de la zona del host.
+
+La migración a TIMESTAMPTZ solo existe en PostgreSQL: sin
+TEST_POSTGRES_URL se verifica la sentencia que emite; con ella, la
+conversión real de los valores.
+"""
+
+import os
+import time
+from contextlib import contextmanager
+from types import SimpleNamespace
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+import pytest
+from sqlalchemy import Column, Integer, MetaData, Table, create_engine, insert, select, text
+
+import database
+import main
+from config import obtener_tiempo_viaje
+from database import FechaUTC, _migrar_fechas_utc
+from reloj import ZONA_COLOMBIA, a_colombia, desde_hora_colombia, reloj_simulado
+from utils import calcular_proxima_verificacion, extraer_fecha_despacho
+
+pytestmark = pytest.mark.skipif(not hasattr(time, "tzset"), reason="time.tzset solo existe en POSIX")
+
+ZONAS_HOST = ["UTC", "America/Bogota", "Asia/Tokyo", "Pacific/Kiritimati", "America/Los_Angeles"]
+
+ORIGEN = "MEDELLIN (ANTIOQUIA)"
+DESTINO = "BARRANQUILLA (ATLANTICO)"
+
+
+@pytest.fixture(params=ZONAS_HOST, autouse=True)
+def zona_host(request, monkeypatch):
+    """Cambia la zona horaria local del proceso durante la prueba"""
+    monkeypatch.setenv("TZ", request.param)
+    time.tzset()
+    yield request.param
+    monkeypatch.undo()
+    time.tzset()
+
+
+def _es_utc(momento: datetime) -> bool:
+    return momento.tzinfo is not None and momento.utcoffset() == timedelta(0)
+
+
+def test_zona_del_host_aplicada(zona_host):
+    # Sin esto el resto de pruebas podría pasar sin haber cambiado la zona
+    referencia = datetime(2025, 10, 3, 12, 0)
+    assert referencia.astimezone().utcoffset() == referencia.replace(tzinfo=ZoneInfo(zona_host)).utcoffset()
+
+
+# ============ BORDES: HORA DE COLOMBIA ============
+
+def test_desde_hora_colombia_a_utc():
+    utc = desde_hora_colombia(datetime(2025, 10, 3, 13, 7))
+    
+    assert utc == datetime(2025, 10, 3, 18, 7, tzinfo=timezone.utc)
+    assert _es_utc(utc)
+
+
+def test_a_colombia_ida_y_vuelta():
+    utc = datetime(2025, 10, 3, 2, 30, tzinfo=timezone.utc)
+    local = a_colombia(utc)
+    
+    # Colombia no tiene horario de verano: siempre UTC-5, incluso cruzando la medianoche
+    assert local.tzinfo == ZONA_COLOMBIA
+    assert (local.year, local.month, local.day, local.hour, local.minute) == (2025, 10, 2, 21, 30)
+    assert desde_hora_colombia(local.replace(tzinfo=None)) == utc
+
+
+def test_listado_admin_en_hora_colombia():
+    fila = SimpleNamespace(
+        id=1, numero_guia="G1", onesignal_user_id="u1", estado_actual="ADMITIDA",
+        fecha_creacion=datetime(2025, 10, 3, 18, 7, tzinfo=timezone.utc),
+        proxima_verificacion=datetime(2025, 10, 4, 2, 30, tzinfo=timezone.utc),
+    )
+    
+    salida = main._fila_admin(fila)
+    
+    # Misma zona que el resto de la API: -05:00, sin importar la zona del host
+    assert salida["fecha_creacion"] == "2025-10-03T13:07:00-05:00"
+    assert salida["proxima_verificacion"] == "2025-10-03T21:30:00-05:00"
+
+
+def test_fecha_despacho_de_la_trazabilidad_en_utc():
+    trazabilidad = [
+        {"detalle": "ADMITIDA", "fecha": "2025/10/03 06:00"},
+        {"detalle": "DESPACHO NACIONAL BUSES", "fecha": "2025/10/03 08:00"},
+    ]
+    
+    assert extraer_fecha_despacho(trazabilidad) == datetime(2025, 10, 3, 13, 0, tzinfo=timezone.utc)
+
+
+# ============ PLANIFICADOR CON RELOJ SIMULADO ============
+
+TRAZABILIDAD_DESPACHADA = [
+    {"detalle": "ADMITIDA", "fecha": "2025/10/03 06:00"},
+    {"detalle": "DESPACHO NACIONAL BUSES", "fecha": "2025/10/03 08:00"},  # 13:00 UTC
+]
+DESPACHO_UTC = datetime(2025, 10, 3, 13, 0, tzinfo=timezone.utc)
+
+
+def _proxima(estado: str, verificaciones: int = 0) -> datetime:
+    return calcular_proxima_verificacion(
+        estado, ORIGEN, DESTINO, "2025/10/03 06:00",
+        verificaciones_realizadas=verificaciones,
+        trazabilidad=TRAZABILIDAD_DESPACHADA
+    )
+
+
+def test_sin_despachar_cada_30_minutos():
+    inicio = datetime(2025, 10, 3, 23, 45, tzinfo=timezone.utc)
+    with reloj_simulado(inicio):
+        proxima = _proxima("ADMITIDA")
+    
+    assert proxima == inicio + timedelta(minutes=30)
+    assert _es_utc(proxima)
+
+
+def test_primera_verificacion_al_90_por_ciento():
+    with reloj_simulado(DESPACHO_UTC + timedelta(minutes=30)):
+        proxima = _proxima("DESPACHO NACIONAL BUSES")
+    
+    assert proxima == DESPACHO_UTC + timedelta(hours=obtener_tiempo_viaje(ORIGEN, DESTINO) * 0.9)
+    assert _es_utc(proxima)
+
+
+def test_entre_90_y_100_por_ciento_cada_30_minutos():
+    momento = DESPACHO_UTC + timedelta(hours=obtener_tiempo_viaje(ORIGEN, DESTINO) * 0.95)
+    with reloj_simulado(momento):
+        proxima = _proxima("DESPACHO NACIONAL BUSES", verificaciones=1)
+    
+    assert proxima == momento + timedelta(minutes=30)
+
+
+def test_retrasada_cada_hora():
+    momento = DESPACHO_UTC + timedelta(hours=obtener_tiempo_viaje(ORIGEN, DESTINO) + 2)
+    with reloj_simulado(momento) as reloj:
+        primera = _proxima("DESPACHO NACIONAL BUSES", verificaciones=3)
+        reloj.fijar(primera)
+        segunda = _proxima("DESPACHO NACIONAL BUSES", verificaciones=4)
+    
+    assert primera == momento + timedelta(hours=1)
+    assert segunda == momento + timedelta(hours=2)
+
+
+def test_llegada_no_reprograma():
+    with reloj_simulado(DESPACHO_UTC + timedelta(hours=20)):
+        assert _proxima("RECLAME EN OFICINA BARRANQUILLA") is None
+
+
+# ============ FechaUTC EN SQLITE ============
+
+def test_fecha_utc_ida_y_vuelta_sqlite():
+    engine = create_engine("sqlite://")
+    metadata = MetaData()
+    tabla = Table("fechas", metadata, Column("id", Integer, primary_key=True), Column("fecha", FechaUTC()))
+    metadata.create_all(engine)
+    
+    esperado = datetime(2025, 10, 3, 18, 7, tzinfo=timezone.utc)
+    entradas = [
+        esperado,
+        esperado.astimezone(ZONA_COLOMBIA),
+        esperado.astimezone(ZoneInfo("Asia/Tokyo")),
+        esperado.replace(tzinfo=None),  # sin zona: se interpreta como UTC
+    ]
+    
+    with engine.begin() as conn:
+        conn.execute(insert(tabla), [{"id": i, "fecha": fecha} for i, fecha in enumerate(entradas)])
+        crudas = conn.execute(text("SELECT fecha FROM fechas ORDER BY id")).scalars().all()
+        leidas = conn.execute(select(tabla.c.fecha).order_by(tabla.c.id)).scalars().all()
+    
+    # SQLite guarda la hora UTC sin zona, igual sin importar la zona de entrada
+    assert len(set(crudas)) == 1 and crudas[0].startswith("2025-10-03 18:07:00")
+    assert all(fecha == esperado and _es_utc(fecha) for fecha in leidas)
+
+
+# ============ MIGRACIÓN A TIMESTAMPTZ ============
+
+class _ResultadoFalso:
+    def __init__(self, valor):
+        self.valor = valor
+    
+    def scalar(self):
+        return self.valor
+
+
+class _ConexionFalsa:
+    """Registra las sentencias y responde el tipo de columna pedido a information_schema"""
+    
+    def __init__(self, tipo: str):
+        self.tipo = tipo
+        self.alteraciones = []
+        self.commits = 0
+    
+    def execute(self, sentencia, parametros=None):
+        sql = str(sentencia)
+        if "information_schema" in sql:
+            return _ResultadoFalso(self.tipo)
+        self.alteraciones.append((" ".join(sql.split()), sentencia.compile().params))
+        return _ResultadoFalso(None)
+    
+    def commit(self):
+        self.commits += 1
+
+
+class _EngineFalso:
+    class dialect:
+        name = "postgresql"
+    
+    def __init__(self, conexion: _ConexionFalsa):
+        self.conexion = conexion
+    
+    @contextmanager
+    def connect(self):
+        yield self.conexion
+
+
+def test_migracion_emite_at_time_zone_con_la_zona_legado(monkeypatch):
+    conexion = _ConexionFalsa("timestamp without time zone")
+    monkeypatch.setattr(database, "engine", _EngineFalso(conexion))
+    monkeypatch.setattr(database, "DB_ZONA_FECHAS_LEGADO", "America/Bogota")
+    
+    _migrar_fechas_utc()
+    
+    assert len(conexion.alteraciones) == len(database.COLUMNAS_FECHA)
+    for (tabla, columna), (sql, parametros) in zip(database.COLUMNAS_FECHA, conexion.alteraciones):
+        assert sql == (
+            f"ALTER TABLE {tabla} ALTER COLUMN {columna} TYPE TIMESTAMPTZ "
+            f"USING {columna} AT TIME ZONE :zona"
+        )
+        assert parametros == {"zona": "America/Bogota"}
+    assert conexion.commits == 1
+
+
+def test_migracion_idempotente(monkeypatch):
+    conexion = _ConexionFalsa("timestamp with time zone")
+    monkeypatch.setattr(database, "engine", _EngineFalso(conexion))
+    
+    _migrar_fechas_utc()
+    
+    assert conexion.alteraciones == []
+
+
+@pytest.mark.skipif(not os.environ.get("TEST_POSTGRES_URL"), reason="Requiere TEST_POSTGRES_URL")
+def test_migracion_convierte_valores_en_postgres(monkeypatch):
+    engine = create_engine(os.environ["TEST_POSTGRES_URL"])
+    with engine.begin() as conn:
+        conn.execute(text("DROP TABLE IF EXISTS prueba_migracion_tz"))
+        conn.execute(text("CREATE TABLE prueba_migracion_tz (fecha TIMESTAMP WITHOUT TIME ZONE)"))
+        conn.execute(text("INSERT INTO prueba_migracion_tz VALUES ('2025-10-03 08:00:00')"))
+    
+    monkeypatch.setattr(database, "engine", engine)
+    monkeypatch.setattr(database, "COLUMNAS_FECHA", (("prueba_migracion_tz", "fecha"),))
+    monkeypatch.setattr(database, "DB_ZONA_FECHAS_LEGADO", "America/Bogota")
+    try:
+        _migrar_fechas_utc()
+        with engine.connect() as conn:
+            fecha = conn.execute(text("SELECT fecha FROM prueba_migracion_tz")).scalar()
+    finally:
+        with engine.begin() as conn:
+            conn.execute(text("DROP TABLE prueba_migracion_tz"))
+        engine.dispose()
+    
+    # La hora guardada sin zona era hora Colombia: igual que desde_hora_colombia
+    assert fecha == desde_hora_colombia(datetime(2025, 10, 3, 8, 0))
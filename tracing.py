@@ -0,0 +1,189 @@
+"""
+Trazas por ejecución (estilo OpenTelemetry, sin dependencias externas)
+
+Cada `span` mide una etapa y se anida automáticamente bajo el span activo
+(contextvars, funciona a través de asyncio.gather). El span raíz acumula
+los tiempos por nombre de etapa para devolver un resumen en la respuesta.
+
+Variables de entorno:
+    TRACING_EXPORTADOR  "ninguno" (por defecto) | "consola" | "archivo"
+    TRACING_ARCHIVO     Ruta del archivo JSONL (por defecto trazas.jsonl)
+"""
+
+import asyncio
+import atexit
+import json
+import logging
+import os
+import queue
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+TRACING_EXPORTADOR = os.environ.get("TRACING_EXPORTADOR", "ninguno").lower()
+TRACING_ARCHIVO = os.environ.get("TRACING_ARCHIVO", "trazas.jsonl")
+
+
+class Span:
+    """Una etapa medida; los campos siguen los nombres de OpenTelemetry"""
+    
+    __slots__ = (
+        "nombre", "trace_id", "span_id", "parent_span_id", "atributos",
+        "inicio_unix_ns", "_inicio", "duracion_ns", "estado", "raiz", "tiempos"
+    )
+    
+    def __init__(self, nombre: str, padre: Optional["Span"], atributos: dict):
+        self.nombre = nombre
+        self.trace_id = padre.trace_id if padre else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_span_id = padre.span_id if padre else None
+        self.atributos = atributos
+        self.inicio_unix_ns = time.time_ns()
+        self._inicio = time.perf_counter_ns()
+        self.duracion_ns = 0
+        self.estado = "ok"
+        self.raiz = padre.raiz if padre else self
+        # Solo el span raíz acumula: nombre -> [llamadas, ns totales]
+        self.tiempos: Optional[Dict[str, list]] = {} if padre is None else None
+    
+    def establecer(self, clave: str, valor):
+        self.atributos[clave] = valor
+    
+    def a_dict(self) -> dict:
+        return {
+            "name": self.nombre,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_span_id,
+            "start_time_unix_nano": self.inicio_unix_ns,
+            "end_time_unix_nano": self.inicio_unix_ns + self.duracion_ns,
+            "status": self.estado,
+            "attributes": self.atributos,
+        }
+
+
+class _ExportadorConsola:
+    def exportar(self, span: Span):
+        logger.info("span %s", json.dumps(span.a_dict(), ensure_ascii=False, default=str))
+
+
+class _ExportadorArchivo:
+    """
+    Escribe los spans en JSONL desde un hilo propio
+    
+    span() solo encola el dict (la verificación emite un span por guía); la
+    serialización y la escritura ocurren fuera del event loop, como en el
+    QueueListener de logging_config. El buffer se vacía cuando la cola queda
+    vacía.
+    """
+    
+    _FIN = object()
+    
+    def __init__(self, ruta: str):
+        self._archivo = open(ruta, "a", encoding="utf-8")
+        self._cola: "queue.Queue" = queue.Queue()
+        self._hilo = threading.Thread(target=self._escribir, name="tracing-archivo", daemon=True)
+        self._hilo.start()
+        atexit.register(self.detener)
+    
+    def exportar(self, span: Span):
+        self._cola.put(span.a_dict())
+    
+    def _escribir(self):
+        while True:
+            registro = self._cola.get()
+            if registro is self._FIN:
+                break
+            try:
+                self._archivo.write(json.dumps(registro, ensure_ascii=False, default=str) + "\n")
+                if self._cola.empty():
+                    self._archivo.flush()
+            except Exception as e:
+                logger.warning("⚠️ No se pudo escribir el span: %s", e)
+            finally:
+                self._cola.task_done()
+        self._archivo.close()
+    
+    def vaciar(self):
+        """Espera a que los spans encolados estén escritos en el archivo"""
+        if self._hilo.is_alive():
+            self._cola.join()
+    
+    def detener(self):
+        """Escribe los spans pendientes y cierra el archivo (al salir del proceso)"""
+        if self._hilo.is_alive():
+            self._cola.put(self._FIN)
+            self._hilo.join()
+
+
+def _crear_exportador():
+    if TRACING_EXPORTADOR == "consola":
+        return _ExportadorConsola()
+    if TRACING_EXPORTADOR == "archivo":
+        return _ExportadorArchivo(TRACING_ARCHIVO)
+    return None
+
+
+_exportador = _crear_exportador()
+_span_actual: ContextVar[Optional[Span]] = ContextVar("span_actual", default=None)
+
+
+@contextmanager
+def span(nombre: str, **atributos) -> Iterator[Span]:
+    """
+    Mide una etapa como hija del span activo (o como raíz si no hay ninguno)
+    
+    Example:
+        with span("verificacion") as raiz:
+            with span("db.consultar_pendientes"):
+                ...
+        resumen_tiempos(raiz)
+    """
+    padre = _span_actual.get()
+    actual = Span(nombre, padre, atributos)
+    token = _span_actual.set(actual)
+    
+    try:
+        yield actual
+    except BaseException as e:
+        actual.estado = "error"
+        actual.atributos["error"] = str(e)
+        raise
+    finally:
+        actual.duracion_ns = time.perf_counter_ns() - actual._inicio
+        _span_actual.reset(token)
+        
+        acumulado = actual.raiz.tiempos.setdefault(nombre, [0, 0])
+        acumulado[0] += 1
+        acumulado[1] += actual.duracion_ns
+        
+        if _exportador is not None:
+            _exportador.exportar(actual)
+
+
+async def detener_rastreo():
+    """Vacía los spans pendientes del exportador (al apagar la aplicación)"""
+    if isinstance(_exportador, _ExportadorArchivo):
+        await asyncio.to_thread(_exportador.vaciar)
+
+
+def resumen_tiempos(raiz: Span) -> dict:
+    """
+    Tiempos por etapa de una traza
+    
+    Returns:
+        {etapa: {"llamadas": n, "total_ms": x, "promedio_ms": y}}
+    """
+    return {
+        nombre: {
+            "llamadas": llamadas,
+            "total_ms": round(total_ns / 1e6, 2),
+            "promedio_ms": round(total_ns / llamadas / 1e6, 2),
+        }
+        for nombre, (llamadas, total_ns) in raiz.tiempos.items()
+    }
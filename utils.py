@@ -2,24 +2,62 @@
 Funciones auxiliares del sistema
 """
 
-import requests
+import asyncio
+import hashlib
+import hmac
+import httpx
 import logging
+import re
+import time
 from datetime import datetime, timedelta
-from typing import Optional, Dict, List
+from typing import Optional, Dict, List, Tuple
 from config import (
     RASTREO_API_URL, 
-    ONESIGNAL_API_KEY,
-    ONESIGNAL_APP_ID,
     HORAS_ENTRE_VERIFICACIONES,
+    HTTP_MAX_CONEXIONES,
+    RASTREO_CACHE_SEGUNDOS,
+    RASTREO_CACHE_MAX_ENTRADAS,
     obtener_tiempo_viaje,
     limpiar_nombre_ciudad
 )
+from metricas import LATENCIA_RASTREO
+from reloj import ahora, a_colombia, desde_hora_colombia
 
 logger = logging.getLogger(__name__)
 
+# ============ CLIENTE HTTP COMPARTIDO ============
+
+_cliente_http: Optional[httpx.AsyncClient] = None
+
+
+def obtener_cliente_http() -> httpx.AsyncClient:
+    """
+    Devuelve el cliente HTTP asíncrono compartido (se crea al primer uso)
+    Reutiliza conexiones keep-alive hacia la API de rastreo y OneSignal
+    """
+    global _cliente_http
+    if _cliente_http is None or _cliente_http.is_closed:
+        _cliente_http = httpx.AsyncClient(
+            timeout=15,
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONEXIONES,
+                max_keepalive_connections=HTTP_MAX_CONEXIONES
+            )
+        )
+    return _cliente_http
+
+
+async def cerrar_cliente_http():
+    """Cierra el cliente HTTP compartido (al apagar la aplicación)"""
+    global _cliente_http
+    if _cliente_http is not None:
+        await _cliente_http.aclose()
+        _cliente_http = None
+
+
 # ============ INTEGRACIÓN CON API DE RASTREO ============
 
-def consultar_guia_rastreo(numero_guia: str) -> Optional[Dict]:
+async def consultar_guia_rastreo(numero_guia: str) -> Optional[Dict]:
     """
     Consulta la información de una guía en la API de rastreo existente
     
@@ -29,39 +67,172 @@ def consultar_guia_rastreo(numero_guia: str) -> Optional[Dict]:
     Returns:
         Diccionario con la información de la guía o None si hay error
     """
+    inicio = time.perf_counter()
+    resultado = "error"
+    
     try:
-        logger.info(f"🔍 Consultando guía {numero_guia} en API de rastreo...")
+        logger.debug("🔍 Consultando guía %s en API de rastreo...", numero_guia, extra={"numero_guia": numero_guia})
         
-        response = requests.get(
+        response = await obtener_cliente_http().get(
             f"{RASTREO_API_URL}/{numero_guia}",
             timeout=15
         )
         
         if response.status_code == 200:
             data = response.json()
-            logger.info(f"✅ Guía {numero_guia} consultada exitosamente")
+            resultado = "ok"
+            logger.debug("✅ Guía %s consultada exitosamente", numero_guia, extra={"numero_guia": numero_guia})
             return data
         else:
-            logger.error(f"❌ Error consultando guía: HTTP {response.status_code}")
+            resultado = "http_error"
+            logger.error("❌ Error consultando guía %s: HTTP %s", numero_guia, response.status_code)
             return None
             
-    except requests.Timeout:
-        logger.error(f"⏰ Timeout consultando guía {numero_guia}")
+    except httpx.TimeoutException:
+        resultado = "timeout"
+        logger.error("⏰ Timeout consultando guía %s", numero_guia)
         return None
     except Exception as e:
-        logger.error(f"❌ Error consultando guía: {e}")
+        logger.error("❌ Error consultando guía %s: %s", numero_guia, e)
         return None
+    finally:
+        LATENCIA_RASTREO.labels(resultado).observe(time.perf_counter() - inicio)
+
+
+# Consultas recientes (numero_guia -> (expira, info)) y consultas en vuelo
+_cache_rastreo: Dict[str, Tuple[float, Dict]] = {}
+_consultas_en_curso: Dict[str, asyncio.Future] = {}
+
+
+async def consultar_guia_rastreo_cacheada(numero_guia: str) -> Optional[Dict]:
+    """
+    Igual que consultar_guia_rastreo, pero reutiliza resultados recientes
+    (RASTREO_CACHE_SEGUNDOS) y comparte la misma consulta entre llamadas
+    simultáneas por la misma guía. Para suscribir, no para el verificador
+    (que necesita el estado actual).
+    
+    Returns:
+        Diccionario con la información de la guía o None si hay error
+    """
+    entrada = _cache_rastreo.get(numero_guia)
+    if entrada and entrada[0] > time.monotonic():
+        return entrada[1]
+    
+    consulta = _consultas_en_curso.get(numero_guia)
+    if consulta is None:
+        consulta = asyncio.ensure_future(consultar_guia_rastreo(numero_guia))
+        _consultas_en_curso[numero_guia] = consulta
+        consulta.add_done_callback(lambda _: _consultas_en_curso.pop(numero_guia, None))
+    
+    # shield: si quien espera se cancela, la consulta sigue para los demás
+    info = await asyncio.shield(consulta)
+    
+    if info and RASTREO_CACHE_SEGUNDOS > 0:
+        _cache_rastreo.pop(numero_guia, None)
+        _cache_rastreo[numero_guia] = (time.monotonic() + RASTREO_CACHE_SEGUNDOS, info)
+        while len(_cache_rastreo) > RASTREO_CACHE_MAX_ENTRADAS:
+            del _cache_rastreo[next(iter(_cache_rastreo))]
+    return info
+
+
+# ============ FIRMA DE WEBHOOKS ============
+
+def firmar_webhook(secreto: str, timestamp: str, cuerpo: bytes) -> str:
+    """
+    Firma HMAC-SHA256 de un webhook: sha256=<hex> sobre "<timestamp>.<cuerpo>"
+    
+    Args:
+        secreto: Secreto compartido con el emisor
+        timestamp: Segundos Unix (texto) enviados en X-Rastreo-Timestamp
+        cuerpo: Cuerpo crudo de la petición
+    """
+    mensaje = timestamp.encode() + b"." + cuerpo
+    return "sha256=" + hmac.new(secreto.encode(), mensaje, hashlib.sha256).hexdigest()
+
+
+def firma_webhook_valida(secreto: str, timestamp: Optional[str], firma: Optional[str],
+                         cuerpo: bytes, tolerancia_segundos: int) -> bool:
+    """Comprueba la firma (en tiempo constante) y que el timestamp sea reciente"""
+    if not timestamp or not firma:
+        return False
+    try:
+        antiguedad = abs(time.time() - int(timestamp))
+    except ValueError:
+        return False
+    if antiguedad > tolerancia_segundos:
+        return False
+    return hmac.compare_digest(firmar_webhook(secreto, timestamp, cuerpo), firma)
+
+
+# ============ TRAZABILIDAD INCREMENTAL ============
+
+def huella_evento(evento: Dict) -> str:
+    """Huella corta de un evento de trazabilidad (detalle + fecha)"""
+    contenido = f"{evento.get('detalle', '')}|{evento.get('fecha', '')}"
+    return hashlib.sha1(contenido.encode("utf-8")).hexdigest()[:16]
+
+
+def diferencia_trazabilidad(
+    trazabilidad: List[Dict],
+    eventos_previos: int,
+    huella_previa: Optional[str]
+) -> Tuple[Optional[List[Dict]], int, Optional[str]]:
+    """
+    Compara la trazabilidad recibida con el resumen guardado
+    
+    La trazabilidad es append-only en orden cronológico: si el evento en la
+    posición eventos_previos - 1 conserva su huella, los nuevos son los que
+    siguen. Si no coincide (la API reescribió la historia o no había resumen)
+    se resincroniza sin reportar eventos nuevos.
+    
+    Args:
+        trazabilidad: Lista completa de eventos recibida de la API
+        eventos_previos: Cantidad de eventos en el resumen guardado
+        huella_previa: Huella del último evento del resumen guardado
+    
+    Returns:
+        (eventos nuevos o None si hubo resincronización, cantidad actual, huella actual)
+    """
+    cantidad = len(trazabilidad)
+    huella = huella_evento(trazabilidad[-1]) if trazabilidad else None
+    
+    if eventos_previos and huella_previa and cantidad >= eventos_previos \
+            and huella_evento(trazabilidad[eventos_previos - 1]) == huella_previa:
+        return trazabilidad[eventos_previos:], cantidad, huella
+    
+    return None, cantidad, huella
 
 
 # ============ CÁLCULO DE TIEMPOS ============
 
+def extraer_fecha_despacho(trazabilidad: Optional[List[Dict]]) -> Optional[datetime]:
+    """
+    Busca en la trazabilidad la fecha del evento DESPACHO NACIONAL BUSES
+    
+    Args:
+        trazabilidad: Lista con el historial de estados y fechas
+    
+    Returns:
+        Fecha de despacho en UTC, o None si aún no aparece
+    """
+    for registro in trazabilidad or ():
+        if "DESPACHO NACIONAL BUSES" in registro.get('detalle', '').upper():
+            fecha_str = registro.get('fecha')
+            fecha_despacho = parsear_fecha_admision(fecha_str) if fecha_str else None
+            if fecha_despacho:
+                # La API de rastreo publica hora local de Colombia sin zona
+                return desde_hora_colombia(fecha_despacho)
+    return None
+
+
 def calcular_proxima_verificacion(
     estado_actual: str,
     origen: str,
     destino: str,
     fecha_admision: str,
     verificaciones_realizadas: int = 0,
-    trazabilidad: List[Dict] = None
+    trazabilidad: List[Dict] = None,
+    fecha_despacho: Optional[datetime] = None
 ) -> Optional[datetime]:
     """
     Calcula cuándo debe realizarse la próxima verificación de una guía
@@ -78,79 +249,63 @@ def calcular_proxima_verificacion(
         destino: Ciudad destino
         fecha_admision: Fecha de admisión
         verificaciones_realizadas: Número de verificaciones ya hechas
-        trazabilidad: Lista con el historial de estados y fechas
+        trazabilidad: Lista con el historial de estados y fechas (solo se
+            recorre si no se pasa fecha_despacho)
+        fecha_despacho: Fecha de despacho ya conocida (UTC), guardada en la suscripción
     
     Returns:
-        Datetime de la próxima verificación (en UTC para la BD) o None si ya llegó
+        Datetime UTC con zona de la próxima verificación, o None si ya llegó
     """
     try:
         estado_upper = estado_actual.upper() if estado_actual else ""
         
-        # Convertir UTC a hora Colombia para todos los cálculos
-        ahora_utc = datetime.now()
-        ahora_colombia = ahora_utc - timedelta(hours=5)
-        
-        logger.info(f"⏰ Hora servidor UTC: {ahora_utc}")
-        logger.info(f"🇨🇴 Hora Colombia: {ahora_colombia}")
+        # Todos los cálculos en UTC con zona; la hora Colombia solo para
+        # interpretar las fechas de la trazabilidad y para los logs
+        ahora_utc = ahora()
         
         # CASO 1: Si ya llegó a destino, NO programar más verificaciones
         if "RECLAME EN OFICINA" in estado_upper or "ENTREGADA" in estado_upper:
-            logger.info("📦 Guía ya está en RECLAME EN OFICINA, no programar verificaciones")
+            logger.debug("📦 Guía ya está en RECLAME EN OFICINA, no programar verificaciones")
             return None
         
         # CASO 2: Si aún NO está despachada, verificar cada 30 minutos
         if "DESPACHO NACIONAL BUSES" not in estado_upper:
-            proxima_colombia = ahora_colombia + timedelta(minutes=30)
-            proxima_utc = proxima_colombia + timedelta(hours=5)
-            logger.info(f"⏳ Guía sin despachar, verificar en 30 minutos")
-            logger.info(f"📍 Estado actual: {estado_actual}")
-            logger.info(f"📅 Próxima verificación (Colombia): {proxima_colombia}")
+            proxima_utc = ahora_utc + timedelta(minutes=30)
+            logger.debug(
+                "⏳ Guía sin despachar (%s), próxima verificación en 30 min (Colombia): %s",
+                estado_actual, a_colombia(proxima_utc)
+            )
             return proxima_utc
         
         # CASO 3: Ya está DESPACHADA - usar estrategia inteligente
-        logger.info(f"🚛 Guía DESPACHADA - Iniciando cálculo de tiempo estimado")
-        
-        # Buscar la fecha REAL del despacho en la trazabilidad
-        fecha_despacho = None
-        
-        if trazabilidad:
-            logger.info(f"🔍 Buscando fecha real de despacho en trazabilidad...")
-            for registro in trazabilidad:
-                detalle = registro.get('detalle', '').upper()
-                if "DESPACHO NACIONAL BUSES" in detalle:
-                    fecha_str = registro.get('fecha')
-                    if fecha_str:
-                        fecha_despacho = parsear_fecha_admision(fecha_str)
-                        if fecha_despacho:
-                            logger.info(f"✅ Fecha real de despacho encontrada: {fecha_despacho}")
-                            logger.info(f"   (Extraída de trazabilidad: {fecha_str})")
-                            break
+        # Fecha REAL del despacho: la guardada en la suscripción o, si no, la de la trazabilidad
+        if fecha_despacho is None:
+            fecha_despacho = extraer_fecha_despacho(trazabilidad)
         
         # Si no se encontró, usar ahora como fallback
         if not fecha_despacho:
-            logger.warning("⚠️ No se encontró fecha de despacho en trazabilidad")
-            logger.warning("⚠️ Usando fecha/hora actual como fallback")
-            fecha_despacho = ahora_colombia
+            logger.debug("⚠️ Sin fecha de despacho en trazabilidad, usando hora actual como fallback")
+            fecha_despacho = ahora_utc
         
         # Obtener tiempo de viaje
         tiempo_viaje = obtener_tiempo_viaje(origen, destino)
-        logger.info(f"⏱️ Tiempo estimado de viaje: {tiempo_viaje} horas")
         
         # Calcular cuándo debería llegar (100% del tiempo)
         tiempo_llegada_esperado = fecha_despacho + timedelta(hours=tiempo_viaje)
-        logger.info(f"🎯 Hora de llegada esperada (Colombia): {tiempo_llegada_esperado}")
+        logger.debug(
+            "🚛 Guía despachada %s, viaje %sh, llegada esperada (Colombia): %s",
+            a_colombia(fecha_despacho), tiempo_viaje, a_colombia(tiempo_llegada_esperado)
+        )
         
         # CASO 4: Si YA PASÓ el 100% del tiempo (guía retrasada)
         # LÓGICA: Verificar cada 1 HORA
-        if ahora_colombia > tiempo_llegada_esperado:
-            logger.warning(f"⚠️ El tiempo estimado de viaje (100%) ya pasó completo")
-            logger.warning(f"⏰ Debió llegar a las {tiempo_llegada_esperado} (Colombia)")
-            logger.info(f"🔄 Guía retrasada - Verificando cada 1 HORA")
-            
+        if ahora_utc > tiempo_llegada_esperado:
             # ✅ CADA 1 HORA cuando está retrasada
-            proxima_colombia = ahora_colombia + timedelta(hours=1)
-            proxima_utc = proxima_colombia + timedelta(hours=5)
-            logger.info(f"📅 Próxima verificación (Colombia): {proxima_colombia}")
+            proxima_utc = ahora_utc + timedelta(hours=1)
+            logger.debug(
+                "🔄 Guía retrasada (debió llegar %s), verificar cada 1 HORA: %s",
+                a_colombia(tiempo_llegada_esperado), a_colombia(proxima_utc)
+            )
             return proxima_utc
         
         # CASO 5: Calcular el 90% del tiempo
@@ -159,131 +314,30 @@ def calcular_proxima_verificacion(
         
         # Si es la PRIMERA verificación y aún NO ha llegado al 90%
         # LÓGICA: Esperar hasta el 90%
-        if verificaciones_realizadas == 0 and ahora_colombia < hora_90_porciento:
-            logger.info(
-                f"📅 Primera verificación programada al 90%:\n"
-                f"   - Fecha despacho (Colombia): {fecha_despacho}\n"
-                f"   - Tiempo total viaje: {tiempo_viaje}h\n"
-                f"   - Esperar hasta 90%: {horas_hasta_90:.1f}h\n"
-                f"   - Próxima verificación (Colombia): {hora_90_porciento}"
+        if verificaciones_realizadas == 0 and ahora_utc < hora_90_porciento:
+            logger.debug(
+                "📅 Primera verificación al 90%% (%.1fh de %sh): %s",
+                horas_hasta_90, tiempo_viaje, a_colombia(hora_90_porciento)
             )
-            proxima_utc = hora_90_porciento + timedelta(hours=5)
-            return proxima_utc
+            return hora_90_porciento
         
         # CASO 6: Ya pasó el 90% pero NO el 100% (entre 90% y 100%)
         # O es una verificación subsiguiente
         # LÓGICA: Verificar cada 30 MINUTOS
-        proxima_colombia = ahora_colombia + timedelta(minutes=30)
-        proxima_utc = proxima_colombia + timedelta(hours=5)
-        tiempo_restante = (tiempo_llegada_esperado - ahora_colombia).total_seconds() / 3600
+        proxima_utc = ahora_utc + timedelta(minutes=30)
         
-        logger.info(f"📅 Verificación cada 30 MINUTOS (Colombia): {proxima_colombia}")
-        logger.info(f"⏱️ Tiempo restante hasta llegada: {tiempo_restante:.1f}h")
+        if logger.isEnabledFor(logging.DEBUG):
+            tiempo_restante = (tiempo_llegada_esperado - ahora_utc).total_seconds() / 3600
+            logger.debug(
+                "📅 Verificación cada 30 MINUTOS (Colombia): %s, faltan %.1fh",
+                a_colombia(proxima_utc), tiempo_restante
+            )
         return proxima_utc
         
     except Exception as e:
-        logger.error(f"❌ Error calculando próxima verificación: {e}")
+        logger.error("❌ Error calculando próxima verificación: %s", e)
         # En caso de error, verificar en 30 minutos
-        ahora_utc = datetime.now()
-        ahora_colombia = ahora_utc - timedelta(hours=5)
-        proxima_utc = ahora_colombia + timedelta(minutes=30) + timedelta(hours=5)
-        return proxima_utc
-
-
-# ============ ONESIGNAL PUSH NOTIFICATIONS ============
-
-def enviar_push_notification(
-    onesignal_user_id: str, 
-    titulo: str, 
-    mensaje: str, 
-    datos_extra: dict = None
-) -> bool:
-    """
-    Envía notificación push usando OneSignal Player ID (API V1)
-    
-    CRÍTICO: USA "include_player_ids" que es compatible con API V1
-    NO usa "include_aliases" que causaba el error
-    
-    Args:
-        onesignal_user_id: OneSignal Player ID (UUID)
-        titulo: Título de la notificación
-        mensaje: Mensaje de la notificación
-        datos_extra: Datos adicionales (opcional)
-    
-    Returns:
-        True si se envió exitosamente, False en caso contrario
-    """
-    import re
-    
-    try:
-        if not ONESIGNAL_API_KEY or not ONESIGNAL_APP_ID:
-            logger.warning("⚠️ OneSignal no configurado")
-            return False
-        
-        if not onesignal_user_id or onesignal_user_id.strip() == "":
-            logger.error("❌ OneSignal Player ID está vacío")
-            return False
-        
-        # Validar formato UUID del Player ID
-        uuid_regex = r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$'
-        if not re.match(uuid_regex, onesignal_user_id, re.IGNORECASE):
-            logger.warning(f"⚠️ Player ID con formato inválido: {onesignal_user_id}")
-            return False
-        
-        logger.info(f"📲 Enviando push OneSignal: {titulo}")
-        logger.info(f"🎯 Destinatario (Player ID): {onesignal_user_id}")
-        
-        headers = {
-            "Authorization": f"Basic {ONESIGNAL_API_KEY}",
-            "Content-Type": "application/json; charset=utf-8"
-        }
-        
-        # ✅ CRÍTICO: Usar include_player_ids para API V1
-        payload = {
-            "app_id": ONESIGNAL_APP_ID,
-            "include_player_ids": [onesignal_user_id],
-            "headings": {"en": titulo},
-            "contents": {"en": mensaje},
-            "priority": 10
-        }
-        
-        if datos_extra:
-            payload["data"] = datos_extra
-            logger.info(f"📦 Datos extra incluidos: {datos_extra}")
-        
-        logger.info(f"📡 Enviando a OneSignal API...")
-        
-        response = requests.post(
-            "https://onesignal.com/api/v1/notifications",
-            json=payload,
-            headers=headers,
-            timeout=10
-        )
-        
-        result = response.json()
-        
-        if response.status_code == 200:
-            recipients = result.get("recipients", 0)
-            if recipients > 0:
-                logger.info(f"✅ Push enviado exitosamente")
-                logger.info(f"📊 Recipients: {recipients}")
-                logger.info(f"📋 Notification ID: {result.get('id', 'N/A')}")
-                return True
-            else:
-                # ✅ CAMBIADO: De warning a debug (no mostrar en logs normales)
-                logger.debug(f"OneSignal sin recipients: {result}")
-                return False
-        else:
-            logger.error(f"❌ Error HTTP al enviar push: {response.status_code}")
-            logger.error(f"📄 Response: {result}")
-            return False
-            
-    except requests.exceptions.Timeout:
-        logger.error(f"❌ Timeout al enviar notificación OneSignal")
-        return False
-    except Exception as e:
-        logger.error(f"❌ Error enviando push: {e}")
-        return False
+        return ahora() + timedelta(minutes=30)
 
 
 # ============ VALIDACIONES ============
@@ -292,7 +346,6 @@ def validar_numero_guia(numero_guia: str) -> bool:
     """
     Valida el formato del número de guía de Rápido Ochoa
     """
-    import re
     if not numero_guia:
         return False
     
@@ -300,15 +353,35 @@ def validar_numero_guia(numero_guia: str) -> bool:
     return bool(re.match(patron, numero_guia.upper()))
 
 
+# Respaldo para variantes sin ceros a la izquierda ("2025/10/3 9:07")
+_PATRON_FECHA = re.compile(r"(\d{4})[/-](\d{1,2})[/-](\d{1,2})[ T](\d{1,2}):(\d{2})(?::(\d{2}))?")
+
+
 def parsear_fecha_admision(fecha_str: str) -> Optional[datetime]:
     """
-    Parsea la fecha de admisión del formato de Rápido Ochoa
+    Parsea una fecha de Rápido Ochoa (hora local sin zona)
+    
+    Formatos: "2025/10/03 13:07" (API de rastreo) y "2025-10-03 13:07:00".
+    Los formatos conocidos se leen por posición (sin strptime); el resto
+    pasa por una expresión regular precompilada.
     """
     try:
-        return datetime.strptime(fecha_str, "%Y/%m/%d %H:%M")
-    except:
-        try:
-            return datetime.strptime(fecha_str, "%Y-%m-%d %H:%M:%S")
-        except:
-            logger.warning(f"⚠️ No se pudo parsear fecha: {fecha_str}")
-            return None
+        if len(fecha_str) == 16 and fecha_str[4] == "/" and fecha_str[13] == ":":
+            return datetime(
+                int(fecha_str[0:4]), int(fecha_str[5:7]), int(fecha_str[8:10]),
+                int(fecha_str[11:13]), int(fecha_str[14:16])
+            )
+        if len(fecha_str) == 19 and fecha_str[4] == "-" and fecha_str[16] == ":":
+            return datetime(
+                int(fecha_str[0:4]), int(fecha_str[5:7]), int(fecha_str[8:10]),
+                int(fecha_str[11:13]), int(fecha_str[14:16]), int(fecha_str[17:19])
+            )
+        
+        coincidencia = _PATRON_FECHA.fullmatch(fecha_str.strip())
+        if coincidencia:
+            return datetime(*(int(parte or 0) for parte in coincidencia.groups()))
+    except (TypeError, ValueError, AttributeError):
+        pass
+    
+    logger.warning("⚠️ No se pudo parsear fecha: %s", fecha_str)
+    return None